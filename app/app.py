@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import functools
-import re
+import tempfile
 import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from uuid import uuid4
 
 import pika.exceptions
 from cloudevents.events import (
@@ -19,8 +24,28 @@ from viaa.observability import logging
 from app.services.org_api import OrgApiClient
 from app.services.pulsar import PulsarClient, PRODUCER_TOPIC
 from app.services import rabbit
-from app.helpers.bag import Bag
+from app.services.rabbit import ConsumerQueue
+from app.helpers.acks import AckCoalescer
+from app.helpers.admission import DiskAdmission
+from app.helpers.bag import Bag, guess_mimetype
+from app.helpers.fixity_cache import FixityCache
+from app.helpers.inflight import Delivery, InFlightRegistry, calculate_message_key
+from app.helpers.journal import JobJournal, JobStage
+from app.helpers.metrics import (
+    JobMetrics,
+    MetricsServer,
+    queue_wait,
+    throughput,
+    timed,
+)
+from app.helpers.outbox import Outbox, OutboxFlusher
+from app.helpers.prefetch import PrefetchController, split_prefetch_count
+from app.helpers.profiling import JobProfiler, ProfilingPolicy
+from app.helpers.scheduler import WeightedScheduler
 from app.helpers.sidecar import Sidecar
+from app.helpers.storage import optional_path
+from app.helpers.sweeper import Reaper, Sweeper
+from app.helpers.tracing import Span, SpanFileExporter, Trace, span
 from app.helpers.events import WatchfolderMessage, InvalidMessageException
 
 APP_NAME = "sipin-sip-creator"
@@ -31,35 +56,281 @@ class EventListener:
         configParser = ConfigParser()
         self.log = logging.get_logger(__name__, config=configParser)
         self.config = configParser.app_cfg
-        self.threads = []
+        # Coalesces the acks of the current channel, per queue
+        self.acks: Dict[str, AckCoalescer] = {}
+        # The messages being processed, across reconnects
+        self.in_flight = InFlightRegistry()
         # Init RabbitMQ client
-        try:
-            self.rabbit_client = rabbit.RabbitClient()
-        except pika.exceptions.AMQPConnectionError as error:
-            self.log.error("Connection to RabbitMQ failed.")
-            raise error
+        self.rabbit_client = self.create_rabbit_client()
+        # The workers shared by the queues
+        self.scheduler = WeightedScheduler(
+            int(self.config.get("workers", 4)), on_error=self.log_job_error
+        )
+        for queue in self.rabbit_client.queues:
+            self.scheduler.add_queue(queue.name, queue.weight, queue.max_concurrency)
         # Init Pusar client
         self.pulsar_client = PulsarClient()
+        # Init outbox, to not lose the events when Pulsar is unavailable
+        self.outbox = None
+        self.outbox_flusher = None
+        outbox_config = self.config.get("outbox") or {}
+        if outbox_config.get("path"):
+            self.outbox = Outbox(outbox_config["path"])
+            self.outbox_flusher = OutboxFlusher(
+                self.outbox,
+                self.pulsar_client.produce_messages,
+                batch_size=int(outbox_config.get("batch_size", 100)),
+                interval=float(outbox_config.get("interval", 1)),
+                max_backoff=float(outbox_config.get("max_backoff", 300)),
+                report=self.log_outbox_flush,
+                on_error=self.log_outbox_error,
+            )
         # Init org API client
         self.org_api_client = OrgApiClient()
+        # Init job journal, to resume interrupted jobs
+        self.journal = None
+        journal_config = self.config.get("journal") or {}
+        if journal_config.get("path"):
+            self.journal = JobJournal(journal_config["path"])
+            pruned = self.journal.prune(float(journal_config.get("max_age", 604800)))
+            self.log.debug(f"Pruned {pruned} entries from the job journal.")
+        # Init disk admission, to defer jobs until there is room for them
+        self.admission = None
+        self.admission_config = self.config.get("admission") or {}
+        if self.admission_config.get("path"):
+            self.admission = DiskAdmission(
+                self.admission_config["path"],
+                int(self.admission_config.get("min_free_bytes", 1073741824)),
+            )
+        # Init reaper, to remove the staging trees after publishing
+        reaper_config = self.config.get("reaper") or {}
+        self.reaper = Reaper(
+            rate=int(reaper_config.get("rate", 104857600)),
+            report=self.log_reclaimed,
+            admission=self.admission,
+        )
+        self.defer_cleanup = bool(reaper_config.get("enabled"))
+        # Init sweeper of the artifacts of crashed jobs
+        self.sweeper = None
+        sweeper_config = self.config.get("sweeper") or {}
+        if sweeper_config.get("enabled"):
+            storage_config = self.config.get("storage") or {}
+            folders = {
+                optional_path(folder)
+                for folder in [
+                    *(sweeper_config.get("folders") or []),
+                    storage_config.get("staging_dir"),
+                    storage_config.get("output_dir"),
+                    storage_config.get("scratch_dir"),
+                ]
+            }
+            self.sweeper = Sweeper(
+                [folder for folder in folders if folder],
+                self.reaper,
+                max_age=float(sweeper_config.get("max_age", 21600)),
+            )
+        # Set when stopping, to stop retuning the prefetch count
+        self.stopping = threading.Event()
+        # Retune the prefetch count to the observed load
+        self.prefetch = None
+        self.prefetch_config = self.config["rabbitmq"].get("adaptive_prefetch") or {}
+        if self.prefetch_config.get("enabled"):
+            self.prefetch = PrefetchController(
+                sum(queue.prefetch_count for queue in self.rabbit_client.queues),
+                workers=self.scheduler.workers,
+                minimum=int(self.prefetch_config.get("min", 1)),
+                maximum=int(self.prefetch_config.get("max", 256)),
+                refill_time=float(self.prefetch_config.get("refill_time", 1)),
+            )
+        # The jobs waiting for disk space and the folders they write to
+        self.waiting_for_space = 0
+        self.waiting_lock = threading.Lock()
+        self.space_folders: List[Path] = []
+        # Init fixity cache, to not hash unchanged essences again
+        self.fixity_cache = None
+        fixity_cache_config = self.config.get("fixity_cache") or {}
+        if fixity_cache_config.get("path"):
+            self.fixity_cache = FixityCache(
+                fixity_cache_config["path"],
+                int(fixity_cache_config.get("max_entries", 100000)),
+            )
+        # Durations per stage and throughput, served to Prometheus
+        self.metrics = JobMetrics()
+        self.metrics_server = None
+        metrics_config = self.config.get("metrics") or {}
+        if metrics_config.get("enabled"):
+            self.metrics_server = MetricsServer(
+                self.metrics.registry,
+                metrics_config.get("host") or "127.0.0.1",
+                int(metrics_config.get("port", 9100)),
+            )
+        # Spans of the jobs, appended to a file or else logged
+        tracing_config = self.config.get("tracing") or {}
+        self.tracing = bool(tracing_config.get("enabled"))
+        self.span_exporter = None
+        if self.tracing and tracing_config.get("path"):
+            self.span_exporter = SpanFileExporter(tracing_config["path"], APP_NAME)
+        # Profile the selected jobs
+        self.profiling = None
+        self.profiling_config = self.config.get("profiling") or {}
+        if self.profiling_config.get("enabled"):
+            self.profiling = ProfilingPolicy(
+                float(self.profiling_config.get("sample_rate") or 0),
+                self.profiling_config.get("cp_ids") or [],
+                bool(self.profiling_config.get("header", True)),
+            )
+
+    def create_rabbit_client(self):
+        try:
+            return rabbit.RabbitClient()
+        except pika.exceptions.AMQPConnectionError as error:
+            self.log.error("Connection to RabbitMQ failed.")
+            raise error
+
+    def log_job_error(self, queue, error):
+        self.log.error(f"SIP creation failed: {error!r}", queue=queue)
+
+    def log_reclaimed(self, path, reclaimed_bytes):
+        self.log.info(
+            f"Removed '{path}'",
+            reclaimed_bytes=reclaimed_bytes,
+            pending_bytes=self.reaper.pending_bytes,
+        )
+
+    def log_outbox_flush(self, sent, failed):
+        if sent:
+            self.log.info(f"Sent {len(sent)} SIP created events from the outbox.")
+        for message, error in failed:
+            self.log.warning(
+                f"SIP created event not sent: {error}",
+                outbox_id=message.id,
+                attempts=message.attempts + 1,
+            )
+
+    def log_outbox_error(self, error):
+        self.log.error(f"Outbox not flushed: {error!r}")
+
+    def event_delivered(self, key, properties, body, job_id, trace, publish, error):
+        """Ack the message once its event is sent, retry it otherwise.
 
-    def ack_message(self, channel, delivery_tag):
-        if channel.is_open:
-            channel.basic_ack(delivery_tag)
+        Called on a thread of the Pulsar client.
+        """
+        publish.finish()
+        if error:
+            publish.set(error=repr(error))
+            self.log.error(f"SIP created event not sent: {error}")
+            self.metrics.failures.inc(reason="publish")
+            self.retry_message(key, properties, body)
         else:
-            # Channel is already closed, so we can't ACK this message
-            # TODO: handle properly
-            pass
+            self.metrics.stage_seconds.observe(publish.duration, stage="pulsar_publish")
+            self.log.info("SIP created event sent.")
+            if self.journal:
+                self.journal.record(job_id, JobStage.ANNOUNCED)
+            self.ack_message(key)
+        trace.add(publish)
+        self.export_spans(trace)
+
+    def ack_message(self, key):
+        """Ack all the deliveries of a message, from any thread."""
+        for delivery in self.in_flight.release(key):
+            self._settle(delivery.acks.ack, delivery.delivery_tag)
+
+    def nack_message(self, key, requeue=False):
+        """Nack all the deliveries of a message, from any thread."""
+        for delivery in self.in_flight.release(key):
+            self._settle(delivery.acks.nack, delivery.delivery_tag, requeue=requeue)
+
+    def retry_message(self, key, properties, body):
+        """Retry a message after a delay, from any thread.
+
+        The message is published to its retry queue and then acked. Without
+        retry queues, it's requeued right away. A message delivered more than
+        once on a queue is retried once, its other deliveries are acked.
+        """
+        retried = set()
+        for delivery in self.in_flight.release(key):
+            if not delivery.queue.retry_topology:
+                self._settle(delivery.acks.nack, delivery.delivery_tag, requeue=True)
+                continue
+            if delivery.queue.name in retried:
+                self._settle(delivery.acks.ack, delivery.delivery_tag)
+                continue
+            retried.add(delivery.queue.name)
+            try:
+                delivery.acks.connection.add_callback_threadsafe(
+                    functools.partial(self._retry, delivery, properties, body)
+                )
+            except pika.exceptions.AMQPError:
+                self.log.warning(
+                    "Connection closed, the message can't be retried.",
+                    delivery_tag=delivery.delivery_tag,
+                )
 
-    def nack_message(self, channel, delivery_tag, requeue=False):
-        if channel.is_open:
-            channel.basic_nack(delivery_tag, requeue=requeue)
+    def _retry(self, delivery, properties, body):
+        channel = delivery.acks.channel
+        if not channel.is_open:
+            # Channel is already closed, the message is redelivered
+            return
+        try:
+            retry_topology = delivery.queue.retry_topology
+            queue = self.rabbit_client.retry(channel, retry_topology, properties, body)
+        except pika.exceptions.AMQPError as error:
+            self.log.warning(f"The message can't be retried: {error!r}")
+            return
+        if queue == retry_topology.parking_queue:
+            self.log.error(f"Message failed too often, parked in '{queue}'.")
         else:
-            # Channel is already closed, so we can't NACK this message
-            # TODO: handle properly
-            pass
+            self.log.info(f"Message will be retried through '{queue}'.")
+        delivery.acks.ack(delivery.delivery_tag)
+
+    def _settle(self, settle, delivery_tag, **kwargs):
+        try:
+            settle(delivery_tag, **kwargs)
+        except pika.exceptions.AMQPError:
+            # The connection is gone, the broker redelivers the message
+            self.log.warning(
+                "Connection closed, the message can't be settled.",
+                delivery_tag=delivery_tag,
+            )
 
-    def do_work(self, channel, delivery_tag, properties, body):
+    def ack_coalescer(self, queue: ConsumerQueue, channel) -> AckCoalescer:
+        """Return the ack coalescer of a channel, on the thread of the connection.
+
+        A reconnect opens new channels, with their own delivery tags.
+        """
+        acks = self.acks.get(queue.name)
+        if acks is None or acks.channel is not channel:
+            acks = self.acks[queue.name] = AckCoalescer(
+                self.rabbit_client.connection,
+                channel,
+                max_delay=float(self.config["rabbitmq"].get("ack_max_delay", 0.05)),
+                max_batch=int(self.config["rabbitmq"].get("ack_max_batch", 100)),
+            )
+        return acks
+
+    def run_job(self, key, queue: ConsumerQueue, properties, body, delivered: float):
+        """Run the worker method in the root span of its trace, profiled if selected.
+
+        The job is unregistered if it crashes.
+        """
+        trace = Trace.from_message(key, properties.headers)
+        waited = queue_wait(delivered, properties.timestamp)
+        self.metrics.stage_seconds.observe(waited, stage="queue_wait")
+        profiler = self.job_profiler(properties.headers, body)
+        try:
+            with profiler or nullcontext(), span(
+                trace, "job", queue=queue.name, queue_wait=waited
+            ):
+                self.do_work(key, properties, body, trace, waited)
+        except Exception:
+            # The message stays unacked, a redelivery may start it again
+            self.in_flight.release(key)
+            raise
+        finally:
+            self.export_spans(trace)
+            self.log_profiles(profiler)
+
+    def do_work(self, key, properties, body, trace: Trace, waited: float = 0.0):
         """Worker method:
 
         - Parse the message.
@@ -67,126 +338,448 @@ class EventListener:
         - Make a bag of the SIP.
         - Send a cloudevent to a Pulsar topic.
         """
+        # Seconds per stage, besides the stages of creating the SIP
+        durations: Dict[str, float] = {}
         try:
             # Parse watchfolder
-            message = WatchfolderMessage(body)
+            with self.stage(trace, durations, "message_parse"):
+                message = WatchfolderMessage(body)
 
             essence_path = message.get_essence_path()
             xml_path = message.get_xml_path()
+            trace.annotate(cp_id=message.flow_id, essence=essence_path.name)
 
             # Check if essence and XML file exist
             if not essence_path.exists() or not xml_path.exists():
                 self.log.error(
                     f"Essence ({essence_path}) and/or sidecar ({xml_path}) not found."
                 )
-                cb_nack = functools.partial(self.nack_message, channel, delivery_tag)
-                self.rabbit_client.connection.add_callback_threadsafe(cb_nack)
+                self.metrics.failures.inc(reason="not_found")
+                self.nack_message(key)
                 return
 
             # filesize of essence. Essence is moved when creating the bag.
             essence_filesize = essence_path.stat().st_size
 
             # Parse sidecar
-            sidecar = Sidecar(xml_path)
+            with self.stage(trace, durations, "sidecar_parse"):
+                sidecar = Sidecar(xml_path)
 
+            sip_bag = self.create_bag(message, sidecar)
+            sip_bag.trace = trace
+            # Reserve the room for the SIP on the filesystems. A job which
+            # doesn't fit is retried later instead of waiting on a worker.
+            reservation_id = None
+            requirements = None
+            if self.admission:
+                reservation_id = str(uuid4())
+                sip_bag.reservation_id = reservation_id
+                requirements = sip_bag.space_requirements()
+                self.space_folders = list(requirements)
+                with self.waiting_lock:
+                    self.waiting_for_space += 1
+                try:
+                    with self.stage(trace, durations, "admission_wait"):
+                        reserved = self.admission.try_reserve(
+                            reservation_id, requirements
+                        )
+                finally:
+                    with self.waiting_lock:
+                        self.waiting_for_space -= 1
+                if not reserved:
+                    self.log.warning(
+                        f"Not enough disk space for SIP of '{essence_path}', "
+                        "retrying later.",
+                        requirements={str(k): v for k, v in requirements.items()},
+                    )
+                    self.metrics.failures.inc(reason="no_space")
+                    self.retry_message(key, properties, body)
+                    return
+            started = time.monotonic()
             try:
-                bag_path, bag = Bag(
-                    message, sidecar, self.org_api_client
-                ).create_sip_bag()
+                with span(trace, "create_sip", essence_size=essence_filesize):
+                    bag_path, bag = sip_bag.create_sip_bag()
             except (ConnectionError, MaxRetryError):
-                cb_nack = functools.partial(
-                    self.nack_message, channel, delivery_tag, requeue=True
-                )
-                self.rabbit_client.connection.add_callback_threadsafe(cb_nack)
+                self.metrics.failures.inc(reason="connection")
+                self.retry_message(key, properties, body)
                 return
+            finally:
+                # Once handed over to the reaper, the reservation is only
+                # released when the staging tree is removed
+                if reservation_id and not sip_bag.cleanup_deferred:
+                    self.admission.release(reservation_id)
+            build_time = time.monotonic() - started
+            self.job_finished(build_time, requirements)
+            if bag is not None:
+                # Not counted again when an earlier attempt already published it
+                self.sip_created(message, sip_bag, essence_filesize)
 
-            # Regex to match essence paths in bag to fetch md5
-            regex = re.compile("data/representations/.*/data/.*")
-
-            for filepath, fixity in bag.entries.items():
-                if regex.match(filepath):
-                    md5_hash_essence_manifest = fixity["md5"]
+            self.log_bag_stats(sip_bag)
 
             # Send Pulsar event
-            attributes = EventAttributes(
-                type=PRODUCER_TOPIC,
-                source=APP_NAME,
-                subject=essence_path.stem,
-                outcome=EventOutcome.SUCCESS,
-            )
-
-            data = {
-                "host": self.config["host"],
-                "path": str(bag_path),
-                "outcome": EventOutcome.SUCCESS.to_str(),
-                "message": f"SIP created: '{bag_path}'",
-                "essence_filename": essence_path.name,
-                "md5_hash_essence_manifest": md5_hash_essence_manifest,
-                "cp_id": message.flow_id,
-                "local_id": sidecar.local_id,
-                "essence_filesize": essence_filesize,
-                "bag_filesize": bag_path.stat().st_size,
-                "md5_hash_essence_sidecar": sidecar.md5,
-            }
-
-            outgoing_event = Event(attributes, data)
+            outgoing_event = self.create_event(
+                message,
+                sidecar,
+                sip_bag,
+                bag_path,
+                essence_filesize,
+                self.event_metrics(sip_bag, bag_path, durations, waited, build_time),
+            )
 
-            self.pulsar_client.produce_event(outgoing_event)
-            self.log.info("SIP created event sent.")
+            if self.outbox:
+                # Committed locally before the ack, the flusher sends it
+                with self.stage(trace, durations, "outbox_commit") as span_:
+                    self.commit_event(
+                        sip_bag.job_id, outgoing_event, self.traceparent(span_)
+                    )
+            elif self.pulsar_client.async_send:
+                # The worker is done, the message is acked once Pulsar
+                # persisted the event
+                publish = trace.child("pulsar_publish")
+                self.pulsar_client.produce_event_async(
+                    outgoing_event,
+                    functools.partial(
+                        self.event_delivered,
+                        key,
+                        properties,
+                        body,
+                        sip_bag.job_id,
+                        trace,
+                        publish,
+                    ),
+                    self.traceparent(publish),
+                )
+                return
+            else:
+                with self.stage(trace, durations, "pulsar_publish") as span_:
+                    self.pulsar_client.produce_event(
+                        outgoing_event, self.traceparent(span_)
+                    )
+                self.log.info("SIP created event sent.")
+                if self.journal:
+                    self.journal.record(sip_bag.job_id, JobStage.ANNOUNCED)
         except InvalidMessageException as e:
             self.log.error(e)
-            cb_nack = functools.partial(self.nack_message, channel, delivery_tag)
-            self.rabbit_client.connection.add_callback_threadsafe(cb_nack)
+            self.metrics.failures.inc(reason="invalid")
+            self.nack_message(key)
             return
+        finally:
+            self.metrics.observe_stages(durations)
         # Send RabbitMQ ack.
-        cb_ack = functools.partial(self.ack_message, channel, delivery_tag)
-        self.rabbit_client.connection.add_callback_threadsafe(cb_ack)
+        self.ack_message(key)
+
+    def job_finished(self, duration: float, requirements: Optional[dict]):
+        """Register the duration and size of a SIP, to retune the prefetch count."""
+        if self.prefetch:
+            self.prefetch.job_finished(duration, sum((requirements or {}).values()))
+
+    @contextmanager
+    def stage(
+        self, trace: Trace, durations: Dict[str, float], stage: str
+    ) -> Iterator[Span]:
+        """Time a stage of a job, also as a span of its trace."""
+        with timed(durations, stage), span(trace, stage) as span_:
+            yield span_
+
+    def traceparent(self, span_: Span) -> Optional[str]:
+        """Return the trace context to send along with the event, if tracing."""
+        return span_.traceparent if self.tracing else None
+
+    def export_spans(self, trace: Trace):
+        """Export the finished spans of a job, to the file or else the log."""
+        spans = trace.pop_finished()
+        if not self.tracing:
+            return
+        if self.span_exporter:
+            self.span_exporter.export(spans)
+        else:
+            for span_ in spans:
+                self.log.debug(f"Span '{span_.name}'", **span_.to_dict())
 
-    def handle_message(self, channel, method, properties, body):
+    def job_profiler(self, headers: Optional[dict], body) -> Optional[JobProfiler]:
+        """Return the profiler of a job, None if it isn't selected."""
+        if not self.profiling:
+            return None
+        try:
+            message = WatchfolderMessage(body)
+        except InvalidMessageException:
+            return None
+        if not self.profiling.selected(headers, message.flow_id):
+            return None
+        interval = self.profiling_config.get("sampling_interval")
+        return JobProfiler(
+            self.profiling_config.get("directory")
+            or Path(tempfile.gettempdir(), f"{APP_NAME}-profiles"),
+            message.get_essence_path().stem,
+            cprofile=bool(self.profiling_config.get("cprofile", True)),
+            trace_malloc=bool(self.profiling_config.get("tracemalloc", True)),
+            sampling_interval=float(interval) if interval else None,
+        )
+
+    def log_profiles(self, profiler: Optional[JobProfiler]):
+        if profiler:
+            self.log.info(
+                "Job profiled", profiles=[str(path) for path in profiler.paths]
+            )
+
+    def sip_created(self, message: WatchfolderMessage, sip_bag: Bag, essence_size: int):
+        """Observe the stages of a created SIP and count it."""
+        self.metrics.observe_stages(sip_bag.stage_durations)
+        self.metrics.sip_created(
+            guess_mimetype(message.get_essence_path()), message.flow_id, essence_size
+        )
+
+    def jobs_in_flight(self) -> int:
+        return len(self.in_flight)
+
+    def next_prefetch_count(self) -> Optional[int]:
+        """Return the retuned prefetch count, None if it doesn't change."""
+        headroom = None
+        if self.admission and self.space_folders:
+            headroom = self.admission.headroom(self.space_folders)
+        prefetch_count = self.prefetch.update(
+            self.jobs_in_flight(), self.waiting_for_space, headroom
+        )
+        if prefetch_count is not None:
+            self.log.info(
+                f"Prefetch count set to {prefetch_count}.",
+                mean_duration=self.prefetch.mean_duration,
+                mean_space=self.prefetch.mean_space,
+                waiting_for_space=self.waiting_for_space,
+                headroom=headroom,
+            )
+            # Shared by the queues by weight, also used when reconnecting
+            queues = self.rabbit_client.queues
+            counts = split_prefetch_count(
+                prefetch_count, [queue.weight for queue in queues]
+            )
+            for queue, count in zip(queues, counts):
+                queue.prefetch_count = count
+        return prefetch_count
+
+    def adjust_prefetch(self):
+        """Retune the prefetch counts of the channels, from any thread."""
+        if self.next_prefetch_count() is None:
+            return
+        try:
+            self.rabbit_client.connection.add_callback_threadsafe(self._set_prefetch)
+        except pika.exceptions.AMQPError:
+            # The new channels of the reconnect use the new prefetch counts
+            pass
+
+    def _set_prefetch(self):
+        for queue in self.rabbit_client.queues:
+            channel = self.rabbit_client.channels.get(queue.name)
+            if channel and channel.is_open:
+                channel.basic_qos(prefetch_count=queue.prefetch_count, global_qos=False)
+
+    def _run_prefetch_controller(self):
+        interval = float(self.prefetch_config.get("interval", 10))
+        while not self.stopping.wait(interval):
+            try:
+                self.adjust_prefetch()
+            except Exception as error:
+                self.log.warning(f"Prefetch count not retuned: {error!r}")
+
+    def create_bag(self, message: WatchfolderMessage, sidecar: Sidecar) -> Bag:
+        return Bag(
+            message,
+            sidecar,
+            self.org_api_client,
+            self.config.get("bag"),
+            self.config.get("storage"),
+            self.journal,
+            self.fixity_cache,
+            self.reaper if self.defer_cleanup else None,
+        )
+
+    def log_bag_stats(self, sip_bag: Bag):
+        for stage, stats in sip_bag.io_stats.items():
+            self.log.debug(f"Essence I/O of stage '{stage}'", **stats.to_dict())
+        if sip_bag.page_cache_monitor:
+            self.log.debug(
+                "Page cache during SIP creation",
+                **sip_bag.page_cache_monitor.to_dict(),
+            )
+
+    def create_event(
+        self,
+        message: WatchfolderMessage,
+        sidecar: Sidecar,
+        sip_bag: Bag,
+        bag_path: Path,
+        essence_filesize: int,
+        metrics: Optional[dict] = None,
+    ) -> Event:
+        """Create the SIP created event of a job.
+
+        Args:
+            metrics: The performance of the job, see `event_metrics`.
+        """
+        essence_path = message.get_essence_path()
+        attributes = EventAttributes(
+            type=PRODUCER_TOPIC,
+            source=APP_NAME,
+            subject=essence_path.stem,
+            outcome=EventOutcome.SUCCESS,
+        )
+
+        data = {
+            "host": self.config["host"],
+            "path": str(bag_path),
+            "outcome": EventOutcome.SUCCESS.to_str(),
+            "message": f"SIP created: '{bag_path}'",
+            "essence_filename": essence_path.name,
+            "md5_hash_essence_manifest": sip_bag.essence_digests["md5"],
+            "cp_id": message.flow_id,
+            "local_id": sidecar.local_id,
+            "essence_filesize": essence_filesize,
+            "bag_filesize": bag_path.stat().st_size,
+            "md5_hash_essence_sidecar": sidecar.md5,
+        }
+        # Additional digests of the essence, e.g. sha256_hash_essence_manifest
+        for algorithm, digest in sip_bag.essence_digests.items():
+            if algorithm in sip_bag.manifest_algorithms:
+                data.setdefault(f"{algorithm}_hash_essence_manifest", digest)
+            else:
+                data[f"{algorithm}_hash_essence"] = digest
+        if metrics:
+            data["metrics"] = metrics
+
+        return Event(attributes, data)
+
+    def event_metrics(
+        self,
+        sip_bag: Bag,
+        bag_path: Path,
+        durations: Dict[str, float],
+        waited: float,
+        build_time: float,
+    ) -> Optional[dict]:
+        """Return the performance of a job for its event, None if disabled.
+
+        Args:
+            sip_bag: The bag of the created SIP.
+            bag_path: The path of the zipped bag.
+            durations: The seconds per stage of the job up to now.
+            waited: The seconds the message waited for the job to start.
+            build_time: The seconds it took to create the SIP.
+        """
+        if not self.config["pulsar"].get("event_metrics"):
+            return None
+        stages = {**durations, **sip_bag.stage_durations}
+        essence_stats = sip_bag.io_stats["essence"]
+        return {
+            "queue_wait": round(waited, 3),
+            "build_time": round(build_time, 3),
+            "stages": {stage: round(seconds, 3) for stage, seconds in stages.items()},
+            # Bytes per second
+            "read_throughput": throughput(
+                essence_stats.bytes,
+                stages.get("essence_copy", 0) + stages.get("hashing", 0),
+            ),
+            "write_throughput": throughput(
+                bag_path.stat().st_size, stages.get("zip", 0)
+            ),
+            "staging_strategy": (
+                sip_bag.staging_strategy.value if sip_bag.staging_strategy else None
+            ),
+            "fixity_cache_hit": sip_bag.fixity_cache_hit,
+        }
+
+    def commit_event(
+        self, job_id: str, event: Event, traceparent: Optional[str] = None
+    ):
+        """Commit an event to the outbox, the flusher sends it."""
+        self.outbox.put(**self.pulsar_client.to_message(event, traceparent))
+        self.outbox_flusher.notify()
+        self.log.info("SIP created event committed to the outbox.")
+        if self.journal:
+            self.journal.record(job_id, JobStage.ANNOUNCED)
+
+    def handle_message(self, queue, channel, method, properties, body):
         """Main method that will handle the incoming messages.
 
         Creating the SIP potentially takes a long time to finish. As this is
         blocking the RabbitMQ I/O loop, this might result in a heartbeat
         timeout and the rabbit broker closing the connection on its end.
 
-        So, we run the SIP creation in a separate thread making sure the
-        RabbitMQ I/O loop is not blocked.
+        So, we run the SIP creation on a worker thread making sure the
+        RabbitMQ I/O loop is not blocked. The workers are shared by the
+        queues, by their weights and concurrency limits.
 
-        That thread will be appended to a list, in order to be able to wait
-        for all threads to finish in the case consuming is stopped.
+        The scheduler waits for all jobs to finish in the case consuming is
+        stopped.
         """
 
-        self.log.debug(f"Incoming message: {body}")
-        # Clean up the list of threads, so it doesn't keep appending
-        for t in self.threads:
-            if not t.is_alive():
-                t.handled = True
-        self.threads = [t for t in self.threads if not t.handled]
+        self.log.debug(f"Incoming message: {body}", queue=queue.name)
+        acks = self.ack_coalescer(queue, channel)
+        acks.delivered(method.delivery_tag)
+        # A redelivery after a reconnect, or a duplicate, of a job which is
+        # still running is settled by that job
+        key = calculate_message_key(body)
+        delivery = Delivery(acks, method.delivery_tag, queue)
+        if not self.in_flight.claim(key, delivery):
+            self.log.info("Message is already being processed, not starting it again.")
+            return
 
-        thread = threading.Thread(
-            target=self.do_work, args=(channel, method.delivery_tag, properties, body)
+        self.scheduler.submit(
+            queue.name,
+            functools.partial(self.run_job, key, queue, properties, body, time.time()),
         )
-        thread.handled = False
-        thread.start()
-        self.threads.append(thread)
 
     def exit_gracefully(self, signum, frame):
         """Stop consuming queue but finish current tasks/messages."""
         self.log.info(
             "Received SIGTERM. Waiting for last SIP creation to finish and then stops."
         )
+        self.stopping.set()
         self.rabbit_client.stop_consuming()
 
+    def start_background(self):
+        """Start the reaper, outbox flusher, sweeper and metrics server threads."""
+        self.reaper.start()
+        if self.metrics_server:
+            self.metrics_server.start()
+        if self.outbox_flusher:
+            self.outbox_flusher.start()
+        # Remove the artifacts of crashed jobs, now and periodically
+        if self.sweeper:
+            self.sweeper.start(
+                float((self.config.get("sweeper") or {}).get("interval", 3600))
+            )
+
+    def flush_events(self):
+        """Send the pending events and close the Pulsar producer."""
+        if self.outbox_flusher:
+            self.outbox_flusher.stop()
+            self.outbox_flusher.flush()
+        self.pulsar_client.close()
+
+    def stop_background(self):
+        if self.sweeper:
+            self.sweeper.stop()
+        self.reaper.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+
     def start(self):
+        self.start_background()
+        self.scheduler.start()
+        if self.prefetch:
+            threading.Thread(target=self._run_prefetch_controller, daemon=True).start()
         # Start listening for incoming messages
         self.log.info("Start to listen for messages...")
         self.rabbit_client.listen(self.handle_message)
-        # Wait for remaining threads to join after consuming.
-        for thread in self.threads:
-            thread.join()
+        # Wait for remaining jobs to finish after consuming.
+        self.scheduler.stop()
+        # Send the pending events, which schedules their (n)acks
+        self.flush_events()
         # Ensure callback (n)acks are send
         self.rabbit_client.connection.process_data_events()
+        for acks in self.acks.values():
+            acks.flush()
 
         # Close the RabbitMQ connection
         self.rabbit_client.connection.close()
-        self.pulsar_client.close()
+        self.stop_background()
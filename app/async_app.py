@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+import aio_pika
+from requests.exceptions import ConnectionError
+from urllib3.exceptions import MaxRetryError
+
+from app.app import EventListener
+from app.helpers.events import WatchfolderMessage, InvalidMessageException
+from app.helpers.inflight import calculate_message_key
+from app.helpers.journal import JobStage
+from app.helpers.metrics import queue_wait
+from app.helpers.profiling import JobProfiler
+from app.helpers.sidecar import Sidecar
+from app.helpers.tracing import Trace, span
+from app.services.org_api import AsyncOrgApiClient
+from app.services.pulsar import PulsarDeliveryError
+from app.services.rabbit import ConsumerQueue
+from app.services.rabbit_async import AsyncRabbitClient
+
+SETTLE_ERRORS = (
+    aio_pika.exceptions.AMQPError,
+    aio_pika.exceptions.ChannelInvalidStateError,
+    aio_pika.exceptions.MessageProcessError,
+)
+
+
+def open_channel(message: aio_pika.IncomingMessage):
+    """Return the channel of a delivery, None once it's closed."""
+    try:
+        channel = message.channel
+    except aio_pika.exceptions.ChannelInvalidStateError:
+        return None
+    return None if channel.is_closed else channel
+
+
+class AsyncEventListener(EventListener):
+    """Event listener running the jobs as tasks on one event loop.
+
+    A job waits for the org API, disk space, Pulsar and the broker without
+    holding a thread, so thousands of them can be in flight. Creating the
+    SIP, which hashes, copies and zips the essence, runs on the workers of
+    the scheduler, shared by the queues by weight. The blocking calls to the
+    local databases and filesystems run on a separate pool, so they don't
+    wait behind the SIPs.
+
+    When stopping, the jobs which are still waiting are cancelled and their
+    messages requeued. The jobs which started creating their SIP are
+    finished.
+    """
+
+    def __init__(self):
+        super().__init__()
+        asyncio_config = self.config.get("asyncio") or {}
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=int(asyncio_config.get("io_workers", 16)),
+            thread_name_prefix="io",
+        )
+        self.async_org_api_client = AsyncOrgApiClient(
+            self.org_api_client, self.io_executor
+        )
+        # The deliveries per message key, across reconnects
+        self.deliveries: Dict[
+            str, List[Tuple[ConsumerQueue, aio_pika.IncomingMessage]]
+        ] = {}
+        self.tasks: Dict[str, "asyncio.Task[None]"] = {}
+        # The jobs past the point of no return, finished when stopping
+        self.committed: Set[str] = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stopped: Optional[asyncio.Event] = None
+
+    def create_rabbit_client(self):
+        # Connects once the event loop runs
+        return AsyncRabbitClient()
+
+    async def run_io(self, func, *args):
+        """Run a blocking call on the I/O pool."""
+        return await self.loop.run_in_executor(
+            self.io_executor, functools.partial(func, *args)
+        )
+
+    async def run_on_worker(self, queue: ConsumerQueue, func):
+        """Run a call on the workers of the scheduler, in the turn of its queue."""
+        future = self.loop.create_future()
+
+        def resolve(result, error):
+            if future.cancelled():
+                return
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def job():
+            try:
+                result = func()
+            except Exception as error:
+                self.loop.call_soon_threadsafe(resolve, None, error)
+            else:
+                self.loop.call_soon_threadsafe(resolve, result, None)
+
+        self.scheduler.submit(queue.name, job)
+        return await future
+
+    async def ack(self, key: str):
+        """Ack all the deliveries of a message."""
+        for _, message in self.deliveries.pop(key, []):
+            await self._settle(message.ack)
+
+    async def nack(self, key: str, requeue: bool = False):
+        """Nack all the deliveries of a message."""
+        for _, message in self.deliveries.pop(key, []):
+            await self._settle(message.nack, requeue=requeue)
+
+    async def retry(self, key: str):
+        """Retry a message after a delay, see `EventListener.retry_message`."""
+        retried = set()
+        for queue, message in self.deliveries.pop(key, []):
+            if not queue.retry_topology:
+                await self._settle(message.nack, requeue=True)
+                continue
+            if queue.name in retried:
+                await self._settle(message.ack)
+                continue
+            retried.add(queue.name)
+            try:
+                routing_key = await self.rabbit_client.retry(queue, message)
+            except SETTLE_ERRORS as error:
+                self.log.warning(f"The message can't be retried: {error!r}")
+                continue
+            if routing_key == queue.retry_topology.parking_queue:
+                self.log.error(f"Message failed too often, parked in '{routing_key}'.")
+            else:
+                self.log.info(f"Message will be retried through '{routing_key}'.")
+            await self._settle(message.ack)
+
+    async def _settle(self, settle, **kwargs):
+        try:
+            await settle(**kwargs)
+        except SETTLE_ERRORS as error:
+            # The channel is gone, the broker redelivers the message
+            self.log.warning(f"The message can't be settled: {error!r}")
+
+    async def run_job(
+        self,
+        key: str,
+        queue: ConsumerQueue,
+        message: aio_pika.IncomingMessage,
+        delivered: float,
+    ):
+        """Run the worker coroutine in the root span of its trace."""
+        trace = Trace.from_message(key, message.headers)
+        published = message.timestamp.timestamp() if message.timestamp else None
+        waited = queue_wait(delivered, published)
+        self.metrics.stage_seconds.observe(waited, stage="queue_wait")
+        profiler = self.job_profiler(message.headers, message.body)
+        try:
+            with span(trace, "job", queue=queue.name, queue_wait=waited):
+                await self.do_work(key, queue, message.body, trace, waited, profiler)
+        finally:
+            self.export_spans(trace)
+            self.log_profiles(profiler)
+
+    async def do_work(
+        self,
+        key: str,
+        queue: ConsumerQueue,
+        body: bytes,
+        trace: Trace,
+        waited: float = 0.0,
+        profiler: Optional[JobProfiler] = None,
+    ):
+        """Worker coroutine, see `EventListener.do_work`.
+
+        The profiler only profiles creating the SIP, on its worker thread, as
+        the event loop runs the other jobs too.
+        """
+        # Seconds per stage, besides the stages of creating the SIP
+        durations: Dict[str, float] = {}
+        try:
+            # Parse watchfolder
+            with self.stage(trace, durations, "message_parse"):
+                message = WatchfolderMessage(body)
+
+            essence_path = message.get_essence_path()
+            xml_path = message.get_xml_path()
+            trace.annotate(cp_id=message.flow_id, essence=essence_path.name)
+
+            # Check if essence and XML file exist
+            if not await self.run_io(
+                lambda: essence_path.exists() and xml_path.exists()
+            ):
+                self.log.error(
+                    f"Essence ({essence_path}) and/or sidecar ({xml_path}) not found."
+                )
+                self.metrics.failures.inc(reason="not_found")
+                await self.nack(key)
+                return
+
+            # filesize of essence. Essence is moved when creating the bag.
+            essence_filesize = (await self.run_io(essence_path.stat)).st_size
+
+            # Parse sidecar
+            with self.stage(trace, durations, "sidecar_parse"):
+                sidecar = await self.run_io(Sidecar, xml_path)
+
+            # Look up the label up front, creating the SIP then uses the cache
+            try:
+                with self.stage(trace, durations, "org_api"):
+                    await self.async_org_api_client.get_label(message.flow_id)
+            except (ConnectionError, MaxRetryError):
+                self.metrics.failures.inc(reason="connection")
+                await self.retry(key)
+                return
+
+            sip_bag = self.create_bag(message, sidecar)
+            sip_bag.trace = trace
+            # Reserve the room for the SIP on the filesystems. A job which
+            # doesn't fit is retried later instead of holding its delivery.
+            reservation_id = None
+            requirements = None
+            if self.admission:
+                reservation_id = str(uuid4())
+                sip_bag.reservation_id = reservation_id
+                requirements = await self.run_io(sip_bag.space_requirements)
+                self.space_folders = list(requirements)
+                self.waiting_for_space += 1
+                try:
+                    with self.stage(trace, durations, "admission_wait"):
+                        reserved = await self.run_io(
+                            self.admission.try_reserve, reservation_id, requirements
+                        )
+                finally:
+                    self.waiting_for_space -= 1
+                if not reserved:
+                    self.log.warning(
+                        f"Not enough disk space for SIP of '{essence_path}', "
+                        "retrying later.",
+                        requirements={str(k): v for k, v in requirements.items()},
+                    )
+                    self.metrics.failures.inc(reason="no_space")
+                    await self.retry(key)
+                    return
+
+            # The thread creating the SIP can't be cancelled
+            self.committed.add(key)
+            started = time.monotonic()
+            try:
+                with span(trace, "create_sip", essence_size=essence_filesize):
+                    build = sip_bag.create_sip_bag
+                    if profiler:
+                        build = functools.partial(profiler.run, build)
+                    bag_path, bag = await self.run_on_worker(queue, build)
+            except (ConnectionError, MaxRetryError):
+                self.metrics.failures.inc(reason="connection")
+                await self.retry(key)
+                return
+            finally:
+                # Once handed over to the reaper, the reservation is only
+                # released when the staging tree is removed
+                if reservation_id and not sip_bag.cleanup_deferred:
+                    await self.run_io(self.admission.release, reservation_id)
+            build_time = time.monotonic() - started
+            self.job_finished(build_time, requirements)
+            if bag is not None:
+                # Not counted again when an earlier attempt already published it
+                self.sip_created(message, sip_bag, essence_filesize)
+
+            self.log_bag_stats(sip_bag)
+
+            # Send Pulsar event
+            metrics = await self.run_io(
+                self.event_metrics, sip_bag, bag_path, durations, waited, build_time
+            )
+            outgoing_event = await self.run_io(
+                self.create_event,
+                message,
+                sidecar,
+                sip_bag,
+                bag_path,
+                essence_filesize,
+                metrics,
+            )
+
+            if self.outbox:
+                # Committed locally before the ack, the flusher sends it
+                with self.stage(trace, durations, "outbox_commit") as span_:
+                    await self.run_io(
+                        self.commit_event,
+                        sip_bag.job_id,
+                        outgoing_event,
+                        self.traceparent(span_),
+                    )
+            else:
+                try:
+                    with self.stage(trace, durations, "pulsar_publish") as span_:
+                        await self.pulsar_client.produce_event_aio(
+                            outgoing_event, self.traceparent(span_)
+                        )
+                except PulsarDeliveryError as error:
+                    self.log.error(f"SIP created event not sent: {error}")
+                    self.metrics.failures.inc(reason="publish")
+                    await self.retry(key)
+                    return
+                self.log.info("SIP created event sent.")
+                if self.journal:
+                    await self.run_io(
+                        self.journal.record, sip_bag.job_id, JobStage.ANNOUNCED
+                    )
+        except InvalidMessageException as e:
+            self.log.error(e)
+            self.metrics.failures.inc(reason="invalid")
+            await self.nack(key)
+            return
+        except asyncio.CancelledError:
+            # Stopped while waiting, another worker picks it up
+            await self.nack(key, requeue=True)
+            raise
+        finally:
+            self.metrics.observe_stages(durations)
+        # Send RabbitMQ ack.
+        await self.ack(key)
+
+    def job_done(self, key: str, task: "asyncio.Task[None]"):
+        """Unregister a job, logging it if it crashed."""
+        self.tasks.pop(key, None)
+        self.committed.discard(key)
+        # The message of a crashed job stays unacked, a redelivery may start
+        # it again
+        self.deliveries.pop(key, None)
+        if not task.cancelled() and task.exception():
+            self.log.error(f"SIP creation failed: {task.exception()!r}")
+
+    def claim(
+        self, key: str, queue: ConsumerQueue, message: aio_pika.IncomingMessage
+    ) -> bool:
+        """Register a delivery of a message, see `InFlightRegistry.claim`.
+
+        A delivery on a closed channel, or on a channel of its queue which
+        was replaced by a reconnect, can't be settled anymore and is dropped.
+
+        Returns:
+            True if a job has to be started, False if it's already running.
+        """
+        deliveries = self.deliveries.get(key)
+        if deliveries is None:
+            self.deliveries[key] = [(queue, message)]
+            return True
+        channel = open_channel(message)
+        deliveries[:] = [
+            (stored_queue, stored)
+            for stored_queue, stored in deliveries
+            if open_channel(stored) is not None
+            and (stored_queue is not queue or open_channel(stored) is channel)
+        ]
+        deliveries.append((queue, message))
+        return False
+
+    async def handle_message(
+        self, queue: ConsumerQueue, message: aio_pika.IncomingMessage
+    ):
+        """Start a job per incoming message, as a task on the event loop."""
+        self.log.debug(f"Incoming message: {message.body}", queue=queue.name)
+        # A redelivery after a reconnect, or a duplicate, of a job which is
+        # still running is settled by that job
+        key = calculate_message_key(message.body)
+        if not self.claim(key, queue, message):
+            self.log.info("Message is already being processed, not starting it again.")
+            return
+
+        task = asyncio.ensure_future(self.run_job(key, queue, message, time.time()))
+        self.tasks[key] = task
+        task.add_done_callback(functools.partial(self.job_done, key))
+
+    def jobs_in_flight(self) -> int:
+        return len(self.tasks)
+
+    async def run_prefetch_controller(self):
+        """Retune the prefetch counts of the channels periodically."""
+        interval = float(self.prefetch_config.get("interval", 10))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await self.run_io(self.next_prefetch_count) is not None:
+                    await self.rabbit_client.set_prefetch_counts()
+            except Exception as error:
+                self.log.warning(f"Prefetch count not retuned: {error!r}")
+
+    async def cancel_jobs(self):
+        """Cancel the waiting jobs and wait for the others to finish."""
+        for key, task in list(self.tasks.items()):
+            if key not in self.committed:
+                task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def exit_gracefully(self, signum, frame):
+        """Stop consuming queue but finish the SIPs which are being created."""
+        self.log.info(
+            "Received SIGTERM. Waiting for last SIP creation to finish and then stops."
+        )
+        self.stopping.set()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if self.stopping.is_set():
+            return
+        self.start_background()
+        self.scheduler.start()
+        await self.rabbit_client.connect()
+        # Start listening for incoming messages
+        self.log.info("Start to listen for messages...")
+        await self.rabbit_client.listen(self.handle_message)
+        prefetch_controller = None
+        if self.prefetch:
+            prefetch_controller = asyncio.ensure_future(self.run_prefetch_controller())
+        await self.stopped.wait()
+
+        if prefetch_controller:
+            prefetch_controller.cancel()
+        await self.rabbit_client.stop_consuming()
+        await self.cancel_jobs()
+        # Send the pending events of the outbox
+        await self.run_io(self.flush_events)
+        await self.rabbit_client.close()
+        await self.run_io(self.scheduler.stop)
+        self.io_executor.shutdown()
+        self.stop_background()
+
+    def start(self):
+        asyncio.run(self.run())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class AckCoalescer:
+    """Coalesces the acks of a RabbitMQ channel into multi-acks.
+
+    The delivery tags of a channel increase in the order of delivery. Once
+    the oldest unsettled messages are all completed, they are acked at once
+    with `multiple=True`. Completed messages behind a message which is still
+    being processed are acked one by one after the maximum delay, so they
+    don't hold up the prefetch window. Nacks are never coalesced.
+
+    The acks are requested from any thread, the channel is only used on the
+    thread of the connection.
+
+    Args:
+        connection: The blocking connection of the channel.
+        channel: The channel of the deliveries.
+        max_delay: The seconds an ack is held at most.
+        max_batch: The amount of completed messages which triggers a flush.
+    """
+
+    def __init__(
+        self, connection, channel, max_delay: float = 0.05, max_batch: int = 100
+    ):
+        self.connection = connection
+        self.channel = channel
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        # The unsettled delivery tags, in order, with the time they completed
+        self._unsettled: "OrderedDict[int, Optional[float]]" = OrderedDict()
+        self._completed = 0
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def delivered(self, delivery_tag: int):
+        """Register a delivery, on the thread of the connection."""
+        with self._lock:
+            self._unsettled[delivery_tag] = None
+
+    def ack(self, delivery_tag: int):
+        """Request the ack of a message, from any thread."""
+        with self._lock:
+            self._unsettled[delivery_tag] = time.monotonic()
+            self._completed += 1
+            flush_now = self._completed >= self.max_batch
+            schedule = not self._scheduled
+            self._scheduled = True
+        if flush_now:
+            self.connection.add_callback_threadsafe(self.flush)
+        elif schedule:
+            self.connection.add_callback_threadsafe(self._schedule_flush)
+
+    def nack(self, delivery_tag: int, requeue: bool = False):
+        """Request the nack of a message, from any thread."""
+        self.connection.add_callback_threadsafe(
+            functools.partial(self._nack, delivery_tag, requeue)
+        )
+
+    def _schedule_flush(self):
+        self.connection.call_later(self.max_delay, self.flush)
+
+    def _nack(self, delivery_tag: int, requeue: bool):
+        # Keep the order of the acks and nacks
+        self.flush()
+        with self._lock:
+            self._unsettled.pop(delivery_tag, None)
+        if self.channel.is_open:
+            self.channel.basic_nack(delivery_tag, requeue=requeue)
+
+    def flush(self):
+        """Send the acks which are due, on the thread of the connection."""
+        last: Optional[int] = None
+        singles: List[int] = []
+        with self._lock:
+            # The completed messages at the front are acked at once
+            while self._unsettled:
+                delivery_tag, completed = next(iter(self._unsettled.items()))
+                if completed is None:
+                    break
+                self._unsettled.popitem(last=False)
+                last = delivery_tag
+            # The completed messages behind a gap only once they're due
+            now = time.monotonic()
+            for delivery_tag, completed in list(self._unsettled.items()):
+                if completed is not None and now - completed >= self.max_delay:
+                    singles.append(delivery_tag)
+                    del self._unsettled[delivery_tag]
+            self._completed = sum(
+                1 for completed in self._unsettled.values() if completed is not None
+            )
+            self._scheduled = reschedule = self._completed > 0
+
+        if self.channel.is_open:
+            if last is not None:
+                self.channel.basic_ack(last, multiple=True)
+            for delivery_tag in singles:
+                self.channel.basic_ack(delivery_tag)
+        else:
+            # Channel is already closed, the messages are redelivered
+            pass
+        if reschedule:
+            self._schedule_flush()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from app.helpers.owner import is_owner_live, owner_info
+from app.helpers.storage import existing_parent
+
+
+def free_bytes(path: Path) -> int:
+    """Return the bytes available to unprivileged users on a filesystem."""
+    stat = os.statvfs(existing_parent(path))
+    return stat.f_bavail * stat.f_frsize
+
+
+class DiskAdmission:
+    """Admits a job only if its filesystems have room for it.
+
+    A job reserves its estimated space per filesystem. The outstanding
+    reservations of the other jobs are subtracted from the free space, as
+    they still have to write. Stored in SQLite so the reservations are shared
+    by the worker threads and processes on the same host. The reservations of
+    crashed processes are dropped.
+
+    The space a running job already wrote is counted twice, as free space
+    and as reservation, which errs on the safe side.
+
+    Args:
+        path: The path of the SQLite database.
+        min_free_bytes: The bytes to always keep free per filesystem.
+    """
+
+    def __init__(self, path: Path, min_free_bytes: int = 1024 * 1024 * 1024):
+        self.path = Path(path)
+        self.min_free_bytes = min_free_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS reservations ("
+                "id TEXT NOT NULL, "
+                "dev INTEGER NOT NULL, "
+                "bytes INTEGER NOT NULL, "
+                "owner TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "PRIMARY KEY (id, dev))"
+            )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run an exclusive write transaction, so checks and writes are atomic."""
+        connection = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def _drop_stale(self, connection: sqlite3.Connection):
+        rows = connection.execute(
+            "SELECT DISTINCT id, owner FROM reservations"
+        ).fetchall()
+        for reservation_id, owner in rows:
+            if not is_owner_live(json.loads(owner)):
+                connection.execute(
+                    "DELETE FROM reservations WHERE id = ?", (reservation_id,)
+                )
+
+    def reserved_bytes(self, device: int) -> int:
+        """Return the outstanding reservations on a filesystem."""
+        with self._transaction() as connection:
+            return self._reserved_bytes(connection, device)
+
+    def headroom(self, folders: Iterable[Path]) -> int:
+        """Return the bytes a new job can still reserve on all the filesystems.
+
+        Args:
+            folders: The folders the jobs write to.
+        """
+        _, per_device = self._per_device({folder: 0 for folder in folders})
+        with self._transaction() as connection:
+            available = [
+                free_bytes(folder)
+                - self._reserved_bytes(connection, device)
+                - self.min_free_bytes
+                for device, folder in per_device.items()
+            ]
+        return max(min(available, default=0), 0)
+
+    @staticmethod
+    def _reserved_bytes(connection: sqlite3.Connection, device: int) -> int:
+        row = connection.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM reservations WHERE dev = ?",
+            (device,),
+        ).fetchone()
+        return row[0]
+
+    @staticmethod
+    def _per_device(
+        requirements: Dict[Path, int],
+    ) -> Tuple[Dict[int, int], Dict[int, Path]]:
+        needed: Dict[int, int] = defaultdict(int)
+        folders: Dict[int, Path] = {}
+        for folder, size in requirements.items():
+            device = existing_parent(folder).stat().st_dev
+            needed[device] += size
+            folders[device] = folder
+        return needed, folders
+
+    def try_reserve(self, reservation_id: str, requirements: Dict[Path, int]) -> bool:
+        """Reserve the space of a job, if it fits.
+
+        Args:
+            reservation_id: The ID of the reservation.
+            requirements: The bytes the job writes, per folder.
+
+        Returns:
+            True if the space is reserved.
+        """
+        needed, folders = self._per_device(requirements)
+        with self._transaction() as connection:
+            self._drop_stale(connection)
+            for device, size in needed.items():
+                available = (
+                    free_bytes(folders[device])
+                    - self._reserved_bytes(connection, device)
+                    - self.min_free_bytes
+                )
+                if size > available:
+                    return False
+            owner = json.dumps(owner_info())
+            for device, size in needed.items():
+                connection.execute(
+                    "INSERT OR REPLACE INTO reservations VALUES (?, ?, ?, ?, ?)",
+                    (reservation_id, device, size, owner, time.time()),
+                )
+        return True
+
+    def reserve(
+        self,
+        reservation_id: str,
+        requirements: Dict[Path, int],
+        timeout: float,
+        interval: float = 30,
+        stop: Optional[threading.Event] = None,
+    ) -> bool:
+        """Wait until the space of a job is reserved.
+
+        Args:
+            reservation_id: The ID of the reservation.
+            requirements: The bytes the job writes, per folder.
+            timeout: The seconds to wait at most.
+            interval: The seconds between two attempts.
+            stop: Stops waiting when set.
+
+        Returns:
+            True if the space is reserved, False if it timed out.
+        """
+        stop = stop or threading.Event()
+        deadline = time.monotonic() + timeout
+        while not self.try_reserve(reservation_id, requirements):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or stop.wait(min(interval, remaining)):
+                return False
+        return True
+
+    def replace(self, reservation_id: str, requirements: Dict[Path, int]):
+        """Replace the space of a reservation, without checking if it fits.
+
+        E.g. by the bytes which are only freed once a staging tree is
+        removed.
+
+        Args:
+            reservation_id: The ID of the reservation.
+            requirements: The reserved bytes, per folder.
+        """
+        needed = self._per_device(requirements)[0]
+        owner = json.dumps(owner_info())
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM reservations WHERE id = ?", (reservation_id,)
+            )
+            for device, size in needed.items():
+                connection.execute(
+                    "INSERT INTO reservations VALUES (?, ?, ?, ?, ?)",
+                    (reservation_id, device, size, owner, time.time()),
+                )
+
+    def release(self, reservation_id: str):
+        """Release the space of a job, once it's written or the job failed."""
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM reservations WHERE id = ?", (reservation_id,)
+            )
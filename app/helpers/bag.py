@@ -2,18 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
+import os
 import shutil
 import zipfile
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 from uuid import uuid4
 
 import bagit
 from lxml import etree
 
+from app.helpers.bagit_utils import make_bag
 from app.helpers.dc import DC
 from app.helpers.events import WatchfolderMessage
+from app.helpers.fixity import (
+    DEFAULT_BLOCK_SIZE,
+    HashEngine,
+    calculate_digests,
+    is_manifest_algorithm,
+)
+from app.helpers.fixity_cache import FixityCache, file_key
+from app.helpers.journal import JobJournal, JobStage, calculate_job_id
+from app.helpers.metrics import timed
 from app.helpers.mets import (
     METSDocSIP,
     Agent,
@@ -25,6 +37,8 @@ from app.helpers.mets import (
     FileGrpUse,
     FileType,
 )
+from app.helpers.page_cache import CacheMode, PageCacheMonitor, WriteBehind
+from app.helpers.pipeline import PipelineStats
 from app.helpers.premis import (
     Fixity,
     Object,
@@ -36,6 +50,23 @@ from app.helpers.premis import (
     Premis,
 )
 from app.helpers.sidecar import Sidecar
+from app.helpers.storage import (
+    StagingStrategy,
+    fsync_tree,
+    optional_path,
+    partial_path,
+    publish,
+    resolve_staging_strategy,
+    same_filesystem,
+)
+from app.helpers.sweeper import (
+    Reaper,
+    marker_path,
+    release_marker,
+    tombstone,
+    write_marker,
+)
+from app.helpers.tracing import Span, Trace, span
 from app.services.org_api import OrgApiClient
 
 EXTENSION_MIMETYPE_MAP = {
@@ -115,11 +146,31 @@ def md5(file: Path) -> str:
     Returns:
         The md5 value in hex value.
     """
-    hash_md5 = hashlib.md5()
-    with open(file, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return calculate_digests(file, ["md5"])["md5"]
+
+
+def calculate_sip_name(message: WatchfolderMessage, namespaced: bool) -> str:
+    """Calculate the name of the root folder and the bag of a SIP.
+
+    In a staging or output folder shared by several watchfolders, two essences
+    with the same name must not end up in the same staging tree or bag. The
+    name is then suffixed with a short hash of the flow and the folder of the
+    essence, which is the same for every attempt of the job.
+
+    Args:
+        message: The watchfolder message.
+        namespaced: If the name has to be unique across the watchfolders.
+
+    Returns:
+        The name of the SIP.
+    """
+    essence_path = message.get_essence_path()
+    if not namespaced:
+        return essence_path.stem
+    namespace = hashlib.sha256(
+        f"{message.flow_id}|{essence_path.parent}".encode("utf-8")
+    ).hexdigest()[:12]
+    return f"{essence_path.stem}_{namespace}"
 
 
 class Bag:
@@ -128,10 +179,91 @@ class Bag:
         watchfolder_message: WatchfolderMessage,
         sidecar: Sidecar,
         org_api_client: OrgApiClient,
+        bag_config: dict = None,
+        storage_config: dict = None,
+        journal: Optional[JobJournal] = None,
+        fixity_cache: Optional[FixityCache] = None,
+        reaper: Optional[Reaper] = None,
     ):
         self.watchfolder_message: WatchfolderMessage = watchfolder_message
         self.sidecar: Sidecar = sidecar
         self.org_api_client: OrgApiClient = org_api_client
+        self.bag_config: dict = bag_config or {}
+        self.storage_config: dict = storage_config or {}
+        self.journal: Optional[JobJournal] = journal
+        # ID of the job in the journal
+        self.job_id: Optional[str] = None
+        self.fixity_cache: Optional[FixityCache] = fixity_cache
+        self.reaper: Optional[Reaper] = reaper
+        # The disk reservation of the job, handed over to the reaper with the
+        # root folder.
+        self.reservation_id: Optional[str] = None
+        # If the root folder is still to be removed by the reaper.
+        self.cleanup_deferred: bool = False
+        # The fixity algorithms, md5 is always calculated.
+        self.algorithms: List[str] = ["md5"] + [
+            algorithm
+            for algorithm in self.bag_config.get("fixity_algorithms", [])
+            if algorithm != "md5"
+        ]
+        self.manifest_algorithms: List[str] = [
+            algorithm
+            for algorithm in self.algorithms
+            if is_manifest_algorithm(algorithm)
+        ]
+        self.hash_engine = HashEngine(
+            block_size=int(self.bag_config.get("hash_block_size", DEFAULT_BLOCK_SIZE)),
+            use_mmap=bool(self.bag_config.get("hash_use_mmap", False)),
+            read_ahead=int(self.bag_config.get("read_ahead_buffers", 0)),
+            cache_mode=CacheMode(self.bag_config.get("cache_mode", "normal")),
+        )
+        # Samples the page cache while creating the SIP, if configured.
+        self.page_cache_monitor: Optional[PageCacheMonitor] = (
+            PageCacheMonitor() if self.bag_config.get("page_cache_monitor") else None
+        )
+        # Statistics of reading the essence, per stage.
+        self.io_stats: Dict[str, PipelineStats] = {
+            "essence": PipelineStats(),
+            "zip": PipelineStats(),
+        }
+        # Digests calculated while building the SIP, keyed by the path
+        # relative to the SIP root folder. Reused when making the bag.
+        self.digests: Dict[str, Dict[str, str]] = {}
+        # Digests of the essence, calculated while staging it.
+        self.essence_digests: Dict[str, str] = {}
+        # How the essence was staged in the SIP.
+        self.staging_strategy: Optional[StagingStrategy] = None
+        # If the essence digests came from the fixity cache.
+        self.fixity_cache_hit: bool = False
+        # Seconds spent per stage of creating the SIP.
+        self.stage_durations: Dict[str, float] = {}
+        # The trace of the job, the stages are added as spans if set.
+        self.trace: Optional[Trace] = None
+
+    @contextmanager
+    def _stage(self, stage: str) -> Iterator[Span]:
+        """Time a stage of creating the SIP, also as a span of the trace."""
+        with timed(self.stage_durations, stage), span(self.trace, stage) as span_:
+            yield span_
+
+    def _checksum(self, sip_root_folder: Path, path_rel: Path) -> str:
+        """Calculate the digests of a file in the SIP and remember them for the bag.
+
+        Args:
+            sip_root_folder: The root folder of the SIP.
+            path_rel: The path of the file relative to the root folder.
+
+        Returns:
+            The md5 value in hex value.
+        """
+        # Only the essence bypasses the page cache
+        digests = self.hash_engine.calculate_digests(
+            Path(sip_root_folder, path_rel),
+            self.manifest_algorithms,
+            cache_mode=CacheMode.NORMAL,
+        )
+        self.digests[path_rel.as_posix()] = digests
+        return digests["md5"]
 
     def _create_package_mets(self, sip_root_folder: Path):
         """Create the package METS.
@@ -199,7 +331,7 @@ class Bag:
         desc_ie_file = File(
             file_type=FileType.FILE,
             label="descriptive",
-            checksum=md5(desc_ie_path),
+            checksum=self._checksum(sip_root_folder, desc_ie_path_rel),
             size=desc_ie_path.stat().st_size,
             mimetype=guess_mimetype(desc_ie_path),
             created=datetime.fromtimestamp(desc_ie_path.stat().st_ctime),
@@ -213,7 +345,7 @@ class Bag:
         pres_ie_file = File(
             file_type=FileType.FILE,
             label="preservation",
-            checksum=md5(pres_ie_path),
+            checksum=self._checksum(sip_root_folder, pres_ie_path_rel),
             size=pres_ie_path.stat().st_size,
             mimetype=guess_mimetype(pres_ie_path),
             created=datetime.fromtimestamp(pres_ie_path.stat().st_ctime),
@@ -243,7 +375,7 @@ class Bag:
         reps_file = File(
             file_type=FileType.FILE,
             label="representation_1",
-            checksum=md5(reps_path),
+            checksum=self._checksum(sip_root_folder, reps_path_rel),
             size=reps_path.stat().st_size,
             mimetype=guess_mimetype(reps_path),
             created=datetime.fromtimestamp(reps_path.stat().st_ctime),
@@ -321,7 +453,7 @@ class Bag:
             mimetype=guess_mimetype(pres_path),
             path=str(pres_path_rel),
             size=pres_path.stat().st_size,
-            checksum=md5(pres_path),
+            checksum=self._checksum(sip_root_folder, pres_path_rel),
             created=datetime.fromtimestamp(pres_path.stat().st_ctime),
         )
 
@@ -355,7 +487,7 @@ class Bag:
 
         return doc.to_element()
 
-    def create_sip_bag(self) -> Tuple[Path, bagit.Bag]:
+    def create_sip_bag(self) -> Tuple[Path, Optional[bagit.Bag]]:
         """Create the SIP in the bag format.
 
         - Create the minimal SIP
@@ -378,25 +510,163 @@ class Bag:
                     preservation/
                         premis.xml
 
+        If a journal is configured, every completed stage is recorded and a
+        redelivered message resumes from the last durable stage. An already
+        published bag is not created again.
+
         Args:
             watchfolder_message: The parse watchfolder message.
         Returns:
-            The path of the zipped bag and the bag information.
+            The path of the zipped bag and the bag information. The bag
+            information is None if the bag was already published.
+        """
+        if self.page_cache_monitor:
+            with self.page_cache_monitor:
+                return self._create_sip_bag()
+        return self._create_sip_bag()
+
+    def _paths(self) -> Tuple[Path, Path]:
+        """Return the root folder of the SIP and the path of the zipped bag.
+
+        These are in the staging and output folder if configured, next to
+        the essence otherwise. The shared folders are namespaced per
+        watchfolder, see `calculate_sip_name`.
+        """
+        essence_path: Path = self.watchfolder_message.get_essence_path()
+        staging_dir = optional_path(self.storage_config.get("staging_dir"))
+        output_dir = optional_path(self.storage_config.get("output_dir"))
+        name = calculate_sip_name(
+            self.watchfolder_message, bool(staging_dir or output_dir)
+        )
+        root_folder = Path(staging_dir or essence_path.parent, name)
+        bag_path = Path(output_dir or essence_path.parent, f"{name}.bag.zip")
+        return root_folder, bag_path
+
+    def space_requirements(self) -> Dict[Path, int]:
+        """Estimate the bytes the SIP creation writes, per folder.
+
+        - The staging copy of the essence, nothing when it's hardlinked.
+        - The zip, stored and thus about the size of the essence.
+        - The copy of the zip to the output folder, when the scratch folder is
+          on another filesystem.
+
+        The metadata is negligible next to the essence.
+
+        Returns:
+            The bytes per folder.
         """
+        essence_path: Path = self.watchfolder_message.get_essence_path()
+        essence_size = essence_path.stat().st_size
+        root_folder, bag_path = self._paths()
+        scratch_folder = partial_path(
+            bag_path, optional_path(self.storage_config.get("scratch_dir"))
+        ).parent
+
+        requirements: Dict[Path, int] = {root_folder.parent: 0}
+        strategy = resolve_staging_strategy(
+            StagingStrategy(self.storage_config.get("staging_strategy", "auto")),
+            essence_path,
+            root_folder,
+        )
+        if strategy is StagingStrategy.COPY:
+            requirements[root_folder.parent] += essence_size
+        requirements[scratch_folder] = (
+            requirements.get(scratch_folder, 0) + essence_size
+        )
+        if not same_filesystem(scratch_folder, bag_path.parent):
+            requirements[bag_path.parent] = (
+                requirements.get(bag_path.parent, 0) + essence_size
+            )
+        return requirements
+
+    def _create_sip_bag(self) -> Tuple[Path, Optional[bagit.Bag]]:
         essence_path: Path = self.watchfolder_message.get_essence_path()
         xml_path = self.watchfolder_message.get_xml_path()
         if not essence_path.exists() or not xml_path.exists():
             # TODO: raise error
             return
 
+        root_folder, bag_path = self._paths()
+
+        # Resume from the last durable stage of an earlier attempt
+        stage = None
+        if self.journal:
+            self.job_id = calculate_job_id(self.watchfolder_message)
+            stage = self._resume(root_folder, bag_path)
+
+        # Mark the staging tree as owned by this job for the sweeper. The
+        # marker is removed with the staging tree, and kept if the job fails.
+        marker = write_marker(root_folder, self.job_id)
+        try:
+            return self._build_sip_bag(root_folder, bag_path, stage)
+        finally:
+            release_marker(marker, remove=False)
+
+    def _build_sip_bag(
+        self, root_folder: Path, bag_path: Path, stage: Optional[JobStage]
+    ) -> Tuple[Path, Optional[bagit.Bag]]:
+        """Build and publish the bag, starting after the given stage.
+
+        Args:
+            root_folder: The root folder of the SIP.
+            bag_path: The path of the zipped bag.
+            stage: The last completed stage or None to start over.
+        Returns:
+            The path of the zipped bag and the bag information.
+        """
+        if stage in (JobStage.PUBLISHED, JobStage.ANNOUNCED):
+            # The bag is already published, it only needs to be announced
+            self._remove_root(root_folder, ignore_errors=True, final=True)
+            return bag_path, None
+
+        if stage is None:
+            if self.journal and root_folder.exists():
+                # Leftover of an earlier attempt in an unknown state
+                self._remove_root(root_folder)
+            self._stage_sip(root_folder)
+            self._record(JobStage.STAGED, root_folder)
+
+        # Make bag
+        if stage is JobStage.BAGGED:
+            bag = bagit.Bag(str(root_folder))
+        else:
+            with self._stage("bagit"):
+                bag = make_bag(
+                    root_folder,
+                    algorithms=self.manifest_algorithms,
+                    workers=int(self.bag_config.get("checksum_workers", 1)),
+                    known_digests=self.digests,
+                    engine=self.hash_engine,
+                )
+            self._record(JobStage.BAGGED, root_folder)
+
+        # Zip bag
+        with self._stage("zip") as span_:
+            self._zip_bag(root_folder, bag_path)
+            span_.set(bytes=self.io_stats["zip"].bytes)
+        self._record(JobStage.PUBLISHED, root_folder, bag_path)
+
+        # Remove root folder
+        with self._stage("cleanup"):
+            self._remove_root(root_folder, final=True)
+
+        return bag_path, bag
+
+    def _stage_sip(self, root_folder: Path):
+        """Create the minimal SIP in the root folder.
+
+        Args:
+            root_folder: The root folder of the SIP.
+        """
+        essence_path: Path = self.watchfolder_message.get_essence_path()
+        xml_path = self.watchfolder_message.get_xml_path()
+
         # Relationships uuids
         ie_uuid = str(uuid4())
         rep_uuid = str(uuid4())
         file_uuid = str(uuid4())
 
-        # Root folder for bag
-        root_folder = Path(essence_path.parent, essence_path.stem)
-        root_folder.mkdir(exist_ok=True)
+        root_folder.mkdir(exist_ok=True, parents=True)
 
         # /metadata
         metadata_folder = root_folder.joinpath("metadata")
@@ -405,14 +675,15 @@ class Bag:
         metadata_desc_folder = metadata_folder.joinpath("descriptive")
         metadata_desc_folder.mkdir(exist_ok=True)
         # Create descriptive metadata and store it
-        dc_terms = DC.transform(
-            xml_path,
-            ie_uuid=etree.XSLT.strparam(ie_uuid),
-        )
-        etree.ElementTree(dc_terms).write(
-            str(metadata_desc_folder.joinpath("dc.xml")),
-            pretty_print=True,
-        )
+        with self._stage("dc_transform"):
+            dc_terms = DC.transform(
+                xml_path,
+                ie_uuid=etree.XSLT.strparam(ie_uuid),
+            )
+            etree.ElementTree(dc_terms).write(
+                str(metadata_desc_folder.joinpath("dc.xml")),
+                pretty_print=True,
+            )
 
         # /metadata/preservation/
         metadata_pres_folder = metadata_folder.joinpath("preservation")
@@ -444,10 +715,11 @@ class Bag:
 
         premis_element.add_object(premis_object_element_ie)
 
-        etree.ElementTree(premis_element.to_element()).write(
-            str(metadata_pres_folder.joinpath("premis.xml")),
-            pretty_print=True,
-        )
+        with self._stage("premis_mets"):
+            etree.ElementTree(premis_element.to_element()).write(
+                str(metadata_pres_folder.joinpath("premis.xml")),
+                pretty_print=True,
+            )
 
         # /representations/representation_1/
         representations_folder = root_folder.joinpath(
@@ -458,10 +730,66 @@ class Bag:
         # /representations/representation_1/data/
         representations_data_folder = representations_folder.joinpath("data")
         representations_data_folder.mkdir(exist_ok=True)
-        # Copy essence
-        shutil.copy(
-            essence_path, representations_data_folder.joinpath(essence_path.name)
+        # Stage essence and calculate its digests.
+        # A hardlink is only possible on the same filesystem, otherwise the
+        # essence is copied and hashed in the same read. Unchanged essences
+        # aren't hashed again if their digests are cached.
+        staged_essence_path = self._staged_essence_path(root_folder)
+        self.staging_strategy = resolve_staging_strategy(
+            StagingStrategy(self.storage_config.get("staging_strategy", "auto")),
+            essence_path,
+            representations_data_folder,
         )
+        essence_key = file_key(essence_path)
+        cached_digests = None
+        if self.fixity_cache:
+            cached_digests = self.fixity_cache.get(essence_path, self.algorithms)
+        self.fixity_cache_hit = cached_digests is not None
+
+        essence_size = essence_path.stat().st_size
+        if self.staging_strategy is StagingStrategy.HARDLINK:
+            with self._stage("essence_copy") as span_:
+                # A leftover hardlink of an earlier attempt is replaced
+                linked_key = file_key(essence_path)
+                staged_essence_path.unlink(missing_ok=True)
+                os.link(essence_path, staged_essence_path)
+                if self.fixity_cache:
+                    self.fixity_cache.relinked(essence_path, linked_key)
+                span_.set(strategy=self.staging_strategy.value, bytes=0)
+            essence_key = file_key(essence_path)
+            if cached_digests is None:
+                with self._stage("hashing") as span_:
+                    span_.set(bytes=essence_size)
+                    self.essence_digests = self.hash_engine.calculate_digests(
+                        staged_essence_path,
+                        self.algorithms,
+                        stats=self.io_stats["essence"],
+                    )
+        elif cached_digests is None:
+            # Copied and hashed in the same read, timed as the copy
+            with self._stage("essence_copy") as span_:
+                span_.set(strategy=self.staging_strategy.value, bytes=essence_size)
+                self.essence_digests = self.hash_engine.copy_with_digests(
+                    essence_path,
+                    staged_essence_path,
+                    self.algorithms,
+                    stats=self.io_stats["essence"],
+                )
+        else:
+            # Nothing to hash, so let the kernel copy it
+            with self._stage("essence_copy") as span_:
+                span_.set(strategy=self.staging_strategy.value, bytes=essence_size)
+                shutil.copyfile(essence_path, staged_essence_path)
+                shutil.copymode(essence_path, staged_essence_path)
+
+        if cached_digests is None:
+            if self.fixity_cache:
+                self.fixity_cache.put(essence_path, self.essence_digests, essence_key)
+        else:
+            self.essence_digests = cached_digests
+        self.digests[
+            staged_essence_path.relative_to(root_folder).as_posix()
+        ] = self.essence_digests
 
         # representations/representation_1/metadata/
         representations_metadata_folder = representations_folder.joinpath("metadata")
@@ -516,7 +844,10 @@ class Bag:
             ObjectType.FILE,
             [ObjectIdentifier("uuid", file_uuid)],
             original_name=original_name,
-            fixity=Fixity(self.sidecar.md5),
+            fixity=Fixity(
+                self.sidecar.md5,
+                {a: d for a, d in self.essence_digests.items() if a != "md5"},
+            ),
         )
 
         # Premis object file relationship
@@ -527,33 +858,194 @@ class Bag:
 
         premis_element.add_object(premis_object_element_file)
 
-        etree.ElementTree(premis_element.to_element()).write(
-            str(representations_metadata_pres_folder.joinpath("premis.xml")),
-            pretty_print=True,
-        )
+        with self._stage("premis_mets"):
+            etree.ElementTree(premis_element.to_element()).write(
+                str(representations_metadata_pres_folder.joinpath("premis.xml")),
+                pretty_print=True,
+            )
 
-        # Create and write representation mets.xml
-        representation_mets_element = self._create_representation_mets(root_folder)
-        etree.ElementTree(representation_mets_element).write(
-            str(representations_folder.joinpath("mets.xml")), pretty_print=True
-        )
+            # Create and write representation mets.xml
+            representation_mets_element = self._create_representation_mets(root_folder)
+            etree.ElementTree(representation_mets_element).write(
+                str(representations_folder.joinpath("mets.xml")), pretty_print=True
+            )
+
+        # Look up the label of the CP, the package METS uses the cached label
+        with self._stage("org_api"):
+            self.org_api_client.get_label(self.watchfolder_message.flow_id)
 
         # Create and write package mets.xml
-        package_mets_element = self._create_package_mets(root_folder)
-        etree.ElementTree(package_mets_element).write(
-            str(root_folder.joinpath("mets.xml")), pretty_print=True
+        with self._stage("premis_mets"):
+            package_mets_element = self._create_package_mets(root_folder)
+            etree.ElementTree(package_mets_element).write(
+                str(root_folder.joinpath("mets.xml")), pretty_print=True
+            )
+
+    def _staged_essence_path(self, root_folder: Path) -> Path:
+        essence_path = self.watchfolder_message.get_essence_path()
+        return root_folder.joinpath(
+            "representations", "representation_1", "data", essence_path.name
         )
 
-        # Make bag
-        bag = bagit.make_bag(root_folder, checksums=["md5"])
+    def _unlink_staged_essence(self, root_folder: Path):
+        """Remove the hardlink of the essence from the root folder.
 
-        # Zip bag
-        bag_path = root_folder.with_suffix(".bag.zip")
-        with zipfile.ZipFile(bag_path, mode="w") as archive:
-            for file_path in root_folder.rglob("*"):
-                archive.write(file_path, arcname=file_path.relative_to(root_folder))
+        Removing it changes the ctime of the essence, the entry in the fixity
+        cache is kept valid. This is done right here, not by the reaper, so
+        the essence can't change between the two stats. A copy of the
+        essence is left to the removal of the root folder.
 
-        # Remove root folder
-        shutil.rmtree(root_folder)
+        Args:
+            root_folder: The root folder of the SIP.
+        """
+        essence_path = self.watchfolder_message.get_essence_path()
+        staged_essence_path = self._staged_essence_path(root_folder)
+        try:
+            if not os.path.samefile(essence_path, staged_essence_path):
+                return
+            essence_key = file_key(essence_path)
+            staged_essence_path.unlink()
+        except FileNotFoundError:
+            return
+        if self.fixity_cache:
+            self.fixity_cache.relinked(essence_path, essence_key)
+
+    def _remove_root(
+        self, root_folder: Path, ignore_errors: bool = False, final: bool = False
+    ):
+        """Remove the root folder of the SIP.
 
-        return Path(bag_path), bag
+        The hardlink of the essence is removed first, see
+        `_unlink_staged_essence`.
+
+        The final removal, once the bag is published, is deferred to the
+        reaper if configured. The root folder is renamed to a tombstone first,
+        so a redelivery of the message can reuse it while the reaper removes
+        the tombstone. The marker of the root folder is only removed with the
+        root folder.
+
+        Args:
+            root_folder: The root folder of the SIP.
+            ignore_errors: Ignore the errors, e.g. when it doesn't exist.
+            final: Remove the root folder for good, with its marker.
+        """
+        try:
+            self._unlink_staged_essence(root_folder)
+        except OSError:
+            if not ignore_errors:
+                raise
+
+        if final and self.reaper and root_folder.exists():
+            try:
+                deleting = tombstone(root_folder)
+            except OSError:
+                deleting = None
+            if deleting:
+                # The tombstone is swept without a marker, and the marker of
+                # a job reusing the root folder is left alone
+                marker_path(root_folder).unlink(missing_ok=True)
+                self.reaper.enqueue(deleting, reservation_id=self.reservation_id)
+                self.cleanup_deferred = True
+                return
+        shutil.rmtree(root_folder, ignore_errors=ignore_errors)
+        if final:
+            marker_path(root_folder).unlink(missing_ok=True)
+
+    def _zip_bag(self, root_folder: Path, bag_path: Path):
+        """Zip the bag under a partial name and only publish it once complete.
+
+        Args:
+            root_folder: The root folder of the bag.
+            bag_path: The final path of the zipped bag.
+        """
+        bag_path.parent.mkdir(exist_ok=True, parents=True)
+        bag_partial_path = partial_path(
+            bag_path, optional_path(self.storage_config.get("scratch_dir"))
+        )
+        essence_name = self.watchfolder_message.get_essence_path().name
+        try:
+            with zipfile.ZipFile(bag_partial_path, mode="w") as archive:
+                write_behind = WriteBehind(archive.fp)
+                for file_path in root_folder.rglob("*"):
+                    self.hash_engine.write_to_zip(
+                        archive,
+                        file_path,
+                        str(file_path.relative_to(root_folder)),
+                        stats=self.io_stats["zip"],
+                        write_behind=write_behind,
+                        # Only the essence bypasses the page cache
+                        cache_mode=(
+                            None if file_path.name == essence_name else CacheMode.NORMAL
+                        ),
+                    )
+                write_behind.flush()
+            publish(
+                bag_partial_path,
+                bag_path,
+                sync_file=bool(self.storage_config.get("fsync_file", True)),
+                sync_dir=bool(self.storage_config.get("fsync_dir", True)),
+            )
+        except Exception:
+            bag_partial_path.unlink(missing_ok=True)
+            raise
+
+    def _record(self, stage: JobStage, root_folder: Path, bag_path: Path = None):
+        """Record a completed stage in the journal, if configured.
+
+        The staged files are flushed first, so the stage survives a crash of
+        the node.
+
+        Args:
+            stage: The completed stage.
+            root_folder: The root folder of the SIP.
+            bag_path: The path of the zipped bag, once published.
+        """
+        if not self.journal:
+            return
+        if stage in (JobStage.STAGED, JobStage.BAGGED) and self.storage_config.get(
+            "fsync_file", True
+        ):
+            fsync_tree(root_folder)
+        state = {
+            "digests": self.digests,
+            "essence_digests": self.essence_digests,
+            "staging_strategy": self.staging_strategy.value,
+        }
+        if bag_path:
+            state["bag_path"] = str(bag_path)
+        self.journal.record(self.job_id, stage, state)
+
+    def _resume(self, root_folder: Path, bag_path: Path) -> Optional[JobStage]:
+        """Restore the state of an earlier attempt from the journal.
+
+        A stage is only resumed if its artifacts are still present.
+
+        Args:
+            root_folder: The root folder of the SIP.
+            bag_path: The path of the zipped bag.
+
+        Returns:
+            The stage to resume from or None to start over.
+        """
+        record = self.journal.get(self.job_id)
+        if record is None:
+            return None
+
+        digests = record.state.get("digests", {})
+        if record.stage in (JobStage.PUBLISHED, JobStage.ANNOUNCED):
+            resumable = bag_path.exists()
+        elif record.stage is JobStage.BAGGED:
+            resumable = root_folder.joinpath("bagit.txt").exists() and all(
+                root_folder.joinpath("data", path).exists() for path in digests
+            )
+        else:
+            resumable = not root_folder.joinpath("bagit.txt").exists() and all(
+                root_folder.joinpath(path).exists() for path in digests
+            )
+        if not resumable:
+            return None
+
+        self.digests = digests
+        self.essence_digests = record.state.get("essence_digests", {})
+        self.staging_strategy = StagingStrategy(record.state["staging_strategy"])
+        return record.stage
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import bagit
+
+from app.helpers.fixity import DEFAULT_ENGINE, HashEngine
+
+BAGIT_TXT = "BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"
+
+
+def _encode_filename(filename: str) -> str:
+    """Encode the line breaks of a filename as done in the bagit manifests."""
+    return filename.replace("\r", "%0D").replace("\n", "%0A")
+
+
+def _write_tag_file(path: Path, contents: str) -> bytes:
+    """Write a tag file and return the written bytes.
+
+    The bytes are returned so the tag manifests can be calculated without
+    reading the file again.
+    """
+    data = contents.encode("utf-8")
+    path.write_bytes(data)
+    return data
+
+
+def _tag_file_contents(bag_info: Dict[str, str]) -> str:
+    """Format the bag-info.txt contents, one sorted `key: value` line per tag."""
+    lines = []
+    for key in sorted(bag_info.keys()):
+        value = str(bag_info[key]).replace("\r", "").replace("\n", "")
+        lines.append(f"{key}: {value}\n")
+    return "".join(lines)
+
+
+def _payload_files(data_folder: Path) -> List[Path]:
+    """Return all the files in the payload folder in a deterministic order."""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(data_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            files.append(Path(dirpath, filename))
+    return files
+
+
+def make_bag(
+    bag_dir: Path,
+    algorithms: List[str] = ["md5"],
+    workers: int = 1,
+    known_digests: Optional[Dict[str, Dict[str, str]]] = None,
+    bag_info: Optional[Dict[str, str]] = None,
+    engine: HashEngine = DEFAULT_ENGINE,
+) -> bagit.Bag:
+    """Convert a given directory into a bag.
+
+    Produces the same bag as `bagit.make_bag` but:
+    - Hashes the payload files concurrently on a pool of threads. Hashlib
+      releases the GIL while hashing, so threads suffice and we don't fork
+      a process with open RabbitMQ/Pulsar connections.
+    - Reuses the digests already known from earlier stages instead of
+      reading those files again.
+    - Calculates the tag manifests from the tag file contents in memory.
+    - Doesn't change the working directory, so it is safe to be called by
+      multiple worker threads at the same time.
+
+    Args:
+        bag_dir: The directory to convert.
+        algorithms: The checksum algorithms of the manifests.
+        workers: The amount of threads hashing the payload files.
+        known_digests: The digests which are already known, keyed by the path
+            relative to the bag directory (before bagging) and the algorithm.
+        bag_info: Extra tags for the bag-info.txt.
+        engine: The engine reading and hashing the payload files.
+
+    Returns:
+        The bag.
+    """
+    bag_dir = Path(bag_dir).absolute()
+    known_digests = known_digests or {}
+
+    # Move the contents into the payload folder
+    temp_data = Path(tempfile.mkdtemp(dir=bag_dir))
+    for child in bag_dir.iterdir():
+        if child != temp_data:
+            child.rename(temp_data.joinpath(child.name))
+    data_folder = bag_dir.joinpath("data")
+    temp_data.rename(data_folder)
+    data_folder.chmod(bag_dir.stat().st_mode)
+
+    def payload_entry(path: Path) -> Tuple[str, Dict[str, str], int]:
+        relative_path = path.relative_to(data_folder).as_posix()
+        digests = known_digests.get(relative_path, {})
+        missing = [a for a in algorithms if a not in digests]
+        if missing:
+            digests = {**digests, **engine.calculate_digests(path, missing)}
+        return f"data/{relative_path}", digests, path.stat().st_size
+
+    payload = _payload_files(data_folder)
+    if workers > 1 and len(payload) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = list(executor.map(payload_entry, payload))
+    else:
+        entries = [payload_entry(path) for path in payload]
+
+    # Tag files, keep the written bytes for the tag manifests
+    tag_files: Dict[str, bytes] = {}
+    for algorithm in algorithms:
+        manifest = "".join(
+            f"{digests[algorithm]}  {_encode_filename(filename)}\n"
+            for filename, digests, _ in entries
+        )
+        manifest_name = f"manifest-{algorithm}.txt"
+        tag_files[manifest_name] = _write_tag_file(
+            bag_dir.joinpath(manifest_name), manifest
+        )
+
+    tag_files["bagit.txt"] = _write_tag_file(bag_dir.joinpath("bagit.txt"), BAGIT_TXT)
+
+    bag_info = dict(bag_info or {})
+    bag_info.setdefault("Bagging-Date", date.strftime(date.today(), "%Y-%m-%d"))
+    bag_info.setdefault(
+        "Bag-Software-Agent", f"bagit.py v{bagit.VERSION} <{bagit.PROJECT_URL}>"
+    )
+    total_bytes = sum(size for _, _, size in entries)
+    bag_info["Payload-Oxum"] = f"{total_bytes}.{len(entries)}"
+    tag_files["bag-info.txt"] = _write_tag_file(
+        bag_dir.joinpath("bag-info.txt"), _tag_file_contents(bag_info)
+    )
+
+    for algorithm in algorithms:
+        tag_manifest = "".join(
+            f"{hashlib.new(algorithm, data).hexdigest()} {name}\n"
+            for name, data in tag_files.items()
+        )
+        _write_tag_file(bag_dir.joinpath(f"tagmanifest-{algorithm}.txt"), tag_manifest)
+
+    return bagit.Bag(str(bag_dir))
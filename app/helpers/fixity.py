@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextlib
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+import time
+import zipfile
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional
+
+from app.helpers.page_cache import (
+    ALIGNMENT,
+    CacheMode,
+    WriteBehind,
+    align,
+    allocate_aligned,
+    clear_direct,
+    drop_pages,
+    open_direct,
+)
+from app.helpers.pipeline import PipelineStats, ReadPipeline
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+MIN_BLOCK_SIZE = 1024 * 1024
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Fast non-cryptographic hashes, only meant for deduplication.
+NON_CRYPTOGRAPHIC_ALGORITHMS = ("crc32", "xxh32", "xxh64", "xxh3_64", "xxh3_128")
+
+
+class CRC32:
+    """Hasher with the hashlib interface calculating a CRC-32 checksum."""
+
+    name = "crc32"
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f"{self.value:08x}"
+
+
+def new_hasher(algorithm: str):
+    """Create a hasher for the given algorithm.
+
+    Supports the hashlib algorithms, "crc32" and the xxhash algorithms if the
+    optional xxhash package is installed.
+
+    Args:
+        algorithm: The name of the algorithm.
+
+    Returns:
+        A hasher with an `update` and a `hexdigest` method.
+
+    Raises:
+        ValueError: When the algorithm is not supported.
+    """
+    if algorithm == "crc32":
+        return CRC32()
+    if algorithm.startswith("xxh"):
+        if xxhash is None:
+            raise ValueError(f"Algorithm '{algorithm}' requires the xxhash package")
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def is_manifest_algorithm(algorithm: str) -> bool:
+    """Return if the algorithm can be used in a bag manifest.
+
+    The non-cryptographic hashes are not supported by bagit.
+    """
+    return algorithm not in NON_CRYPTOGRAPHIC_ALGORITHMS
+
+
+def write_all(f: BinaryIO, block: memoryview):
+    """Write the whole block to an unbuffered file, which may write partially."""
+    while block:
+        written = f.write(block)
+        block = block[written:]
+
+
+class HashEngine:
+    """Reads files in large blocks and passes them to the hashers.
+
+    Every thread reads into its own preallocated buffer, or ring of buffers
+    when reading ahead, which is reused for all the blocks of all the files,
+    instead of allocating a new bytes object per block.
+
+    Args:
+        block_size: The size of the blocks, clamped between 1 and 16 MiB.
+        use_mmap: Memory map the file instead of reading it into the buffer.
+        fadvise: Advise the kernel that the file will be read sequentially.
+        read_ahead: The amount of buffers a reader thread fills ahead of the
+            consumers, see `ReadPipeline`. Disabled when lower than 2. Only
+            files larger than two blocks are read ahead.
+        cache_mode: How the page cache is used for the essence, see
+            `CacheMode`. The calls for other files, e.g. the metadata, can
+            use the page cache normally instead.
+    """
+
+    def __init__(
+        self,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        use_mmap: bool = False,
+        fadvise: bool = True,
+        read_ahead: int = 0,
+        cache_mode: CacheMode = CacheMode.NORMAL,
+    ):
+        self.block_size = align(
+            min(max(int(block_size), MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+        )
+        self.use_mmap = use_mmap
+        self.fadvise = fadvise and hasattr(os, "posix_fadvise")
+        self.read_ahead = int(read_ahead)
+        self.cache_mode = cache_mode
+        self._local = threading.local()
+
+    def _allocate(self, size: int) -> memoryview:
+        if self.cache_mode is CacheMode.DIRECT:
+            return allocate_aligned(size)
+        return memoryview(bytearray(size))
+
+    def _buffer(self) -> memoryview:
+        """Return the buffer of the current thread."""
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._allocate(self.block_size)
+            self._local.buffer = buffer
+        return buffer
+
+    def _cache_mode(self, cache_mode: Optional[CacheMode]) -> CacheMode:
+        return self.cache_mode if cache_mode is None else cache_mode
+
+    def _pipeline(self) -> ReadPipeline:
+        """Return the read pipeline of the current thread, with its buffers."""
+        pipeline = getattr(self._local, "pipeline", None)
+        if pipeline is None:
+            pipeline = ReadPipeline(self.read_ahead, self.block_size, self._allocate)
+            self._local.pipeline = pipeline
+        return pipeline
+
+    def _open(
+        self, file: Path, mode: str, cache_mode: Optional[CacheMode] = None
+    ) -> BinaryIO:
+        """Open a file unbuffered, with O_DIRECT if configured and supported."""
+        if self._cache_mode(cache_mode) is CacheMode.DIRECT:
+            flags = (
+                os.O_RDONLY if mode == "rb" else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            )
+            fd = open_direct(file, flags)
+            if fd is not None:
+                return open(fd, mode, buffering=0)
+        return open(file, mode, buffering=0)
+
+    def blocks(
+        self,
+        f: BinaryIO,
+        stats: Optional[PipelineStats] = None,
+        cache_mode: Optional[CacheMode] = None,
+    ) -> Iterator[memoryview]:
+        """Iterate over the blocks of an opened file.
+
+        The yielded memoryviews are only valid until the next block is read.
+        Unless the page cache is used normally, the pages of a block are
+        dropped from the page cache once it is consumed.
+
+        Args:
+            f: The file, opened in binary mode.
+            stats: Collects the statistics of the read.
+            cache_mode: Overrides the cache mode of the engine.
+
+        Yields:
+            The blocks of the file.
+        """
+        cache_mode = self._cache_mode(cache_mode)
+        fileno = f.fileno()
+        if self.fadvise:
+            os.posix_fadvise(fileno, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        offset = 0
+        for block in self._read_blocks(f, stats):
+            size = len(block)
+            yield block
+            if cache_mode is not CacheMode.NORMAL:
+                drop_pages(fileno, offset, size)
+            offset += size
+
+    def _read_blocks(
+        self, f: BinaryIO, stats: Optional[PipelineStats] = None
+    ) -> Iterator[memoryview]:
+        fileno = f.fileno()
+        file_size = os.fstat(fileno).st_size
+        if self.use_mmap and file_size:
+            start = time.perf_counter()
+            mm = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            view = memoryview(mm)
+            block = None
+            try:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                for offset in range(0, len(view), self.block_size):
+                    block = view[offset : offset + self.block_size]
+                    yield block
+                    block.release()
+                if stats is not None:
+                    stats.bytes += len(mm)
+                    stats.duration += time.perf_counter() - start
+            finally:
+                # The views are released before the map is closed, also when
+                # the consumer raised. If it still holds a slice of a block,
+                # e.g. in its traceback, the map is closed once that's gone
+                # instead of hiding its error behind a BufferError.
+                with contextlib.suppress(BufferError):
+                    if block is not None:
+                        block.release()
+                    view.release()
+                    mm.close()
+            return
+
+        # Smaller files aren't worth a reader thread
+        if self.read_ahead > 1 and file_size > 2 * self.block_size:
+            yield from self._pipeline().blocks(f, stats)
+            return
+
+        start = time.perf_counter()
+        buffer = self._buffer()
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            if stats is not None:
+                stats.bytes += size
+            yield buffer[:size]
+        if stats is not None:
+            stats.duration += time.perf_counter() - start
+
+    def calculate_digests(
+        self,
+        file: Path,
+        algorithms: Iterable[str] = ("md5",),
+        stats: Optional[PipelineStats] = None,
+        cache_mode: Optional[CacheMode] = None,
+    ) -> Dict[str, str]:
+        """Calculate the digests of a given file.
+
+        The file is read once, every block is passed to all the requested
+        algorithms.
+
+        Args:
+            file: File to calculate the digests for.
+            algorithms: The names of the algorithms.
+            stats: Collects the statistics of the read.
+            cache_mode: Overrides the cache mode of the engine.
+
+        Returns:
+            The digests in hex value, keyed by algorithm.
+        """
+        hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+        with self._open(file, "rb", cache_mode) as f:
+            for block in self.blocks(f, stats, cache_mode):
+                for hasher in hashers.values():
+                    hasher.update(block)
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+    def copy_with_digests(
+        self,
+        src: Path,
+        dst: Path,
+        algorithms: Iterable[str] = ("md5",),
+        stats: Optional[PipelineStats] = None,
+    ) -> Dict[str, str]:
+        """Copy a file and calculate its digests in the same read.
+
+        The permission bits are copied as well, like `shutil.copy`. Unless
+        the page cache is used normally, the written pages are dropped as
+        the copy goes.
+
+        Args:
+            src: The file to copy.
+            dst: The destination file.
+            algorithms: The names of the algorithms.
+            stats: Collects the statistics of the read.
+
+        Returns:
+            The digests of the file in hex value, keyed by algorithm.
+        """
+        hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+        with self._open(src, "rb") as f_src, self._open(dst, "wb") as f_dst:
+            write_behind = WriteBehind(f_dst)
+            direct = self.cache_mode is CacheMode.DIRECT
+            for block in self.blocks(f_src, stats):
+                for hasher in hashers.values():
+                    hasher.update(block)
+                if direct and len(block) % ALIGNMENT:
+                    # The unaligned tail can't be written with O_DIRECT
+                    clear_direct(f_dst.fileno())
+                    direct = False
+                write_all(f_dst, block)
+                if self.cache_mode is not CacheMode.NORMAL:
+                    write_behind.written(len(block))
+            write_behind.flush()
+        shutil.copymode(src, dst)
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+    def write_to_zip(
+        self,
+        archive: zipfile.ZipFile,
+        file: Path,
+        arcname: str,
+        stats: Optional[PipelineStats] = None,
+        write_behind: Optional[WriteBehind] = None,
+        cache_mode: Optional[CacheMode] = None,
+    ):
+        """Write a file into a zip archive, like `ZipFile.write`.
+
+        The file is read through the engine, so large files profit from the
+        large blocks and the read ahead. The zip entry calculates the CRC-32
+        of every block it receives. The archive itself is never written with
+        O_DIRECT as the zip headers break the alignment.
+
+        Args:
+            archive: The zip archive, opened for writing.
+            file: The file to add.
+            arcname: The name of the file in the archive.
+            stats: Collects the statistics of the read.
+            write_behind: Flushes and drops the written pages of the archive,
+                shared by all its files. Unless the page cache is used
+                normally, the written bytes are counted in it. Flush it once
+                the archive is written.
+            cache_mode: Overrides the cache mode of the engine.
+        """
+        if file.is_dir():
+            archive.write(file, arcname=arcname)
+            return
+        cache_mode = self._cache_mode(cache_mode)
+        zinfo = zipfile.ZipInfo.from_file(file, arcname=arcname)
+        zinfo.compress_type = archive.compression
+        with self._open(file, "rb", cache_mode) as f_src, archive.open(
+            zinfo, mode="w"
+        ) as f_dst:
+            for block in self.blocks(f_src, stats, cache_mode):
+                f_dst.write(block)
+                if write_behind is not None and cache_mode is not CacheMode.NORMAL:
+                    write_behind.written(len(block))
+
+
+DEFAULT_ENGINE = HashEngine()
+
+
+def calculate_digests(
+    file: Path, algorithms: Iterable[str] = ("md5",)
+) -> Dict[str, str]:
+    """Calculate the digests of a given file with the default engine.
+
+    Args:
+        file: File to calculate the digests for.
+        algorithms: The names of the algorithms.
+
+    Returns:
+        The digests in hex value, keyed by algorithm.
+    """
+    return DEFAULT_ENGINE.calculate_digests(file, algorithms)
+
+
+def copy_with_digests(
+    src: Path, dst: Path, algorithms: Iterable[str] = ("md5",)
+) -> Dict[str, str]:
+    """Copy a file and calculate its digests with the default engine.
+
+    Args:
+        src: The file to copy.
+        dst: The destination file.
+        algorithms: The names of the algorithms.
+
+    Returns:
+        The digests of the file in hex value, keyed by algorithm.
+    """
+    return DEFAULT_ENGINE.copy_with_digests(src, dst, algorithms)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# The identity of a file's contents: (device, inode, size, mtime_ns, ctime_ns)
+FileKey = Tuple[int, int, int, int, int]
+
+
+def file_key(path: Path) -> FileKey:
+    """Return the key of the current contents of a file.
+
+    Unlike the mtime, the ctime can't be reset after a write. It does also
+    change when the file is (un)linked, see `FixityCache.relinked`.
+    """
+    stat = os.stat(path)
+    return (
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+    )
+
+
+class FixityCache:
+    """Persistent cache of the digests of files.
+
+    An unchanged file isn't read again. Stored in SQLite so it can be shared
+    by the worker threads and processes on the same host. The least recently
+    used entries are evicted.
+
+    Args:
+        path: The path of the SQLite database.
+        max_entries: The amount of entries to keep.
+    """
+
+    def __init__(self, path: Path, max_entries: int = 100000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "dev INTEGER NOT NULL, "
+                "ino INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "ctime_ns INTEGER NOT NULL, "
+                "digests TEXT NOT NULL, "
+                "used REAL NOT NULL, "
+                "PRIMARY KEY (dev, ino))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS digests_used ON digests (used)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _get(self, key: FileKey) -> Optional[Dict[str, str]]:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT digests FROM digests WHERE dev = ? AND ino = ? "
+                "AND size = ? AND mtime_ns = ? AND ctime_ns = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE digests SET used = ? WHERE dev = ? AND ino = ?",
+                (time.time(), *key[:2]),
+            )
+        return json.loads(row[0])
+
+    def get(self, path: Path, algorithms: List[str]) -> Optional[Dict[str, str]]:
+        """Return the cached digests of a file.
+
+        Args:
+            path: The file.
+            algorithms: The algorithms which are needed.
+
+        Returns:
+            The digests by algorithm or None if the file changed or not all
+            algorithms are cached.
+        """
+        digests = self._get(file_key(path))
+        if digests is None or not all(a in digests for a in algorithms):
+            return None
+        return {a: digests[a] for a in algorithms}
+
+    def put(self, path: Path, digests: Dict[str, str], key: FileKey = None):
+        """Store the digests of a file.
+
+        The digests are merged with the cached digests of the same contents.
+
+        Args:
+            path: The file.
+            digests: The digests by algorithm.
+            key: The key of the file when it was hashed, defaults to the
+                current one.
+        """
+        key = key or file_key(path)
+        merged = {**(self._get(key) or {}), **digests}
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, json.dumps(merged), time.time()),
+            )
+            connection.execute(
+                "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests "
+                "ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def relinked(self, path: Path, key: FileKey):
+        """Keep the entry of a file valid after (un)linking it.
+
+        Creating or removing a hardlink changes the ctime but not the
+        contents. Only call it right after the (un)link, with the key from
+        right before it, so nothing else can have changed the file in
+        between. If anything but the ctime changed, the entry is dropped.
+
+        Args:
+            path: The file.
+            key: The key of the file right before it was (un)linked.
+        """
+        new_key = file_key(path)
+        with self._connect() as connection:
+            if new_key[:4] != key[:4]:
+                connection.execute(
+                    "DELETE FROM digests WHERE dev = ? AND ino = ?", key[:2]
+                )
+                return
+            connection.execute(
+                "UPDATE digests SET ctime_ns = ? WHERE dev = ? AND ino = ? "
+                "AND size = ? AND mtime_ns = ? AND ctime_ns = ?",
+                (new_key[4], *key),
+            )
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+from typing import Dict, List
+
+from app.helpers.acks import AckCoalescer
+
+
+def calculate_message_key(body: bytes) -> str:
+    """Return the key of a message, the same for its redeliveries."""
+    return hashlib.sha256(body).hexdigest()
+
+
+class Delivery:
+    """Class representing a delivery of a message on a channel.
+
+    Args:
+        acks: The ack coalescer of the channel.
+        delivery_tag: The delivery tag on the channel.
+        queue: The consumer queue of the channel.
+    """
+
+    def __init__(self, acks: AckCoalescer, delivery_tag: int, queue=None):
+        self.acks = acks
+        self.delivery_tag = delivery_tag
+        self.queue = queue
+
+    def replaced_by(self, delivery: "Delivery") -> bool:
+        """Return if a later delivery is the redelivery of this one.
+
+        That's the case after a reconnect, when the channel of this delivery
+        is closed, or replaced by the channel of the later one.
+        """
+        channel = self.acks.channel
+        return not channel.is_open or (
+            self.queue is delivery.queue and channel is not delivery.acks.channel
+        )
+
+
+class InFlightRegistry:
+    """Registry of the messages which are being processed.
+
+    After a reconnect, the broker redelivers the unacked messages on the new
+    channel while their jobs are still running. A redelivery of a running
+    job doesn't start a duplicate job. Instead, the job is settled with the
+    delivery tag of the new channel, as the old one can't be acked anymore.
+
+    Other deliveries of the same message while its job is running, e.g. a
+    duplicate publish or the same message on another queue, don't start a
+    job either. They are kept, the job settles all of them.
+    """
+
+    def __init__(self):
+        self._deliveries: Dict[str, List[Delivery]] = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key: str, delivery: Delivery) -> bool:
+        """Register a delivery of a message.
+
+        Args:
+            key: The key of the message.
+            delivery: The delivery.
+
+        Returns:
+            True if a job has to be started, False if it's already running.
+        """
+        with self._lock:
+            deliveries = self._deliveries.get(key)
+            if deliveries is None:
+                self._deliveries[key] = [delivery]
+                return True
+            # The deliveries which can't be settled anymore are dropped
+            deliveries[:] = [d for d in deliveries if not d.replaced_by(delivery)]
+            deliveries.append(delivery)
+        return False
+
+    def current(self, key: str) -> List[Delivery]:
+        """Return the deliveries of a running job."""
+        with self._lock:
+            return list(self._deliveries.get(key, []))
+
+    def release(self, key: str) -> List[Delivery]:
+        """Unregister a job once it's settled.
+
+        Returns:
+            The deliveries to settle the job with, empty if it isn't running.
+        """
+        with self._lock:
+            return self._deliveries.pop(key, [])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._deliveries)
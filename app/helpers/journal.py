@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from enum import Enum
+from pathlib import Path
+from typing import Iterator, Optional
+
+from app.helpers.events import WatchfolderMessage
+
+
+class JobStage(Enum):
+    """The durable stages of a SIP creation job, in order."""
+
+    STAGED = "staged"
+    BAGGED = "bagged"
+    PUBLISHED = "published"
+    ANNOUNCED = "announced"
+
+
+class JobRecord:
+    """Class representing the journal entry of a job.
+
+    Args:
+        job_id: The ID of the job.
+        stage: The last completed stage.
+        state: The state needed to resume the job, e.g. the digests.
+        updated: The timestamp of the last update.
+    """
+
+    def __init__(self, job_id: str, stage: JobStage, state: dict, updated: float):
+        self.job_id = job_id
+        self.stage = stage
+        self.state = state
+        self.updated = updated
+
+
+def calculate_job_id(message: WatchfolderMessage) -> str:
+    """Calculate the ID of the job of a watchfolder message.
+
+    A redelivered message results in the same ID, as long as the essence and
+    the sidecar didn't change.
+
+    Args:
+        message: The watchfolder message.
+
+    Returns:
+        The job ID.
+    """
+    parts = [message.flow_id]
+    for path in (message.get_essence_path(), message.get_xml_path()):
+        stat = path.stat()
+        parts += [str(path), str(stat.st_size), str(stat.st_mtime_ns)]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+class JobJournal:
+    """Local journal of the completed stages of the SIP creation jobs.
+
+    Stored in SQLite so it survives crashes and can be shared by the worker
+    threads and processes on the same host.
+
+    Args:
+        path: The path of the SQLite database.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        """Return the journal entry of a job.
+
+        Args:
+            job_id: The ID of the job.
+
+        Returns:
+            The journal entry or None if the job is unknown.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT stage, state, updated FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return JobRecord(job_id, JobStage(row[0]), json.loads(row[1]), row[2])
+
+    def record(self, job_id: str, stage: JobStage, state: dict = None):
+        """Record the completion of a stage of a job.
+
+        The state is merged with the state of the earlier stages.
+
+        Args:
+            job_id: The ID of the job.
+            stage: The completed stage.
+            state: The state needed to resume from this stage.
+        """
+        record = self.get(job_id)
+        merged = {**(record.state if record else {}), **(state or {})}
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, stage, state, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (job_id, stage.value, json.dumps(merged), time.time()),
+            )
+
+    def prune(self, max_age: float) -> int:
+        """Remove the entries which weren't updated for a while.
+
+        Args:
+            max_age: The age in seconds.
+
+        Returns:
+            The amount of removed entries.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "DELETE FROM jobs WHERE updated < ?", (time.time() - max_age,)
+            )
+        return cursor.rowcount
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds, from parsing a message up to zipping a large essence
+STAGE_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+LabelValues = Tuple[str, ...]
+
+
+@contextmanager
+def timed(durations: Dict[str, float], stage: str) -> Iterator[None]:
+    """Add the duration of the block to a stage, also if it fails."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        durations[stage] = durations.get(stage, 0.0) + time.perf_counter() - started
+
+
+def queue_wait(delivered: float, published: Optional[float] = None) -> float:
+    """Return the seconds a message waited until now, for its job to start.
+
+    Args:
+        delivered: The time the message was delivered, in seconds since the
+            epoch.
+        published: The timestamp the publisher set on the message, if any,
+            in seconds since the epoch. Includes the time on the broker.
+    """
+    return max(time.time() - (published or delivered), 0.0)
+
+
+def throughput(size: int, seconds: float) -> Optional[float]:
+    """Return the bytes per second, None if nothing was timed or transferred."""
+    if not size or seconds <= 0:
+        return None
+    return round(size / seconds, 1)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value per combination of labels."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _labels(self.labelnames, key)
+                lines.append(f"{self.name}{labels} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """The distribution of observed values per combination of labels.
+
+    Args:
+        name: The name of the metric.
+        help: The description of the metric.
+        labelnames: The names of the labels.
+        buckets: The upper bounds of the buckets, ascending.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = STAGE_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # Per combination of labels: the counts per bucket, the sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * len(self.buckets), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, **labels: str) -> int:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, _ = self._values.get(key, ([0], [0.0]))
+            return sum(counts)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _labels(self.labelnames + ("le",), key + (_number(bound),))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_number(total[0])}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The metrics exposed together, in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics: List[object] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = STAGE_BUCKETS,
+    ):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class JobMetrics:
+    """The metrics of the SIP creation jobs.
+
+    The durations are observed per stage, so the stage which saturates first
+    under load stands out. The throughput is counted in SIPs and essence
+    bytes, per mimetype and CP; the rate per second follows from the
+    counters, e.g. `rate(sipin_sip_creator_essence_bytes_total[5m])`.
+    """
+
+    def __init__(self, registry: Optional[Registry] = None):
+        self.registry = registry or Registry()
+        self.stage_seconds = self.registry.histogram(
+            "sipin_sip_creator_stage_seconds",
+            "Duration of a stage of the SIP creation.",
+            ["stage"],
+        )
+        self.sips = self.registry.counter(
+            "sipin_sip_creator_sips_total",
+            "Created SIPs.",
+            ["mimetype", "cp_id"],
+        )
+        self.essence_bytes = self.registry.counter(
+            "sipin_sip_creator_essence_bytes_total",
+            "Bytes of the essences of the created SIPs.",
+            ["mimetype", "cp_id"],
+        )
+        self.failures = self.registry.counter(
+            "sipin_sip_creator_failures_total",
+            "Failed jobs, per reason.",
+            ["reason"],
+        )
+
+    def observe_stages(self, durations: Dict[str, float]):
+        for stage, seconds in durations.items():
+            self.stage_seconds.observe(seconds, stage=stage)
+
+    def sip_created(self, mimetype: Optional[str], cp_id: str, essence_size: int):
+        labels = {"mimetype": mimetype or "unknown", "cp_id": cp_id}
+        self.sips.inc(**labels)
+        self.essence_bytes.inc(essence_size, **labels)
+
+
+class MetricsServer:
+    """Serves the metrics of a registry on `/metrics`, on a background thread.
+
+    Args:
+        registry: The metrics to serve.
+        host: The address to listen on.
+        port: The port to listen on, a free one if 0.
+    """
+
+    def __init__(self, registry: Registry, host: str = "127.0.0.1", port: int = 9100):
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes aren't worth a log line
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread:
+            self._thread.join()
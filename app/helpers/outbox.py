@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+
+class OutboxMessage:
+    """Class representing a message waiting in the outbox.
+
+    Args:
+        id: The ID of the message, increasing in the order of adding.
+        content: The payload.
+        properties: The properties of the message.
+        event_timestamp: The timestamp of the event in milliseconds.
+        attempts: The amount of failed attempts to send it.
+    """
+
+    def __init__(
+        self,
+        id: int,
+        content: bytes,
+        properties: dict,
+        event_timestamp: Optional[int],
+        attempts: int = 0,
+    ):
+        self.id = id
+        self.content = content
+        self.properties = properties
+        self.event_timestamp = event_timestamp
+        self.attempts = attempts
+
+    def to_dict(self) -> dict:
+        return {
+            "content": self.content,
+            "properties": self.properties,
+            "event_timestamp": self.event_timestamp,
+        }
+
+
+class Outbox:
+    """Local durable outbox of the messages to send.
+
+    A message is committed to the outbox before its job is acknowledged, and
+    removed once it's sent. Stored in SQLite so it survives crashes and can
+    be shared by the worker threads.
+
+    Args:
+        path: The path of the SQLite database.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "content BLOB NOT NULL, "
+                "properties TEXT NOT NULL, "
+                "event_timestamp INTEGER, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt REAL NOT NULL DEFAULT 0)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def put(
+        self, content: bytes, properties: dict, event_timestamp: Optional[int] = None
+    ) -> int:
+        """Commit a message to the outbox.
+
+        Returns:
+            The ID of the message.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO messages (content, properties, event_timestamp) "
+                "VALUES (?, ?, ?)",
+                (content, json.dumps(properties), event_timestamp),
+            )
+        return cursor.lastrowid
+
+    def due(self, limit: int) -> List[OutboxMessage]:
+        """Return the messages to send now, oldest first.
+
+        Args:
+            limit: The maximum amount of messages.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT id, content, properties, event_timestamp, attempts "
+                "FROM messages WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+        return [
+            OutboxMessage(id, bytes(content), json.loads(properties), timestamp, n)
+            for id, content, properties, timestamp, n in rows
+        ]
+
+    def remove(self, ids: List[int]):
+        """Remove the sent messages."""
+        with self._connect() as connection:
+            connection.executemany(
+                "DELETE FROM messages WHERE id = ?", [(id,) for id in ids]
+            )
+
+    def retry_later(self, ids: List[int], delay: float):
+        """Postpone the next attempt of the messages which failed to send."""
+        with self._connect() as connection:
+            connection.executemany(
+                "UPDATE messages SET attempts = attempts + 1, next_attempt = ? "
+                "WHERE id = ?",
+                [(time.time() + delay, id) for id in ids],
+            )
+
+    def __len__(self) -> int:
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+class OutboxFlusher:
+    """Sends the messages in the outbox in batches, on a background thread.
+
+    Failed messages are retried with an exponential backoff.
+
+    Args:
+        outbox: The outbox.
+        send: Sends a batch of messages and returns, per message, None if it
+            was sent and the error otherwise.
+        batch_size: The maximum amount of messages per batch.
+        interval: The seconds to wait when the outbox is empty.
+        max_backoff: The maximum seconds between two attempts of a message.
+        report: Called with the sent messages and the failed messages with
+            their errors.
+        on_error: Called with the error when flushing fails, e.g. when the
+            outbox can't be read. The flusher backs off and tries again.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        send: Callable[[List[dict]], List[Optional[Exception]]],
+        batch_size: int = 100,
+        interval: float = 1,
+        max_backoff: float = 300,
+        report: Optional[
+            Callable[[List[OutboxMessage], List[Tuple[OutboxMessage, Exception]]], None]
+        ] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+    ):
+        self.outbox = outbox
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.report = report
+        self.on_error = on_error
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.interval * 2 ** attempts, self.max_backoff)
+
+    def flush(self) -> int:
+        """Send one batch of due messages.
+
+        Returns:
+            The amount of sent messages.
+        """
+        messages = self.outbox.due(self.batch_size)
+        if not messages:
+            return 0
+        try:
+            errors = self.send([message.to_dict() for message in messages])
+        except Exception as e:
+            errors = [e] * len(messages)
+
+        sent = [m for m, error in zip(messages, errors) if error is None]
+        failed = [(m, error) for m, error in zip(messages, errors) if error]
+        self.outbox.remove([message.id for message in sent])
+        for message, _ in failed:
+            self.outbox.retry_later([message.id], self._backoff(message.attempts))
+        if self.report:
+            self.report(sent, failed)
+        return len(sent)
+
+    def notify(self):
+        """Wake up the flusher, e.g. after a message is added."""
+        self._wakeup.set()
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                sent = self.flush()
+            except Exception as error:
+                # Keep the flusher running, the messages stay in the outbox
+                if self.on_error:
+                    self.on_error(error)
+                self._stop.wait(self._backoff(failures))
+                failures += 1
+                continue
+            failures = 0
+            if sent < self.batch_size:
+                # Nothing due anymore, wait for new messages or retries
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher, the messages not sent yet stay in the outbox."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+from uuid import uuid4
+
+# Identifies this process, as the pid is reused, e.g. always 1 in a container.
+PROCESS_TOKEN = uuid4().hex
+
+
+def owner_info() -> dict:
+    """Return the identity of this process, to record it as an owner."""
+    return {
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "process": PROCESS_TOKEN,
+    }
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, but owned by another user
+        return True
+    return True
+
+
+def is_owner_live(info: dict) -> bool:
+    """Return if the owning process is still running.
+
+    Processes on other hosts are considered live, as they can't be checked.
+
+    Args:
+        info: The identity of the owner, see `owner_info`.
+    """
+    if info.get("host") != socket.gethostname():
+        return True
+    if info.get("process") == PROCESS_TOKEN:
+        return True
+    if info.get("pid") == os.getpid():
+        # A reused pid of an earlier process
+        return False
+    return _pid_alive(info.get("pid", -1))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import mmap
+import os
+import threading
+from enum import Enum
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+# O_DIRECT requires the buffers, offsets and sizes to be aligned to the
+# logical block size of the device. A page is a safe multiple of it.
+ALIGNMENT = mmap.PAGESIZE
+
+# Amount of written bytes after which the dirty pages are flushed and dropped.
+WRITEBACK_WINDOW = 64 * 1024 * 1024
+
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+HAS_O_DIRECT = hasattr(os, "O_DIRECT")
+
+
+class CacheMode(Enum):
+    """How the essence I/O uses the page cache.
+
+    - NORMAL: Use the page cache as usual.
+    - DONTNEED: Drop the pages of the essence once they are consumed, so the
+      essence doesn't evict the pages of the other files on the node.
+    - DIRECT: Bypass the page cache with O_DIRECT. Falls back to DONTNEED when
+      the filesystem doesn't support it.
+    """
+
+    NORMAL = "normal"
+    DONTNEED = "dontneed"
+    DIRECT = "direct"
+
+
+def align(size: int) -> int:
+    """Round a size up to the alignment."""
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def allocate_aligned(size: int) -> memoryview:
+    """Allocate a buffer aligned to a page, as required by O_DIRECT.
+
+    An anonymous memory map is always page aligned.
+    """
+    return memoryview(mmap.mmap(-1, align(size)))
+
+
+def drop_pages(fd: int, offset: int = 0, length: int = 0):
+    """Drop the clean pages of a file range from the page cache.
+
+    A length of 0 means until the end of the file.
+    """
+    if HAS_FADVISE:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def open_direct(path: Path, flags: int) -> Optional[int]:
+    """Open a file with O_DIRECT.
+
+    Returns:
+        The file descriptor or None if the filesystem doesn't support O_DIRECT.
+    """
+    if not HAS_O_DIRECT:
+        return None
+    try:
+        return os.open(path, flags | os.O_DIRECT, 0o666)
+    except OSError:
+        # EINVAL, e.g. tmpfs
+        return None
+
+
+def clear_direct(fd: int):
+    """Clear O_DIRECT on a file descriptor, for writing an unaligned tail."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+
+
+class WriteBehind:
+    """Flushes and drops the written pages of a file every window.
+
+    Dirty pages can't be dropped, so they are written back first.
+
+    Args:
+        f: The file being written.
+        window: The amount of bytes after which to flush and drop.
+    """
+
+    def __init__(self, f: BinaryIO, window: int = WRITEBACK_WINDOW):
+        self.f = f
+        self.window = window
+        self.pending = 0
+
+    def written(self, size: int):
+        self.pending += size
+        if self.pending >= self.window:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.f.flush()
+        os.fdatasync(self.f.fileno())
+        drop_pages(self.f.fileno())
+        self.pending = 0
+
+
+def cached_bytes() -> Optional[int]:
+    """Return the size of the page cache of the node, in bytes.
+
+    Returns:
+        The "Cached" value of /proc/meminfo or None if it's not available.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("Cached:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class PageCacheMonitor:
+    """Samples the size of the page cache during a run.
+
+    Use as a context manager. The page cache is shared by the whole node, so
+    the values include the I/O of the other processes.
+
+    Args:
+        interval: The seconds between two samples.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.start: Optional[int] = None
+        self.peak: Optional[int] = None
+        self.end: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        value = cached_bytes()
+        if value is not None:
+            self.peak = value if self.peak is None else max(self.peak, value)
+        return value
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start = self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.end = self._sample()
+
+    def to_dict(self) -> dict:
+        def delta(value):
+            if value is None or self.start is None:
+                return None
+            return value - self.start
+
+        return {
+            "page_cache_start_bytes": self.start,
+            "page_cache_peak_growth_bytes": delta(self.peak),
+            "page_cache_end_growth_bytes": delta(self.end),
+        }
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+
+class PipelineStats:
+    """Statistics of reading a file through a read pipeline.
+
+    - read_stall: Seconds the reader waited for a free buffer, meaning the
+      consumers (hashing, writing) are the bottleneck.
+    - consume_stall: Seconds the consumers waited for a filled buffer, meaning
+      the storage is the bottleneck.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.read_stall = 0.0
+        self.consume_stall = 0.0
+        self.duration = 0.0
+
+    def add(self, other: "PipelineStats"):
+        self.bytes += other.bytes
+        self.read_stall += other.read_stall
+        self.consume_stall += other.consume_stall
+        self.duration += other.duration
+
+    def to_dict(self) -> dict:
+        return {
+            "bytes": self.bytes,
+            "read_stall_seconds": round(self.read_stall, 3),
+            "consume_stall_seconds": round(self.consume_stall, 3),
+            "duration_seconds": round(self.duration, 3),
+        }
+
+
+class ReadPipeline:
+    """Reads a file on a separate thread into a ring of buffers.
+
+    While the consumers process a block, the reader thread already fills the
+    next buffers. This overlaps the (network) storage latency with the
+    hashing and writing.
+
+    The buffers are allocated on the first read and reused for the next
+    files, so a pipeline reads one file at a time.
+
+    Args:
+        ring_size: The amount of buffers, at least 2.
+        block_size: The size of a buffer.
+        allocate: Allocates a buffer of the given size, e.g. an aligned one.
+    """
+
+    def __init__(
+        self,
+        ring_size: int,
+        block_size: int,
+        allocate: Callable[[int], memoryview] = lambda size: memoryview(
+            bytearray(size)
+        ),
+    ):
+        self.ring_size = max(int(ring_size), 2)
+        self.block_size = block_size
+        self.allocate = allocate
+        self._buffers: Optional[List[memoryview]] = None
+
+    def _read(
+        self,
+        f: BinaryIO,
+        buffers: list,
+        free: queue.Queue,
+        filled: queue.Queue,
+        stop: threading.Event,
+        stats: PipelineStats,
+    ):
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                index = free.get()
+                stats.read_stall += time.perf_counter() - start
+                if stop.is_set():
+                    break
+                size = f.readinto(buffers[index])
+                if not size:
+                    break
+                filled.put((index, size))
+        except Exception as e:
+            filled.put(e)
+            return
+        filled.put(None)
+
+    def blocks(
+        self, f: BinaryIO, stats: Optional[PipelineStats] = None
+    ) -> Iterator[memoryview]:
+        """Iterate over the blocks of an opened file.
+
+        The yielded memoryview is only valid until the next block is requested,
+        after which its buffer is handed back to the reader thread.
+
+        Args:
+            f: The file, opened in binary mode.
+            stats: Collects the statistics of the read.
+
+        Yields:
+            The blocks of the file.
+        """
+        stats = stats if stats is not None else PipelineStats()
+        if self._buffers is None:
+            self._buffers = [
+                self.allocate(self.block_size) for _ in range(self.ring_size)
+            ]
+        buffers = self._buffers
+        free: queue.Queue = queue.Queue()
+        filled: queue.Queue = queue.Queue()
+        for index in range(self.ring_size):
+            free.put(index)
+        stop = threading.Event()
+
+        read_stats = PipelineStats()
+        reader = threading.Thread(
+            target=self._read,
+            args=(f, buffers, free, filled, stop, read_stats),
+            daemon=True,
+        )
+        begin = time.perf_counter()
+        reader.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = filled.get()
+                stats.consume_stall += time.perf_counter() - start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                index, size = item
+                stats.bytes += size
+                yield buffers[index][:size]
+                free.put(index)
+        finally:
+            # Also stop the reader when the consumer bails out
+            stop.set()
+            free.put(None)
+            reader.join()
+            stats.read_stall += read_stats.read_stall
+            stats.duration += time.perf_counter() - begin
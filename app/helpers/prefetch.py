@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+from typing import List, Optional
+
+
+def split_prefetch_count(prefetch_count: int, weights: List[float]) -> List[int]:
+    """Split a prefetch count over channels by weight, at least 1 each."""
+    total = sum(weights)
+    return [max(round(prefetch_count * weight / total), 1) for weight in weights]
+
+
+class PrefetchController:
+    """Adapts the prefetch count of a channel to the observed load.
+
+    Every prefetched message is a job in flight. The target is enough jobs
+    to keep the workers busy, plus the jobs which finish while the next
+    deliveries arrive: many for short jobs, e.g. JPEGs, one for long jobs,
+    e.g. MXFs. The jobs waiting for disk space don't keep a worker busy, so
+    the target is capped at the running jobs plus the jobs which still fit
+    on the disks. The remaining messages are left to the other replicas.
+
+    The prefetch count only grows when the current window is used up, as
+    more deliveries don't help otherwise. It shrinks right away.
+
+    The durations and sizes of the jobs are averaged with an exponentially
+    weighted moving average.
+
+    Args:
+        prefetch_count: The initial prefetch count.
+        workers: The jobs which run in parallel at full load.
+        minimum: The minimum prefetch count.
+        maximum: The maximum prefetch count.
+        refill_time: The seconds for a new delivery to arrive after an ack.
+        smoothing: The weight of a new job in the averages.
+    """
+
+    def __init__(
+        self,
+        prefetch_count: int,
+        workers: int,
+        minimum: int = 1,
+        maximum: int = 256,
+        refill_time: float = 1,
+        smoothing: float = 0.2,
+    ):
+        self.prefetch_count = prefetch_count
+        self.workers = workers
+        self.minimum = minimum
+        self.maximum = maximum
+        self.refill_time = refill_time
+        self.smoothing = smoothing
+        self.mean_duration: Optional[float] = None
+        self.mean_space: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _average(self, mean: Optional[float], value: float) -> float:
+        if mean is None:
+            return value
+        return mean + self.smoothing * (value - mean)
+
+    def job_finished(self, duration: float, space: int = 0):
+        """Register a finished job, from any thread.
+
+        Args:
+            duration: The seconds the job ran.
+            space: The bytes the job reserved.
+        """
+        with self._lock:
+            self.mean_duration = self._average(self.mean_duration, duration)
+            if space:
+                self.mean_space = self._average(self.mean_space, space)
+
+    def target(self, in_flight: int, waiting: int, headroom: Optional[int]) -> int:
+        """Return the prefetch count for the current load.
+
+        Args:
+            in_flight: The jobs in flight.
+            waiting: The jobs in flight waiting for disk space.
+            headroom: The bytes a new job can still reserve, None if unknown.
+        """
+        with self._lock:
+            mean_duration, mean_space = self.mean_duration, self.mean_space
+        if mean_duration is None:
+            return self.prefetch_count
+        # Jobs which finish while the next deliveries arrive
+        buffer = math.ceil(self.workers * self.refill_time / max(mean_duration, 1e-3))
+        target = self.workers + buffer
+        if headroom is not None and mean_space:
+            # No more jobs than the disks have room for
+            target = min(target, in_flight - waiting + int(headroom // mean_space))
+        return min(max(target, self.minimum), self.maximum)
+
+    def update(
+        self, in_flight: int, waiting: int = 0, headroom: Optional[int] = None
+    ) -> Optional[int]:
+        """Retune the prefetch count, see `target`.
+
+        Returns:
+            The new prefetch count, None if it doesn't change.
+        """
+        target = self.target(in_flight, waiting, headroom)
+        if target > self.prefetch_count and in_flight < self.prefetch_count:
+            # The window isn't used up, the workers aren't starved
+            return None
+        if target == self.prefetch_count:
+            return None
+        self.prefetch_count = target
+        return target
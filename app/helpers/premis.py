@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from enum import Enum
-from typing import List
+from typing import Dict, List
 
 from lxml import etree
 
@@ -190,15 +190,63 @@ class Fixity:
 
     Args:
         md5: The md5.
+        digests: Additional digests keyed by algorithm, e.g. "sha256".
     """
 
-    def __init__(self, md5: str = None):
+    # The Library of Congress cryptographicHashFunctions vocabulary
+    ALGORITHM_AUTHORITY_URI = (
+        "http://id.loc.gov/vocabulary/preservation/cryptographicHashFunctions"
+    )
+    # Labels of the algorithms in the vocabulary.
+    ALGORITHM_LABEL_MAP = {
+        "adler32": "Adler-32",
+        "crc32": "CRC32",
+        "md5": "MD5",
+        "sha1": "SHA-1",
+        "sha256": "SHA-256",
+        "sha384": "SHA-384",
+        "sha512": "SHA-512",
+    }
+
+    def __init__(self, md5: str = None, digests: Dict[str, str] = None):
         self.md5 = md5
+        self.digests = {}
+        if md5:
+            self.digests["md5"] = md5
+        for algorithm, digest in (digests or {}).items():
+            if digest:
+                self.digests.setdefault(algorithm, digest)
+
+    def _fixity_element(self, parent, algorithm: str, digest: str):
+        fixity_element = etree.SubElement(
+            parent,
+            qname_text(NSMAP, "premis", "fixity"),
+        )
+        if algorithm in self.ALGORITHM_LABEL_MAP:
+            etree.SubElement(
+                fixity_element,
+                qname_text(NSMAP, "premis", "messageDigestAlgorithm"),
+                attrib={
+                    "authority": "cryptographicHashFunctions",
+                    "authorityURI": self.ALGORITHM_AUTHORITY_URI,
+                    "valueURI": f"{self.ALGORITHM_AUTHORITY_URI}/{algorithm}",
+                },
+            ).text = self.ALGORITHM_LABEL_MAP[algorithm]
+        else:
+            etree.SubElement(
+                fixity_element,
+                qname_text(NSMAP, "premis", "messageDigestAlgorithm"),
+            ).text = algorithm
+        etree.SubElement(
+            fixity_element,
+            qname_text(NSMAP, "premis", "messageDigest"),
+        ).text = digest
 
     def to_element(self):
         """Returns the fixity node as an lxml element.
 
-        If the md5 value is empty, the fixity node will be empty.
+        Every digest results in a fixity node. If there are no digests, the
+        fixity node will be empty.
 
         Returns:
             The Premis fixity element."""
@@ -207,24 +255,13 @@ class Fixity:
         object_characteristics_element = etree.Element(
             qname_text(NSMAP, "premis", "objectCharacteristics"),
         )
-        fixity_element = etree.SubElement(
-            object_characteristics_element,
-            qname_text(NSMAP, "premis", "fixity"),
-        )
-        if self.md5:
-            etree.SubElement(
-                fixity_element,
-                qname_text(NSMAP, "premis", "messageDigestAlgorithm"),
-                attrib={
-                    "authority": "cryptographicHashFunctions",
-                    "authorityURI": "http://id.loc.gov/vocabulary/preservation/cryptographicHashFunctions",
-                    "valueURI": "http://id.loc.gov/vocabulary/preservation/cryptographicHashFunctions/md5",
-                },
-            ).text = "MD5"
+        if not self.digests:
             etree.SubElement(
-                fixity_element,
-                qname_text(NSMAP, "premis", "messageDigest"),
-            ).text = self.md5
+                object_characteristics_element,
+                qname_text(NSMAP, "premis", "fixity"),
+            )
+        for algorithm, digest in self.digests.items():
+            self._fixity_element(object_characteristics_element, algorithm, digest)
 
         return object_characteristics_element
 
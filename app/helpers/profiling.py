@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import cProfile
+import collections
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Counter, Iterable, List, Optional
+
+# Header of a message to profile its job
+PROFILE_HEADER = "x-profile"
+
+# The jobs tracing the allocations, tracemalloc is shared by the threads
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def _truthy(value) -> bool:
+    if isinstance(value, bytes):
+        value = value.decode(errors="replace")
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+class ProfilingPolicy:
+    """Selects the jobs to profile.
+
+    Args:
+        sample_rate: The fraction of the jobs to profile, between 0 and 1.
+        cp_ids: The CPs of which to profile all the jobs.
+        header: If a message with a truthy `x-profile` header is profiled.
+        rand: Returns a random float in [0, 1).
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        cp_ids: Iterable[str] = (),
+        header: bool = True,
+        rand: Callable[[], float] = random.random,
+    ):
+        self.sample_rate = sample_rate
+        self.cp_ids = set(cp_ids)
+        self.header = header
+        self.rand = rand
+
+    def selected(self, headers: Optional[dict], cp_id: Optional[str]) -> bool:
+        if self.header and _truthy((headers or {}).get(PROFILE_HEADER)):
+            return True
+        if cp_id is not None and cp_id in self.cp_ids:
+            return True
+        return self.sample_rate > 0 and self.rand() < self.sample_rate
+
+
+class _Sampler:
+    """Samples the stack of a thread at an interval, for a wall-clock profile.
+
+    Unlike cProfile, the samples include the time spent waiting, e.g. on I/O
+    or locks.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path: Path):
+        """Write the samples as folded stacks, the input of flame graphs."""
+        with path.open("w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class JobProfiler:
+    """Profiles the block of a job on the current thread, as a context manager.
+
+    Writes to the folder, named after the time and the name of the job:
+    - `.pstats`: The cProfile statistics, see `pstats.Stats`.
+    - `.tracemalloc.txt`: The peak of the traced memory and the top
+      allocating lines.
+    - `.folded`: The folded stacks of the wall-clock samples.
+
+    Args:
+        directory: The folder to write the profiles to.
+        name: The name of the job, e.g. the subject of its event.
+        cprofile: If the calls are profiled with cProfile.
+        trace_malloc: If the allocations are traced with tracemalloc.
+        sampling_interval: The seconds between two samples of the stack,
+            disabled if None.
+        top: The amount of allocating lines to write.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        name: str,
+        cprofile: bool = True,
+        trace_malloc: bool = True,
+        sampling_interval: Optional[float] = None,
+        top: int = 25,
+    ):
+        self.directory = Path(directory)
+        safe_name = re.sub(r"[^\w.-]+", "_", name)[:100] or "job"
+        self.prefix = f"{time.strftime('%Y%m%dT%H%M%S')}-{safe_name}"
+        self.cprofile = cprofile
+        self.trace_malloc = trace_malloc
+        self.sampling_interval = sampling_interval
+        self.top = top
+        # The profiles written, once done
+        self.paths: List[Path] = []
+        self._profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[_Sampler] = None
+
+    def __enter__(self) -> "JobProfiler":
+        global _tracemalloc_users
+        if self.trace_malloc:
+            with _tracemalloc_lock:
+                if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                _tracemalloc_users += 1
+        if self.sampling_interval:
+            self._sampler = _Sampler(threading.get_ident(), self.sampling_interval)
+            self._sampler.start()
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _tracemalloc_users
+        if self._profile:
+            self._profile.disable()
+        if self._sampler:
+            self._sampler.stop()
+        snapshot = None
+        peak = 0
+        if self.trace_malloc:
+            with _tracemalloc_lock:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                _tracemalloc_users -= 1
+                if _tracemalloc_users == 0:
+                    tracemalloc.stop()
+
+        self.directory.mkdir(exist_ok=True, parents=True)
+        if self._profile:
+            path = self.directory.joinpath(f"{self.prefix}.pstats")
+            self._profile.dump_stats(str(path))
+            self.paths.append(path)
+        if snapshot:
+            path = self.directory.joinpath(f"{self.prefix}.tracemalloc.txt")
+            with path.open("w") as f:
+                # Since the first of the overlapping profiled jobs started
+                f.write(f"Peak traced memory: {peak} bytes\n\n")
+                for statistic in snapshot.statistics("lineno")[: self.top]:
+                    f.write(f"{statistic}\n")
+            self.paths.append(path)
+        if self._sampler:
+            path = self.directory.joinpath(f"{self.prefix}.folded")
+            self._sampler.write(path)
+            self.paths.append(path)
+        return False
+
+    def run(self, func: Callable, *args):
+        """Call a function in the profiler, e.g. on a worker thread."""
+        with self:
+            return func(*args)
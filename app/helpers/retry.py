@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from typing import Dict, Optional, Tuple
+
+# Header with the amount of failed attempts of a message
+ATTEMPT_HEADER = "x-attempt"
+
+
+class RetryTopology:
+    """Delayed retries of the messages of a queue.
+
+    A message which failed is published to a retry queue, which has no
+    consumers. Once its TTL expires, the broker dead-letters it back to the
+    main queue. Each delay has its own retry queue, so a long delay never
+    holds up a shorter one. After the maximum attempts the message is parked
+    for inspection instead.
+
+    The queues are named after their delay, so changing the delays declares
+    new queues instead of conflicting with the existing ones.
+
+    Args:
+        queue: The main queue.
+        max_attempts: The attempts after which a message is parked.
+        base_delay: The seconds before the first retry, doubling per attempt.
+        max_delay: The maximum seconds before a retry.
+    """
+
+    def __init__(
+        self,
+        queue: str,
+        max_attempts: int = 5,
+        base_delay: float = 30,
+        max_delay: float = 3600,
+    ):
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @property
+    def parking_queue(self) -> str:
+        return f"{self.queue}.parked"
+
+    def delay(self, attempt: int) -> float:
+        """Return the seconds before the retry after the given failed attempt."""
+        return min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+
+    def retry_queue(self, attempt: int) -> str:
+        return f"{self.queue}.retry.{int(self.delay(attempt) * 1000)}ms"
+
+    def retry_queues(self) -> Dict[str, dict]:
+        """Return the arguments of the retry queues to declare, per name."""
+        return {
+            self.retry_queue(attempt): {
+                "x-message-ttl": int(self.delay(attempt) * 1000),
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self.queue,
+            }
+            for attempt in range(1, self.max_attempts)
+        }
+
+    @staticmethod
+    def attempts(headers: Optional[dict]) -> int:
+        """Return the amount of failed attempts of a message."""
+        try:
+            return int((headers or {}).get(ATTEMPT_HEADER, 0))
+        except (TypeError, ValueError):
+            return 0
+
+    def route(self, headers: Optional[dict]) -> Tuple[str, dict]:
+        """Route a message which failed once more.
+
+        Args:
+            headers: The headers of the message.
+
+        Returns:
+            The queue to publish it to and its new headers.
+        """
+        attempt = self.attempts(headers) + 1
+        headers = {**(headers or {}), ATTEMPT_HEADER: attempt}
+        if attempt >= self.max_attempts:
+            return self.parking_queue, headers
+        return self.retry_queue(attempt), headers
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+
+class _Queue:
+    def __init__(self, weight: float, max_concurrency: Optional[int]):
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.jobs: Deque[Callable[[], None]] = deque()
+        self.running = 0
+        self.current = 0.0
+
+    @property
+    def eligible(self) -> bool:
+        return bool(self.jobs) and (
+            self.max_concurrency is None or self.running < self.max_concurrency
+        )
+
+
+class WeightedScheduler:
+    """Runs the jobs of several queues on a shared pool of worker threads.
+
+    When a worker is free, it picks the next job by smooth weighted round
+    robin over the queues with jobs waiting: a queue with weight 2 gets twice
+    the turns of a queue with weight 1, interleaved. A queue with as many
+    running jobs as its concurrency limit is skipped, so its turns go to the
+    other queues. The jobs of a queue run in the order they are submitted.
+
+    Args:
+        workers: The amount of worker threads.
+        on_error: Called with the queue and the error of a job which crashed.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        on_error: Optional[Callable[[str, Exception], None]] = None,
+    ):
+        self.workers = workers
+        self.on_error = on_error
+        self._queues: Dict[str, _Queue] = {}
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        self._condition = threading.Condition()
+
+    def add_queue(
+        self, name: str, weight: float = 1, max_concurrency: Optional[int] = None
+    ):
+        """Add a queue.
+
+        Args:
+            name: The name of the queue.
+            weight: The share of the turns of the queue.
+            max_concurrency: The maximum amount of running jobs of the queue,
+                unlimited if None.
+        """
+        with self._condition:
+            self._queues[name] = _Queue(weight, max_concurrency)
+
+    def submit(self, queue: str, job: Callable[[], None]):
+        """Queue a job, from any thread."""
+        with self._condition:
+            self._queues[queue].jobs.append(job)
+            self._condition.notify()
+
+    def pending(self) -> int:
+        """Return the amount of jobs waiting for a worker."""
+        with self._condition:
+            return sum(len(queue.jobs) for queue in self._queues.values())
+
+    def running(self) -> int:
+        """Return the amount of running jobs."""
+        with self._condition:
+            return sum(queue.running for queue in self._queues.values())
+
+    def _next(self):
+        eligible = [(n, q) for n, q in self._queues.items() if q.eligible]
+        if not eligible:
+            return None
+        total = sum(queue.weight for _, queue in eligible)
+        for _, queue in eligible:
+            queue.current += queue.weight
+        name, chosen = max(eligible, key=lambda item: item[1].current)
+        chosen.current -= total
+        chosen.running += 1
+        return name, chosen, chosen.jobs.popleft()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                item = self._next()
+                while item is None:
+                    if self._stopping and not any(
+                        queue.jobs for queue in self._queues.values()
+                    ):
+                        return
+                    self._condition.wait()
+                    item = self._next()
+            name, queue, job = item
+            try:
+                job()
+            except Exception as error:
+                if self.on_error:
+                    self.on_error(name, error)
+            finally:
+                with self._condition:
+                    queue.running -= 1
+                    # A worker may be waiting for the concurrency limit
+                    self._condition.notify_all()
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop the workers once all the submitted jobs are done."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
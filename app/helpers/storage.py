@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+PARTIAL_SUFFIX = ".partial"
+
+
+class StagingStrategy(Enum):
+    """How the essence is placed in the staging folder.
+
+    - AUTO: Hardlink when on the same filesystem, copy otherwise.
+    - COPY: Copy the essence, hashing it in the same read.
+    - HARDLINK: Link the essence, it is only read to hash it.
+    """
+
+    AUTO = "auto"
+    COPY = "copy"
+    HARDLINK = "hardlink"
+
+
+def optional_path(value: Optional[str]) -> Optional[Path]:
+    """Return a configured path or None if it's not configured.
+
+    Args:
+        value: The configured value, possibly empty.
+
+    Returns:
+        The path or None.
+    """
+    if not value or not str(value).strip():
+        return None
+    return Path(str(value).strip())
+
+
+def partial_path(path: Path, folder: Optional[Path] = None) -> Path:
+    """Return the path to write a file to before it's published.
+
+    Args:
+        path: The final path of the file.
+        folder: The folder to write the file in, defaults to the folder of the
+            final path.
+
+    Returns:
+        The path with the partial suffix.
+    """
+    return Path(folder or path.parent, path.name + PARTIAL_SUFFIX)
+
+
+def fsync_file(path: Path):
+    """Flush the contents of a file to the storage."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: Path):
+    """Flush the entries of a directory, e.g. a rename, to the storage."""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_tree(path: Path):
+    """Flush all the files and directories of a tree to the storage."""
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            fsync_file(Path(dirpath, filename))
+        fsync_dir(Path(dirpath))
+
+
+def existing_parent(path: Path) -> Path:
+    """Return the path itself or its closest existing parent."""
+    path = path.absolute()
+    while not path.exists():
+        path = path.parent
+    return path
+
+
+def same_filesystem(path: Path, other: Path) -> bool:
+    """Return if both paths are on the same filesystem.
+
+    Paths which don't exist yet are checked by their closest existing parent.
+    """
+    return existing_parent(path).stat().st_dev == existing_parent(other).stat().st_dev
+
+
+def resolve_staging_strategy(
+    strategy: StagingStrategy, essence: Path, staging_folder: Path
+) -> StagingStrategy:
+    """Resolve the staging strategy for an essence.
+
+    A hardlink can't cross filesystems, in that case the essence is copied.
+
+    Args:
+        strategy: The configured strategy.
+        essence: The path of the essence.
+        staging_folder: The folder to stage the essence in.
+
+    Returns:
+        Either COPY or HARDLINK.
+    """
+    if strategy is StagingStrategy.COPY:
+        return StagingStrategy.COPY
+    if same_filesystem(essence, staging_folder):
+        return StagingStrategy.HARDLINK
+    return StagingStrategy.COPY
+
+
+def publish(
+    partial: Path, path: Path, sync_file: bool = True, sync_dir: bool = True
+) -> Path:
+    """Atomically publish a completely written file under its final name.
+
+    On the same filesystem the file is renamed. Otherwise it is first copied
+    next to its final path under the partial name, and then renamed. The final
+    name thus never refers to an incomplete file. A failed copy is removed,
+    the partial file is kept.
+
+    Args:
+        partial: The completely written file.
+        path: The final path.
+        sync_file: Flush the file contents before renaming.
+        sync_dir: Flush the directory after renaming, so the rename survives
+            a crash.
+
+    Returns:
+        The final path.
+    """
+    if not same_filesystem(partial, path):
+        copy = partial_path(path)
+        try:
+            shutil.copyfile(partial, copy)
+            shutil.copymode(partial, copy)
+        except Exception:
+            # E.g. the output filesystem is full, the incomplete copy isn't
+            # left behind
+            copy.unlink(missing_ok=True)
+            raise
+        partial.unlink()
+        partial = copy
+
+    if sync_file:
+        fsync_file(partial)
+    os.replace(partial, path)
+    if sync_dir:
+        fsync_dir(path.parent)
+    return path
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Set
+from uuid import uuid4
+
+from app.helpers.admission import DiskAdmission
+from app.helpers.owner import PROCESS_TOKEN, is_owner_live, owner_info
+from app.helpers.storage import PARTIAL_SUFFIX
+
+MARKER_SUFFIX = ".sipin-sip-creator"
+# Only our own partial zips, not the partial uploads of other tools
+BAG_PARTIAL_SUFFIX = ".bag.zip" + PARTIAL_SUFFIX
+TOMBSTONE_SUFFIX = ".deleting"
+
+# The markers of the jobs running in this process.
+_active_markers: Set[Path] = set()
+_active_lock = threading.Lock()
+
+
+def marker_path(root_folder: Path) -> Path:
+    """Return the path of the marker of a staging tree.
+
+    The marker is a hidden file next to the tree, so it doesn't end up in the
+    bag.
+    """
+    return root_folder.with_name(f".{root_folder.name}{MARKER_SUFFIX}")
+
+
+def write_marker(root_folder: Path, job_id: Optional[str] = None) -> Path:
+    """Mark a staging tree as owned by a job of this process.
+
+    Args:
+        root_folder: The root folder of the staging tree.
+        job_id: The ID of the job, if known.
+
+    Returns:
+        The path of the marker.
+    """
+    marker = marker_path(root_folder)
+    marker.parent.mkdir(exist_ok=True, parents=True)
+    marker.write_text(
+        json.dumps(
+            {
+                **owner_info(),
+                "job_id": job_id,
+                "root_folder": str(root_folder),
+                "created": time.time(),
+            }
+        )
+    )
+    with _active_lock:
+        _active_markers.add(marker)
+    return marker
+
+
+def release_marker(marker: Path, remove: bool):
+    """Release the marker of a staging tree once its job stops.
+
+    Args:
+        marker: The path of the marker.
+        remove: Remove the marker, when the staging tree is removed as well.
+            A kept marker lets the sweeper remove the staging tree later.
+    """
+    with _active_lock:
+        _active_markers.discard(marker)
+    if remove:
+        marker.unlink(missing_ok=True)
+
+
+def tombstone(path: Path) -> Path:
+    """Rename a file or tree to a unique hidden name, before removing it.
+
+    The path itself can then be reused right away, e.g. by a redelivered job,
+    while the tombstone is removed. It stays on the same filesystem, so the
+    rename is atomic. Its mtime is the time of the rename, so the sweeper
+    leaves it to the reaper for the maximum age.
+
+    Returns:
+        The path of the tombstone.
+    """
+    path = Path(path)
+    renamed = path.with_name(f".{path.name}.{uuid4().hex}{TOMBSTONE_SUFFIX}")
+    path.rename(renamed)
+    os.utime(renamed)
+    return renamed
+
+
+def is_live(marker: Path) -> bool:
+    """Return if the job of a marker is still running.
+
+    Jobs on other hosts are considered live, as their processes can't be
+    checked.
+    """
+    try:
+        info = json.loads(marker.read_text())
+    except (OSError, ValueError):
+        return False
+    if info.get("process") == PROCESS_TOKEN:
+        with _active_lock:
+            return marker in _active_markers
+    return is_owner_live(info)
+
+
+class Reaper:
+    """Removes files and trees on a background thread, rate limited.
+
+    So the removal doesn't delay the jobs, nor compete with them for the
+    storage. Large files are truncated in steps before they are unlinked,
+    as unlinking a large file at once can stall the filesystem. Until they
+    are removed, the reclaimable bytes stay reserved in the disk admission.
+
+    Args:
+        rate: The maximum amount of bytes to remove per second.
+        step: The amount of bytes to truncate a file with per step.
+        report: Called with the path and the reclaimed bytes of every removed
+            path.
+        admission: The disk admission to reserve the pending bytes in.
+    """
+
+    def __init__(
+        self,
+        rate: int = 100 * 1024 * 1024,
+        step: int = 64 * 1024 * 1024,
+        report: Optional[Callable[[Path, int], None]] = None,
+        admission: Optional[DiskAdmission] = None,
+    ):
+        self.rate = rate
+        self.step = step
+        self.report = report
+        self.admission = admission
+        self.reclaimed_bytes = 0
+        self.pending_bytes = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._queued: Set[Path] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def reclaimable_bytes(path: Path) -> int:
+        """Return the bytes freed by removing a path.
+
+        Files with other hardlinks, e.g. the essence, free nothing.
+        """
+        paths = [path]
+        if path.is_dir() and not path.is_symlink():
+            paths = [
+                Path(dirpath, filename)
+                for dirpath, _, filenames in os.walk(path)
+                for filename in filenames
+            ]
+        reclaimable = 0
+        for file in paths:
+            try:
+                stat = file.lstat()
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink == 1:
+                reclaimable += stat.st_size
+        return reclaimable
+
+    def enqueue(
+        self,
+        path: Path,
+        done: Optional[Callable[[], None]] = None,
+        reservation_id: Optional[str] = None,
+    ) -> bool:
+        """Queue a path for removal.
+
+        Args:
+            path: The file or tree.
+            done: Called once the path is removed.
+            reservation_id: The disk reservation of the job which created the
+                path. It's replaced by the reclaimable bytes and released once
+                the path is removed.
+
+        Returns:
+            False if the path is already queued.
+        """
+        with self._lock:
+            if path in self._queued:
+                return False
+            self._queued.add(path)
+        pending = self.reclaimable_bytes(path)
+        if self.admission:
+            reservation_id = reservation_id or str(uuid4())
+            self.admission.replace(reservation_id, {path.parent: pending})
+        with self._lock:
+            self.pending_bytes += pending
+        self._queue.put((path, pending, done, reservation_id))
+        return True
+
+    def _throttle(self, size: int):
+        if self.rate:
+            time.sleep(size / self.rate)
+
+    def _remove_file(self, path: Path) -> int:
+        stat = path.lstat()
+        if stat.st_nlink > 1:
+            # A hardlinked essence, only the link is removed
+            path.unlink()
+            return 0
+        size = stat.st_size
+        while size > self.step:
+            size -= self.step
+            os.truncate(path, size)
+            self._throttle(self.step)
+        path.unlink()
+        self._throttle(size)
+        return stat.st_size
+
+    def remove(self, path: Path) -> int:
+        """Remove a file or tree, rate limited.
+
+        Returns:
+            The amount of reclaimed bytes.
+        """
+        reclaimed = 0
+        if path.is_dir() and not path.is_symlink():
+            for dirpath, _, filenames in os.walk(path, topdown=False):
+                for filename in filenames:
+                    reclaimed += self._remove_file(Path(dirpath, filename))
+                    if self._stop.is_set():
+                        return reclaimed
+            shutil.rmtree(path)
+        elif path.exists():
+            reclaimed += self._remove_file(path)
+        return reclaimed
+
+    def _remove_queued(self):
+        while not self._stop.is_set():
+            try:
+                path, pending, done, reservation_id = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                reclaimed = self.remove(path)
+            except OSError:
+                # E.g. removed in the meantime
+                reclaimed = 0
+            with self._lock:
+                self._queued.discard(path)
+                self.pending_bytes -= pending
+                self.reclaimed_bytes += reclaimed
+            if self.admission and reservation_id:
+                self.admission.release(reservation_id)
+            if done and not path.exists():
+                done()
+            if self.report:
+                self.report(path, reclaimed)
+
+    def start(self):
+        """Start removing the queued paths on a background thread."""
+        self._thread = threading.Thread(target=self._remove_queued, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop removing, the paths still queued are left for the sweeper."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+class Sweeper:
+    """Finds the artifacts left behind by crashed jobs.
+
+    These are the staging trees with a marker, the tombstones and the partial
+    bag zips, found in the given folders (not recursively). Only artifacts
+    older than the maximum age and not owned by a live job are queued for
+    removal.
+
+    Args:
+        folders: The folders to sweep.
+        reaper: Removes the artifacts.
+        max_age: The seconds after which an artifact is abandoned.
+    """
+
+    def __init__(self, folders: List[Path], reaper: Reaper, max_age: float = 21600):
+        self.folders = [Path(folder) for folder in folders]
+        self.reaper = reaper
+        self.max_age = max_age
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _abandoned(self, path: Path) -> bool:
+        try:
+            return time.time() - path.stat().st_mtime > self.max_age
+        except FileNotFoundError:
+            return False
+
+    def find(self) -> List[Path]:
+        """Return the abandoned artifacts, the markers included."""
+        found = []
+        for folder in self.folders:
+            if not folder.is_dir():
+                continue
+            for path in folder.iterdir():
+                if path.name.endswith(BAG_PARTIAL_SUFFIX) and self._abandoned(path):
+                    found.append(path)
+                elif (
+                    path.name.startswith(".")
+                    and path.name.endswith(TOMBSTONE_SUFFIX)
+                    and self._abandoned(path)
+                ):
+                    found.append(path)
+                elif (
+                    path.name.startswith(".")
+                    and path.name.endswith(MARKER_SUFFIX)
+                    and self._abandoned(path)
+                    and not is_live(path)
+                ):
+                    root_folder = path.with_name(path.name[1 : -len(MARKER_SUFFIX)])
+                    if root_folder.exists():
+                        found.append(root_folder)
+                    found.append(path)
+        return found
+
+    def sweep(self) -> int:
+        """Queue the abandoned artifacts for removal.
+
+        Returns:
+            The amount of queued artifacts.
+        """
+        return sum(self.reaper.enqueue(path) for path in self.find())
+
+    def _sweep_periodically(self, interval: float):
+        while True:
+            self.sweep()
+            if self._stop.wait(interval):
+                break
+
+    def start(self, interval: float = 3600):
+        """Sweep now and every interval, on a background thread."""
+        self._thread = threading.Thread(
+            target=self._sweep_periodically, args=(interval,), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# W3C trace context, in the headers of the incoming and outgoing messages
+TRACEPARENT_HEADER = "traceparent"
+
+TRACEPARENT_PATTERN = re.compile(
+    r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$"
+)
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def parse_traceparent(value: Any) -> Optional[Tuple[str, str]]:
+    """Return the trace id and parent span id of a traceparent header.
+
+    Returns:
+        None if the header is missing or malformed.
+    """
+    if isinstance(value, bytes):
+        value = value.decode(errors="replace")
+    if not isinstance(value, str):
+        return None
+    match = TRACEPARENT_PATTERN.match(value.strip().lower())
+    if not match or set(match.group(1)) == {"0"} or set(match.group(2)) == {"0"}:
+        return None
+    return match.group(1), match.group(2)
+
+
+class Span:
+    """A timed operation of a trace, with attributes such as byte counts.
+
+    Args:
+        name: The name of the operation.
+        trace_id: The 32 hex digits of the trace.
+        parent_id: The 16 hex digits of the parent span, None for a root span.
+        attributes: The initial attributes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def finish(self, end: Optional[int] = None):
+        self.end = end or time.time_ns()
+
+    @property
+    def traceparent(self) -> str:
+        """The traceparent header of a message sent within the span."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def duration(self) -> float:
+        """The seconds the span took, up to now if it isn't finished."""
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def to_dict(self) -> dict:
+        """Return the span as flat fields, e.g. for a log line."""
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "span": self.name,
+            "duration": self.duration,
+            **self.attributes,
+        }
+
+    def to_otlp(self) -> dict:
+        """Return the span in the OTLP/JSON format."""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end or time.time_ns()),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+        }
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """The spans of a job, nested in the order they are started.
+
+    A job runs its stages one after the other, so the span started last is
+    the parent of the next one, also when the stages run on other threads.
+
+    Args:
+        trace_id: The 32 hex digits of the trace.
+        parent_id: The span of the caller, e.g. of the producer of the message.
+    """
+
+    def __init__(self, trace_id: str, parent_id: Optional[str] = None):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self._stack: List[Span] = []
+        self._finished: List[Span] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_message(cls, key: str, headers: Optional[dict] = None) -> "Trace":
+        """Continue the trace of the traceparent header of a message.
+
+        Without one, the trace id is derived from the key of the message, so
+        the redeliveries of a message share their trace.
+        """
+        parsed = parse_traceparent((headers or {}).get(TRACEPARENT_HEADER))
+        if parsed:
+            return cls(*parsed)
+        return cls(key[:32])
+
+    @property
+    def current_id(self) -> Optional[str]:
+        """The id of the innermost running span, else of the parent."""
+        with self._lock:
+            return self._stack[-1].span_id if self._stack else self.parent_id
+
+    def annotate(self, **attributes: Any):
+        """Set attributes of the innermost running span."""
+        with self._lock:
+            if self._stack:
+                self._stack[-1].set(**attributes)
+
+    def child(self, name: str, **attributes: Any) -> Span:
+        """Start a span of the innermost running span, to finish and `add` later.
+
+        E.g. for an operation which completes in a callback.
+        """
+        return Span(name, self.trace_id, self.current_id, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Time a block as a child of the innermost running span."""
+        span = Span(name, self.trace_id, self.current_id, attributes)
+        with self._lock:
+            self._stack.append(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.set(error=repr(error))
+            raise
+        finally:
+            span.finish()
+            with self._lock:
+                self._stack.remove(span)
+                self._finished.append(span)
+
+    def add(self, span: Span):
+        """Add a span which was timed separately, e.g. in a callback."""
+        with self._lock:
+            self._finished.append(span)
+
+    def pop_finished(self) -> List[Span]:
+        """Return the finished spans which weren't returned before."""
+        with self._lock:
+            spans, self._finished = self._finished, []
+        return spans
+
+
+@contextmanager
+def span(trace: Optional[Trace], name: str, **attributes: Any) -> Iterator[Span]:
+    """Time a block as a span of a trace, if there is one.
+
+    Without a trace, the span isn't recorded.
+    """
+    if trace is None:
+        yield Span(name, "0" * 32, attributes=attributes)
+    else:
+        with trace.span(name, **attributes) as span_:
+            yield span_
+
+
+class SpanFileExporter:
+    """Appends spans to a file, a line in the OTLP/JSON format per export.
+
+    The file can be read by the OpenTelemetry collector, e.g. with its
+    `otlpjsonfile` receiver.
+
+    Args:
+        path: The file to append to.
+        service_name: The name of the service which created the spans.
+    """
+
+    def __init__(self, path: Path, service_name: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]):
+        if not spans:
+            return
+        line = json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [
+                                {
+                                    "key": "service.name",
+                                    "value": {"stringValue": self.service_name},
+                                }
+                            ]
+                        },
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": __name__},
+                                "spans": [span.to_otlp() for span in spans],
+                            }
+                        ],
+                    }
+                ]
+            },
+            separators=(",", ":"),
+        )
+        with self._lock, self.path.open("a") as file:
+            file.write(line + "\n")
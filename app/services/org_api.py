@@ -1,3 +1,7 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Dict, Optional
+
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
@@ -66,3 +70,34 @@ class OrgApiClient:
             raise OrgApiError(f"Could not fetch the label for CP ID '{cp_id}': {e}")
         self.labels[cp_id] = label
         return label
+
+
+class AsyncOrgApiClient:
+    """Looks up the labels from a coroutine.
+
+    The lookups run on the threads of an executor, as the client uses
+    requests. Concurrent lookups of the same CP share one request.
+
+    Args:
+        client: The client doing the lookups and caching the labels.
+        executor: The executor of the lookups, the default one if None.
+    """
+
+    def __init__(self, client: OrgApiClient, executor: Optional[Executor] = None):
+        self.client = client
+        self.executor = executor
+        self._pending: Dict[str, "asyncio.Future[str]"] = {}
+
+    async def get_label(self, cp_id: str) -> str:
+        """Retrieve the label of the CP, see `OrgApiClient.get_label`."""
+        if cp_id in self.client.labels:
+            return self.client.labels[cp_id]
+
+        future = self._pending.get(cp_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, self.client.get_label, cp_id)
+            self._pending[cp_id] = future
+            future.add_done_callback(lambda _: self._pending.pop(cp_id, None))
+        # A cancelled waiter doesn't cancel the lookup of the others
+        return await asyncio.shield(future)
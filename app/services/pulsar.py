@@ -1,13 +1,36 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
+import functools
+import threading
+from typing import Callable, List, Optional
+
 import pulsar
 
 from viaa.configuration import ConfigParser
 from cloudevents.events import Event, CEMessageMode, PulsarBinding
 
+from app.helpers.tracing import TRACEPARENT_HEADER
+
 PRODUCER_TOPIC = "be.meemoo.sipin.sip.create"
 
+COMPRESSION_TYPES = {
+    "none": pulsar.CompressionType.NONE,
+    "lz4": pulsar.CompressionType.LZ4,
+    "zlib": pulsar.CompressionType.ZLib,
+    "zstd": pulsar.CompressionType.ZSTD,
+    "snappy": pulsar.CompressionType.SNAPPY,
+}
+
+
+class PulsarDeliveryError(Exception):
+    """Raised when the broker didn't persist a message."""
+
+    def __init__(self, result):
+        super().__init__(f"Pulsar delivery failed: {result}")
+        self.result = result
+
 
 class PulsarClient:
     def __init__(self):
@@ -16,21 +39,150 @@ class PulsarClient:
         self.client = pulsar.Client(
             f'pulsar://{self.pulsar_config["host"]}:{self.pulsar_config["port"]}'
         )
-        self.producer = self.client.create_producer(PRODUCER_TOPIC)
+        # Send without waiting for the broker, acknowledging in the callback
+        self.async_send = bool(self.pulsar_config.get("async_send", False))
+        self.producer = self.client.create_producer(
+            PRODUCER_TOPIC,
+            batching_enabled=bool(self.pulsar_config.get("batching", False)),
+            batching_max_publish_delay_ms=int(
+                self.pulsar_config.get("batching_max_publish_delay_ms", 10)
+            ),
+            compression_type=COMPRESSION_TYPES[
+                self.pulsar_config.get("compression", "none").lower()
+            ],
+            # A send which isn't persisted in time fails in its callback
+            send_timeout_millis=int(
+                float(self.pulsar_config.get("send_timeout", 30)) * 1000
+            ),
+            # Fail instead of blocking the caller when the broker is slow,
+            # the event is retried later
+            block_if_queue_full=False,
+        )
+
+    def to_message(self, event: Event, traceparent: Optional[str] = None) -> dict:
+        """Convert a cloudevent to the arguments of a Pulsar send.
+
+        Args:
+            event: The cloudevent.
+            traceparent: The trace context of the job, added to the properties
+                so the consumers can continue its trace.
 
-    def produce_event(self, event: Event):
+        Returns:
+            The content, properties and event timestamp.
+        """
+        msg = PulsarBinding.to_protocol(event, CEMessageMode.STRUCTURED)
+        properties = dict(msg.attributes)
+        if traceparent:
+            properties[TRACEPARENT_HEADER] = traceparent
+        return {
+            "content": msg.data,
+            "properties": properties,
+            "event_timestamp": event.get_event_time_as_int(),
+        }
+
+    def produce_event(self, event: Event, traceparent: Optional[str] = None):
         """Produce a cloudevent on a topic
         Args:
             event: The cloudevent to send to the topic.
+            traceparent: The trace context of the job, see `to_message`.
         """
 
-        msg = PulsarBinding.to_protocol(event, CEMessageMode.STRUCTURED)
-        self.producer.send(
-            msg.data,
-            properties=msg.attributes,
-            event_timestamp=event.get_event_time_as_int(),
+        self.producer.send(**self.to_message(event, traceparent))
+
+    def produce_event_async(
+        self,
+        event: Event,
+        callback: Callable[[Optional[Exception]], None],
+        traceparent: Optional[str] = None,
+    ):
+        """Produce a cloudevent on a topic without waiting for the broker.
+
+        The messages are sent in order, batched and compressed if configured.
+        The callback is called on a thread of the Pulsar client.
+
+        Args:
+            event: The cloudevent to send to the topic.
+            callback: Called with None once the broker persisted the event, or
+                with the error if it didn't.
+            traceparent: The trace context of the job, see `to_message`.
+        """
+
+        def delivered(result, msg_id):
+            if result == pulsar.Result.Ok:
+                callback(None)
+            else:
+                callback(PulsarDeliveryError(result))
+
+        self.producer.send_async(
+            callback=delivered, **self.to_message(event, traceparent)
         )
 
+    async def produce_event_aio(self, event: Event, traceparent: Optional[str] = None):
+        """Produce a cloudevent on a topic, from a coroutine.
+
+        Awaits the broker without holding a thread.
+
+        Args:
+            event: The cloudevent to send to the topic.
+            traceparent: The trace context of the job, see `to_message`.
+
+        Raises:
+            PulsarDeliveryError: When the broker didn't persist the event.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(error: Optional[Exception]):
+            if future.cancelled():
+                return
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+        def delivered(error: Optional[Exception]):
+            loop.call_soon_threadsafe(resolve, error)
+
+        self.produce_event_async(event, delivered, traceparent)
+        await future
+
+    def produce_messages(self, messages: List[dict]) -> List[Optional[Exception]]:
+        """Produce a batch of messages and wait until the broker persisted them.
+
+        A message is only failed by its callback, so it isn't retried while
+        its first send may still succeed. The send timeout of the producer
+        bounds the wait.
+
+        Args:
+            messages: The messages, see `to_message`.
+
+        Returns:
+            Per message, None if it was sent or the error otherwise.
+        """
+        results: List[Optional[Exception]] = [None] * len(messages)
+        done = threading.Semaphore(0)
+        pending = 0
+
+        def delivered(index, result, msg_id):
+            if result != pulsar.Result.Ok:
+                results[index] = PulsarDeliveryError(result)
+            done.release()
+
+        for index, message in enumerate(messages):
+            try:
+                self.producer.send_async(
+                    callback=functools.partial(delivered, index), **message
+                )
+            except Exception as error:
+                # Not sent, e.g. the producer is closed
+                results[index] = error
+                continue
+            pending += 1
+        for _ in range(pending):
+            done.acquire()
+        return results
+
     def close(self):
-        """Close the open producers"""
+        """Close the open producers, after sending the pending messages"""
+        self.producer.flush()
         self.producer.close()
@@ -1,11 +1,94 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import copy
+import functools
+import random
 import time
+from typing import Dict, List, Optional
 
 from viaa.configuration import ConfigParser
 from viaa.observability import logging
 
 import pika
+from pika.adapters.blocking_connection import BlockingChannel
+
+from app.helpers.retry import RetryTopology
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter.
+
+    The jitter spreads the reconnects of the workers after a broker restart.
+
+    Args:
+        attempt: The number of the attempt, starting at 0.
+        base: The maximum delay of the first attempt.
+        cap: The maximum delay.
+
+    Returns:
+        The seconds to wait.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def create_retry_topology(rabbit_config: dict, queue: str) -> Optional[RetryTopology]:
+    """Return the retry topology of a queue, None if retrying is disabled."""
+    retry_config = rabbit_config.get("retry") or {}
+    if not retry_config.get("enabled"):
+        return None
+    return RetryTopology(
+        queue,
+        max_attempts=int(retry_config.get("max_attempts", 5)),
+        base_delay=float(retry_config.get("base_delay", 30)),
+        max_delay=float(retry_config.get("max_delay", 3600)),
+    )
+
+
+class ConsumerQueue:
+    """Class representing a queue, consumed on its own channel.
+
+    Args:
+        name: The name of the queue.
+        prefetch_count: The prefetch count of its channel.
+        weight: The share of the workers for its jobs.
+        max_concurrency: The maximum amount of its jobs running at once,
+            unlimited if None.
+        retry_topology: Its retry queues, None if retrying is disabled.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        prefetch_count: int,
+        weight: float = 1,
+        max_concurrency: Optional[int] = None,
+        retry_topology: Optional[RetryTopology] = None,
+    ):
+        self.name = name
+        self.prefetch_count = prefetch_count
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.retry_topology = retry_topology
+
+
+def consumer_queues(rabbit_config: dict) -> List[ConsumerQueue]:
+    """Return the main queue and the additional queues to consume."""
+    queues = [
+        {**rabbit_config, "name": rabbit_config["queue"]},
+        *(rabbit_config.get("queues") or []),
+    ]
+    return [
+        ConsumerQueue(
+            queue["name"],
+            int(queue.get("prefetch_count") or rabbit_config["prefetch_count"]),
+            weight=float(queue.get("weight", 1)),
+            max_concurrency=(
+                int(queue["max_concurrency"]) if queue.get("max_concurrency") else None
+            ),
+            retry_topology=create_retry_topology(rabbit_config, queue["name"]),
+        )
+        for queue in queues
+    ]
 
 
 class RabbitClient:
@@ -18,50 +101,143 @@ class RabbitClient:
         self.credentials = pika.PlainCredentials(
             self.rabbit_config["username"], self.rabbit_config["password"]
         )
+        self.parameters = pika.ConnectionParameters(
+            host=self.rabbit_config["host"],
+            port=self.rabbit_config["port"],
+            credentials=self.credentials,
+        )
+        self.reconnect_base_delay = float(
+            self.rabbit_config.get("reconnect_base_delay", 1)
+        )
+        self.reconnect_max_delay = float(
+            self.rabbit_config.get("reconnect_max_delay", 60)
+        )
+
+        self.connection = pika.BlockingConnection(self.parameters)
+
+        # The queues to consume, each on its own channel
+        self.queues = consumer_queues(self.rabbit_config)
+        self.channels: Dict[str, BlockingChannel] = {}
 
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=self.rabbit_config["host"],
-                port=self.rabbit_config["port"],
-                credentials=self.credentials,
+    def reconnect(self):
+        """Rebuild the connection, with exponential backoff and jitter.
+
+        The channels of the old connection are gone, the broker redelivers
+        their unacked messages on the new connection.
+        """
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+        attempt = 0
+        while not self.stopped:
+            delay = backoff_delay(
+                attempt, self.reconnect_base_delay, self.reconnect_max_delay
             )
+            self.log.warning(f"RMQBridge reconnecting in {delay:.1f}s...")
+            time.sleep(delay)
+            try:
+                self.connection = pika.BlockingConnection(self.parameters)
+                self.log.info("RMQBridge reconnected.")
+                return
+            except pika.exceptions.AMQPConnectionError as error:
+                self.log.warning(f"RMQBridge reconnect failed: {error!r}")
+                attempt += 1
+
+    @staticmethod
+    def declare_retry_queues(channel, retry_topology: RetryTopology):
+        for name, arguments in retry_topology.retry_queues().items():
+            channel.queue_declare(name, durable=True, arguments=arguments)
+        channel.queue_declare(retry_topology.parking_queue, durable=True)
+
+    @staticmethod
+    def retry(channel, retry_topology: RetryTopology, properties, body) -> str:
+        """Publish a failed message to its retry or parking queue.
+
+        Called on the thread of the connection, before acking the message.
+        The properties of the message are kept, besides its headers and its
+        delivery mode. The user ID is dropped, the broker only accepts the
+        user of the connection.
+
+        Returns:
+            The name of the queue.
+        """
+        queue, headers = retry_topology.route(properties.headers)
+        retry_properties = copy.copy(properties)
+        retry_properties.headers = headers
+        retry_properties.delivery_mode = 2
+        retry_properties.user_id = None
+        channel.basic_publish(
+            exchange="",
+            routing_key=queue,
+            body=body,
+            properties=retry_properties,
         )
+        return queue
+
+    def _open_channels(self, on_message_callback):
+        # Closing the remaining channels of a failed attempt, so their queues
+        # aren't consumed twice
+        for channel in self.channels.values():
+            if channel.is_open:
+                channel.close()
+        self.channels = {}
+        for queue in self.queues:
+            channel = self.connection.channel()
 
-        self.prefetch_count = int(self.rabbit_config["prefetch_count"])
+            if queue.retry_topology:
+                self.declare_retry_queues(channel, queue.retry_topology)
 
-    def listen(self, on_message_callback, queue=None):
-        if queue is None:
-            queue = self.rabbit_config["queue"]
+            channel.basic_qos(prefetch_count=queue.prefetch_count, global_qos=False)
 
+            channel.basic_consume(
+                queue=queue.name,
+                on_message_callback=functools.partial(on_message_callback, queue),
+            )
+            self.channels[queue.name] = channel
+
+    def listen(self, on_message_callback):
+        """Consume the queues until stopped.
+
+        Args:
+            on_message_callback: Called with the consumer queue, the channel,
+                the method, the properties and the body of a delivery.
+        """
         try:
             while not self.stopped:
                 try:
-                    self.channel = self.connection.channel()
-
-                    self.channel.basic_qos(
-                        prefetch_count=self.prefetch_count, global_qos=False
-                    )
-
-                    self.channel.basic_consume(
-                        queue=queue, on_message_callback=on_message_callback
-                    )
-
-                    self.channel.start_consuming()
-                except pika.exceptions.StreamLostError:
-                    self.log.warning("RMQBridge lost connection, reconnecting...")
-                    time.sleep(3)
-                except pika.exceptions.ChannelWrongStateError:
-                    self.log.warning(
-                        "RMQBridge wrong state in channel, reconnecting..."
-                    )
-                    time.sleep(3)
-                except pika.exceptions.AMQPHeartbeatTimeout:
-                    self.log.warning("RMQBridge heartbeat timed out, reconnecting...")
-                    time.sleep(3)
+                    self._open_channels(on_message_callback)
+
+                    # Dispatches the deliveries of all the channels
+                    while not self.stopped:
+                        if not all(c.is_open for c in self.channels.values()):
+                            raise pika.exceptions.ChannelWrongStateError(
+                                "A consumer channel is closed."
+                            )
+                        self.connection.process_data_events(time_limit=1)
+                except pika.exceptions.AMQPConnectionError as error:
+                    # E.g. a lost stream, a heartbeat timeout or a broker
+                    # restart. The connection can't be used anymore.
+                    self.log.warning(f"RMQBridge lost connection: {error!r}")
+                    self.reconnect()
+                except (
+                    pika.exceptions.ChannelWrongStateError,
+                    pika.exceptions.ChannelClosed,
+                ) as error:
+                    self.log.warning(f"RMQBridge lost channel: {error!r}")
+                    if self.connection.is_open:
+                        time.sleep(self.reconnect_base_delay)
+                    else:
+                        self.reconnect()
 
         except KeyboardInterrupt:
             self.stop_consuming()
 
     def stop_consuming(self):
         self.stopped = True
-        self.channel.stop_consuming()
+        for channel in self.channels.values():
+            # The channels are already gone while reconnecting
+            if channel.is_open:
+                channel.stop_consuming()
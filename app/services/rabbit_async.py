@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import functools
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aio_pika
+from viaa.configuration import ConfigParser
+from viaa.observability import logging
+
+from app.services.rabbit import ConsumerQueue, consumer_queues
+
+
+class JitteredRobustConnection(aio_pika.RobustConnection):
+    """Robust connection waiting a jittered delay before reconnecting.
+
+    With a fixed reconnect interval, all the replicas reconnect in lockstep
+    after a broker restart. The delay is drawn with full jitter, as
+    `backoff_delay` does, from a window which grows with the duration of the
+    outage, from the reconnect interval up to the maximum.
+    """
+
+    KWARGS_TYPES = aio_pika.RobustConnection.KWARGS_TYPES + (
+        ("max_reconnect_interval", float, "60"),
+    )
+
+    def __init__(self, url, loop=None, **kwargs):
+        super().__init__(url, loop=loop, **kwargs)
+        self.max_reconnect_interval: float = self.kwargs.pop("max_reconnect_interval")
+        # When the connection was lost, None while connected
+        self.outage_started: Optional[float] = None
+
+    @property
+    def reconnect_interval(self) -> float:
+        now = time.monotonic()
+        if self.outage_started is None:
+            self.outage_started = now
+        window = max(self.base_reconnect_interval, now - self.outage_started)
+        return random.uniform(0, min(window, self.max_reconnect_interval))
+
+    @reconnect_interval.setter
+    def reconnect_interval(self, value: float):
+        self.base_reconnect_interval = value
+
+    async def connect(self, timeout=None):
+        await super().connect(timeout)
+        self.outage_started = None
+
+
+class AsyncRabbitClient:
+    """RabbitMQ client for the asyncio mode.
+
+    The connection is robust: after a lost connection it reconnects and
+    restores the channels, their prefetch counts and the consumers. The
+    broker redelivers the unacked messages on the new channels.
+    """
+
+    def __init__(self):
+        configParser = ConfigParser()
+        self.log = logging.get_logger(__name__, config=configParser)
+        self.rabbit_config = configParser.app_cfg["rabbitmq"]
+        self.reconnect_base_delay = float(
+            self.rabbit_config.get("reconnect_base_delay", 1)
+        )
+        self.reconnect_max_delay = float(
+            self.rabbit_config.get("reconnect_max_delay", 60)
+        )
+        # The queues to consume, each on its own channel
+        self.queues = consumer_queues(self.rabbit_config)
+        self.connection: Optional[aio_pika.RobustConnection] = None
+        self.channels: Dict[str, aio_pika.RobustChannel] = {}
+        self.consumers: List[Tuple[aio_pika.RobustQueue, str]] = []
+
+    async def connect(self):
+        self.connection = await aio_pika.connect_robust(
+            host=self.rabbit_config["host"],
+            port=int(self.rabbit_config["port"]),
+            login=self.rabbit_config["username"],
+            password=self.rabbit_config["password"],
+            connection_class=JitteredRobustConnection,
+            reconnect_interval=self.reconnect_base_delay,
+            max_reconnect_interval=self.reconnect_max_delay,
+        )
+        for queue in self.queues:
+            channel = await self.connection.channel()
+            await channel.set_qos(prefetch_count=queue.prefetch_count)
+            if queue.retry_topology:
+                for name, arguments in queue.retry_topology.retry_queues().items():
+                    await channel.declare_queue(name, durable=True, arguments=arguments)
+                await channel.declare_queue(
+                    queue.retry_topology.parking_queue, durable=True
+                )
+            self.channels[queue.name] = channel
+
+    async def listen(
+        self,
+        on_message_callback: Callable[
+            [ConsumerQueue, aio_pika.IncomingMessage], Awaitable[None]
+        ],
+    ):
+        """Start consuming, the callback is called on the event loop.
+
+        Args:
+            on_message_callback: Called with the consumer queue and the
+                message of a delivery.
+        """
+        for queue in self.queues:
+            amqp_queue = await self.channels[queue.name].get_queue(
+                queue.name, ensure=True
+            )
+            consumer_tag = await amqp_queue.consume(
+                functools.partial(on_message_callback, queue)
+            )
+            self.consumers.append((amqp_queue, consumer_tag))
+
+    async def set_prefetch_counts(self):
+        """Apply the prefetch counts of the queues to their channels."""
+        for queue in self.queues:
+            await self.channels[queue.name].set_qos(prefetch_count=queue.prefetch_count)
+
+    async def retry(
+        self, queue: ConsumerQueue, message: aio_pika.IncomingMessage
+    ) -> str:
+        """Publish a failed message to its retry or parking queue.
+
+        The properties are kept as `RabbitClient.retry` does.
+
+        Returns:
+            The name of the queue.
+        """
+        routing_key, headers = queue.retry_topology.route(message.headers)
+        await self.channels[queue.name].default_exchange.publish(
+            aio_pika.Message(
+                message.body,
+                headers=headers,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                priority=message.priority,
+                correlation_id=message.correlation_id,
+                reply_to=message.reply_to,
+                expiration=message.expiration,
+                message_id=message.message_id,
+                timestamp=message.timestamp,
+                type=message.type,
+                app_id=message.app_id,
+            ),
+            routing_key=routing_key,
+        )
+        return routing_key
+
+    async def stop_consuming(self):
+        consumers, self.consumers = self.consumers, []
+        for amqp_queue, consumer_tag in consumers:
+            await amqp_queue.cancel(consumer_tag)
+
+    async def close(self):
+        if self.connection:
+            await self.connection.close()
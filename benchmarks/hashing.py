@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark the hashing engine on a given location.
+
+Run it on every storage type the service reads from, e.g. the local SSD and
+the NFS watchfolder:
+
+    python -m benchmarks.hashing /mnt/ssd/bench /mnt/nfs/watchfolder/bench
+
+A file of `--size` bytes is created in each directory, hashed with every
+combination of block size and read mode, and removed afterwards. An existing
+file can be passed instead of a directory. With `--cold` the pages of the
+file are dropped from the page cache before every run.
+"""
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from app.helpers.fixity import HashEngine
+
+MIB = 1024 * 1024
+
+
+def _create_file(directory: Path, size: int) -> Path:
+    file = directory.joinpath(".hashing_benchmark.bin")
+    block = os.urandom(16 * MIB)
+    with open(file, "wb") as f:
+        written = 0
+        while written < size:
+            written += f.write(block[: size - written])
+        f.flush()
+        os.fsync(f.fileno())
+    return file
+
+
+def _drop_cache(file: Path):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def benchmark(
+    file: Path,
+    algorithms: List[str],
+    block_sizes: List[int],
+    modes: List[str],
+    cold: bool,
+) -> List[Dict]:
+    size = file.stat().st_size
+    results = []
+    for mode in modes:
+        for block_size in block_sizes:
+            engine = HashEngine(block_size=block_size, use_mmap=mode == "mmap")
+            if cold:
+                _drop_cache(file)
+            start = time.perf_counter()
+            engine.calculate_digests(file, algorithms)
+            duration = time.perf_counter() - start
+            results.append(
+                {
+                    "path": str(file),
+                    "mode": mode,
+                    "block_size": engine.block_size,
+                    "algorithms": algorithms,
+                    "bytes": size,
+                    "seconds": round(duration, 3),
+                    "gb_per_second": round(size / duration / 1e9, 3),
+                }
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", type=Path)
+    parser.add_argument("--size", type=int, default=2048, help="File size in MiB.")
+    parser.add_argument("--block-sizes", default="1,4,8,16", help="Block sizes in MiB.")
+    parser.add_argument("--algorithms", default="md5,sha256")
+    parser.add_argument("--modes", default="readinto,mmap")
+    parser.add_argument("--cold", action="store_true")
+    parser.add_argument("--json", type=Path, help="Write the results to a file.")
+    args = parser.parse_args()
+
+    results = []
+    for path in args.paths:
+        created = path.is_dir()
+        file = _create_file(path, args.size * MIB) if created else path
+        try:
+            results += benchmark(
+                file,
+                args.algorithms.split(","),
+                [int(size) * MIB for size in args.block_sizes.split(",")],
+                args.modes.split(","),
+                args.cold,
+            )
+        finally:
+            if created:
+                file.unlink()
+
+    for result in results:
+        print(
+            f"{result['path']:<50} {result['mode']:<9} "
+            f"{result['block_size'] // MIB:>3} MiB  "
+            f"{result['gb_per_second']:>7.3f} GB/s"
+        )
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark creating a SIP bag end to end.
+
+Generates an essence and sidecar pair per extension of
+`EXTENSION_MIMETYPE_MAP`, size and kind, and creates its SIP bag with a stub
+of the org API:
+
+    python -m benchmarks.sip_build /mnt/ssd/bench --sizes 1K,1M,1G --json a.json
+
+The essences are sparse, which is cheap to create up to e.g. 50G, or random.
+Every SIP is created in a separate process, so the peak RSS is its own. Per
+SIP, the wall time, the CPU time, the bytes read and written, the peak RSS
+and the seconds and GB/s per stage are reported. Compare the results of two
+commits with `--compare`:
+
+    python -m benchmarks.sip_build /mnt/ssd/bench --json b.json --compare a.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.helpers.bag import EXTENSION_MIMETYPE_MAP, Bag
+from app.helpers.events import WatchfolderMessage
+from app.helpers.sidecar import Sidecar
+from app.helpers.storage import StagingStrategy
+
+KIB = 1024
+MIB = 1024 * KIB
+UNITS = {"K": KIB, "M": MIB, "G": 1024 * MIB}
+
+SIDECAR = """<?xml version="1.0" encoding="utf-8"?>
+<VIAA>
+    <CP>Benchmark</CP>
+    <CP_id>OR-benchmark</CP_id>
+    <dc_identifier_localid>{name}</dc_identifier_localid>
+    <dc_title>{name}</dc_title>
+    <dcterms_created>2022-01-28</dcterms_created>
+    <dc_description>Synthetic essence of {size} bytes</dc_description>
+</VIAA>
+"""
+
+
+class StubOrgApiClient:
+    """Answers the label lookups of the org API without a request."""
+
+    def get_label(self, cp_id: str) -> str:
+        return "Benchmark"
+
+
+def parse_size(size: str) -> int:
+    """Parse a size such as 512, 1K, 16M or 50G, in bytes."""
+    size = size.strip().upper().rstrip("B").rstrip("I")
+    if size[-1:] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def _create_essence(path: Path, size: int, kind: str):
+    with open(path, "wb") as f:
+        if kind == "sparse":
+            f.truncate(size)
+            return
+        block = os.urandom(min(size, 16 * MIB))
+        written = 0
+        while written < size:
+            written += f.write(block[: size - written])
+
+
+def _create_pair(folder: Path, name: str, extension: str, size: int, kind: str):
+    """Create an essence and its sidecar and return their watchfolder message."""
+    folder.mkdir(exist_ok=True, parents=True)
+    _create_essence(folder.joinpath(f"{name}{extension}"), size, kind)
+    # Not named after the essence, the essence may be an XML file too
+    sidecar_name = f"{name}.sidecar.xml"
+    folder.joinpath(sidecar_name).write_text(SIDECAR.format(name=name, size=size))
+    return json.dumps(
+        {
+            "cp_name": "Benchmark",
+            "flow_id": "OR-benchmark",
+            "sip_package": [
+                {
+                    "file_name": f"{name}{extension}",
+                    "file_path": str(folder),
+                    "file_type": "essence",
+                },
+                {
+                    "file_name": sidecar_name,
+                    "file_path": str(folder),
+                    "file_type": "sidecar",
+                },
+            ],
+        }
+    ).encode()
+
+
+def _io_counters() -> Dict[str, int]:
+    """Return the I/O of the process: through the syscalls and on the storage."""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {
+        "read_bytes": int(counters["rchar"]),
+        "write_bytes": int(counters["wchar"]),
+        "storage_read_bytes": int(counters["read_bytes"]),
+        "storage_write_bytes": int(counters["write_bytes"]),
+    }
+
+
+def run_case(
+    message: bytes,
+    directory: str,
+    bag_config: dict,
+    staging_strategy: str,
+) -> dict:
+    """Create a SIP bag and measure it, in a process of its own."""
+    watchfolder_message = WatchfolderMessage(message)
+    sidecar = Sidecar(watchfolder_message.get_xml_path())
+    storage_config = {
+        "staging_dir": str(Path(directory, "staging")),
+        "output_dir": str(Path(directory, "output")),
+        "staging_strategy": staging_strategy,
+    }
+    bag = Bag(
+        watchfolder_message,
+        sidecar,
+        StubOrgApiClient(),
+        bag_config,
+        storage_config,
+    )
+
+    io_before = _io_counters()
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+    bag_path, _ = bag.create_sip_bag()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_before
+    io_after = _io_counters()
+
+    # Bytes per stage, the stages without are only timed. A copied essence
+    # is hashed in the same read, a hardlinked one is only read to hash it.
+    essence_bytes = bag.io_stats["essence"].bytes
+    stage_bytes = {"hashing": essence_bytes, "zip": bag_path.stat().st_size}
+    if bag.staging_strategy is not StagingStrategy.HARDLINK:
+        stage_bytes["essence_copy"] = essence_bytes
+    stages = {}
+    for stage, seconds in bag.stage_durations.items():
+        stages[stage] = {"seconds": round(seconds, 6)}
+        size = stage_bytes.get(stage)
+        if size and seconds > 0:
+            stages[stage]["bytes"] = size
+            stages[stage]["gb_per_second"] = round(size / seconds / 1e9, 3)
+    bag_path.unlink()
+
+    # Kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= KIB
+    return {
+        "staging_strategy": bag.staging_strategy.value,
+        "fixity_cache_hit": bag.fixity_cache_hit,
+        "wall_seconds": round(wall, 6),
+        "cpu_seconds": round(cpu, 6),
+        "peak_rss_bytes": peak_rss,
+        **{key: io_after[key] - io_before[key] for key in io_after},
+        "stages": stages,
+    }
+
+
+def benchmark(
+    directory: Path,
+    extensions: List[str],
+    sizes: List[int],
+    kinds: List[str],
+    staging_strategies: List[str],
+    bag_config: dict,
+    repeat: int,
+) -> List[dict]:
+    watchfolder = directory.joinpath("watchfolder")
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for extension, size, kind in itertools.product(extensions, sizes, kinds):
+        name = f"bench_{kind}_{size}{extension.replace('.', '_')}"
+        message = _create_pair(watchfolder, name, extension, size, kind)
+        try:
+            for staging_strategy, run in itertools.product(
+                staging_strategies, range(repeat)
+            ):
+                case = {
+                    "extension": extension,
+                    "mimetype": EXTENSION_MIMETYPE_MAP[extension],
+                    "size": size,
+                    "kind": kind,
+                    "run": run,
+                }
+                try:
+                    with context.Pool(1) as pool:
+                        result = pool.apply(
+                            run_case,
+                            (message, str(directory), bag_config, staging_strategy),
+                        )
+                except Exception as error:
+                    # E.g. a mimetype without a SIP type, the other cases go on
+                    result = {
+                        "staging_strategy": staging_strategy,
+                        "error": repr(error),
+                    }
+                    shutil.rmtree(directory.joinpath("staging"), ignore_errors=True)
+                results.append({**case, **result})
+                _print_result(results[-1])
+        finally:
+            for file in watchfolder.glob(f"{name}.*"):
+                file.unlink()
+    return results
+
+
+def _case_key(result: dict) -> tuple:
+    return (
+        result["extension"],
+        result["size"],
+        result["kind"],
+        result["staging_strategy"],
+        result["run"],
+    )
+
+
+def _print_result(result: dict):
+    if "error" in result:
+        print(
+            f"{result['extension']:<6} {result['kind']:<7} {result['size']:>14} B "
+            f"{result['staging_strategy']:<9} failed: {result['error']}"
+        )
+        return
+    gb_per_second = " ".join(
+        f"{stage}={stats['gb_per_second']}"
+        for stage, stats in result["stages"].items()
+        if "gb_per_second" in stats
+    )
+    print(
+        f"{result['extension']:<6} {result['kind']:<7} {result['size']:>14} B "
+        f"{result['staging_strategy']:<9} {result['wall_seconds']:>9.3f} s "
+        f"cpu {result['cpu_seconds']:>9.3f} s "
+        f"rss {result['peak_rss_bytes'] // MIB:>6} MiB  GB/s {gb_per_second}"
+    )
+
+
+def compare(results: List[dict], baseline: List[dict]):
+    """Print the change of the wall time per case, against a baseline."""
+    baseline_by_case = {_case_key(result): result for result in baseline}
+    for result in results:
+        before = baseline_by_case.get(_case_key(result))
+        if "error" in result or not before or not before.get("wall_seconds"):
+            continue
+        change = result["wall_seconds"] / before["wall_seconds"] - 1
+        print(
+            f"{result['extension']:<6} {result['kind']:<7} {result['size']:>14} B "
+            f"{result['staging_strategy']:<9} {before['wall_seconds']:>9.3f} s -> "
+            f"{result['wall_seconds']:>9.3f} s ({change:+.1%})"
+        )
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--extensions", default=",".join(EXTENSION_MIMETYPE_MAP))
+    parser.add_argument("--sizes", default="1K,1M,64M", help="e.g. 1K,1M,1G,50G")
+    parser.add_argument("--kinds", default="sparse,random")
+    parser.add_argument(
+        "--staging-strategies", default="auto", help="auto, copy or hardlink."
+    )
+    parser.add_argument("--algorithms", default="md5,sha256")
+    parser.add_argument("--checksum-workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="Write the results to a file.")
+    parser.add_argument("--compare", type=Path, help="Results of an earlier run.")
+    args = parser.parse_args()
+
+    directory = args.directory.joinpath(".sip_build_benchmark")
+    try:
+        results = benchmark(
+            directory,
+            args.extensions.split(","),
+            [parse_size(size) for size in args.sizes.split(",")],
+            args.kinds.split(","),
+            args.staging_strategies.split(","),
+            {
+                "fixity_algorithms": args.algorithms.split(","),
+                "checksum_workers": args.checksum_workers,
+            },
+            args.repeat,
+        )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.json:
+        args.json.write_text(
+            json.dumps(
+                {
+                    "commit": _commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text())["results"])
+
+
+if __name__ == "__main__":
+    main()
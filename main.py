@@ -2,9 +2,16 @@
 # -*- coding: utf-8 -*-
 from signal import signal, SIGTERM
 
+from viaa.configuration import ConfigParser
+
 from app.app import EventListener
 
 if __name__ == "__main__":
-    event_listener = EventListener()
+    if ConfigParser().app_cfg.get("mode") == "asyncio":
+        from app.async_app import AsyncEventListener
+
+        event_listener = AsyncEventListener()
+    else:
+        event_listener = EventListener()
     signal(SIGTERM, event_listener.exit_gracefully)
     event_listener.start()
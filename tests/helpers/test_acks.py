@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+
+from app.helpers.acks import AckCoalescer
+
+
+class FakeConnection:
+    """Runs the thread safe callbacks right away and collects the timers."""
+
+    def __init__(self):
+        self.timers = []
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def call_later(self, delay, callback):
+        self.timers.append(callback)
+
+    def fire_timers(self):
+        timers, self.timers = self.timers, []
+        for callback in timers:
+            callback()
+
+
+class FakeChannel:
+    def __init__(self):
+        self.is_open = True
+        self.sent = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.sent.append(("ack", delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, requeue=False):
+        self.sent.append(("nack", delivery_tag, requeue))
+
+
+@pytest.fixture
+def coalescer():
+    acks = AckCoalescer(FakeConnection(), FakeChannel(), max_delay=0.01)
+    for delivery_tag in range(1, 6):
+        acks.delivered(delivery_tag)
+    return acks
+
+
+def test_multi_ack(coalescer):
+    for delivery_tag in (3, 1, 2):
+        coalescer.ack(delivery_tag)
+    assert coalescer.channel.sent == []
+
+    coalescer.connection.fire_timers()
+    assert coalescer.channel.sent == [("ack", 3, True)]
+
+
+def test_ack_behind_gap(coalescer):
+    coalescer.ack(1)
+    coalescer.ack(3)
+    time.sleep(0.02)
+    coalescer.connection.fire_timers()
+    # 2 is still being processed, 3 is acked on its own
+    assert coalescer.channel.sent == [("ack", 1, True), ("ack", 3, False)]
+
+    coalescer.ack(2)
+    coalescer.ack(4)
+    coalescer.connection.fire_timers()
+    assert coalescer.channel.sent[2:] == [("ack", 4, True)]
+
+
+def test_nack(coalescer):
+    coalescer.ack(1)
+    coalescer.nack(2, requeue=True)
+    coalescer.ack(3)
+    coalescer.connection.fire_timers()
+    # The nack is never part of a multi-ack
+    assert coalescer.channel.sent == [
+        ("ack", 1, True),
+        ("nack", 2, True),
+        ("ack", 3, True),
+    ]
+
+
+def test_max_batch():
+    coalescer = AckCoalescer(FakeConnection(), FakeChannel(), max_batch=2)
+    coalescer.delivered(1)
+    coalescer.delivered(2)
+    coalescer.ack(1)
+    coalescer.ack(2)
+    assert coalescer.channel.sent == [("ack", 2, True)]
+
+
+def test_closed_channel(coalescer):
+    coalescer.channel.is_open = False
+    coalescer.ack(1)
+    coalescer.connection.fire_timers()
+    assert coalescer.channel.sent == []
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+
+import pytest
+
+from app.helpers import admission
+from app.helpers.admission import DiskAdmission
+
+
+@pytest.fixture
+def free(monkeypatch):
+    """Fake the free space of the filesystems."""
+    value = {"bytes": 1000}
+    monkeypatch.setattr(admission, "free_bytes", lambda path: value["bytes"])
+    return value
+
+
+def test_try_reserve(tmp_path, free):
+    disk = DiskAdmission(tmp_path.joinpath("admission.db"), min_free_bytes=100)
+    device = tmp_path.stat().st_dev
+
+    assert disk.try_reserve("job_1", {tmp_path: 500})
+    assert disk.reserved_bytes(device) == 500
+    # Only 1000 - 500 - 100 left
+    assert not disk.try_reserve("job_2", {tmp_path: 401})
+    assert disk.try_reserve("job_2", {tmp_path.joinpath("staging"): 200, tmp_path: 200})
+    assert disk.reserved_bytes(device) == 900
+
+    disk.release("job_1")
+    assert disk.reserved_bytes(device) == 400
+    # Shared between instances
+    assert DiskAdmission(disk.path).reserved_bytes(device) == 400
+
+
+def test_headroom(tmp_path, free):
+    disk = DiskAdmission(tmp_path.joinpath("admission.db"), min_free_bytes=100)
+    assert disk.headroom([tmp_path, tmp_path.joinpath("staging")]) == 900
+
+    disk.try_reserve("job_1", {tmp_path: 500})
+    assert disk.headroom([tmp_path]) == 400
+    free["bytes"] = 200
+    assert disk.headroom([tmp_path]) == 0
+    assert disk.headroom([]) == 0
+
+
+def test_stale_reservation(tmp_path, free):
+    disk = DiskAdmission(tmp_path.joinpath("admission.db"), min_free_bytes=0)
+    assert disk.try_reserve("job_1", {tmp_path: 1000})
+    assert not disk.try_reserve("job_2", {tmp_path: 1})
+
+    # The owner of the first reservation crashed
+    with disk._transaction() as connection:
+        owner = {**admission.owner_info(), "pid": 2 ** 22 + 1, "process": "crashed"}
+        connection.execute("UPDATE reservations SET owner = ?", (json.dumps(owner),))
+    assert disk.try_reserve("job_2", {tmp_path: 1})
+
+
+def test_reserve(tmp_path, free):
+    disk = DiskAdmission(tmp_path.joinpath("admission.db"), min_free_bytes=0)
+    assert not disk.reserve("job", {tmp_path: 2000}, timeout=0.05, interval=0.01)
+
+    stop = threading.Event()
+    stop.set()
+    assert not disk.reserve("job", {tmp_path: 2000}, timeout=10, stop=stop)
+
+    assert disk.reserve("job", {tmp_path: 1000}, timeout=0)
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import json
+import os
 from pathlib import Path
 
 import pytest
 
-from app.helpers.bag import guess_mimetype, calculate_sip_type
+from app.helpers.bag import Bag, guess_mimetype, calculate_sip_type
+from app.helpers.events import WatchfolderMessage
+from app.helpers.fixity_cache import FixityCache
+from app.helpers.sweeper import Reaper
 
 
 @pytest.mark.parametrize(
@@ -70,3 +75,81 @@ def test_calculate_sip_type(mimetype, sip_type):
 def test_calculate_sip_type_other():
     result = calculate_sip_type(None)
     assert result == "OTHER"
+
+
+def _message(flow_id, folder):
+    return WatchfolderMessage(
+        json.dumps(
+            {
+                "cp_name": "CP",
+                "flow_id": flow_id,
+                "sip_package": [
+                    {
+                        "file_name": "video.mxf",
+                        "file_path": str(folder),
+                        "file_type": "essence",
+                    },
+                    {
+                        "file_name": "video.xml",
+                        "file_path": str(folder),
+                        "file_type": "sidecar",
+                    },
+                ],
+            }
+        ).encode("utf-8")
+    )
+
+
+def test_paths_namespaced(tmp_path):
+    storage_config = {
+        "staging_dir": str(tmp_path / "staging"),
+        "output_dir": str(tmp_path / "output"),
+    }
+    first = Bag(_message("flow-a", tmp_path / "a"), None, None, {}, storage_config)
+    second = Bag(_message("flow-b", tmp_path / "b"), None, None, {}, storage_config)
+
+    first_root, first_bag = first._paths()
+    second_root, second_bag = second._paths()
+
+    # Same-named essences of other watchfolders don't share a tree or bag
+    assert first_root != second_root
+    assert first_bag != second_bag
+    assert first_root.parent == second_root.parent == tmp_path / "staging"
+    assert first_bag.parent == second_bag.parent == tmp_path / "output"
+    assert first_root.name.startswith("video_")
+    assert first_bag.name == f"{first_root.name}.bag.zip"
+    # The same for every attempt of the job
+    assert first._paths() == (first_root, first_bag)
+
+
+def test_paths_next_to_essence(tmp_path):
+    bag = Bag(_message("flow-a", tmp_path), None, None)
+
+    assert bag._paths() == (tmp_path / "video", tmp_path / "video.bag.zip")
+
+
+def test_remove_root_deferred_keeps_fixity_cache(tmp_path):
+    tmp_path.joinpath("video.mxf").write_bytes(b"essence")
+    fixity_cache = FixityCache(tmp_path.joinpath("cache.db"))
+    reaper = Reaper()
+    bag = Bag(
+        _message("flow-a", tmp_path),
+        None,
+        None,
+        fixity_cache=fixity_cache,
+        reaper=reaper,
+    )
+    essence_path = tmp_path.joinpath("video.mxf")
+    root_folder, _ = bag._paths()
+    staged_essence_path = bag._staged_essence_path(root_folder)
+    staged_essence_path.parent.mkdir(parents=True)
+    os.link(essence_path, staged_essence_path)
+    fixity_cache.put(essence_path, {"md5": "1"})
+
+    bag._remove_root(root_folder, final=True)
+
+    # The hardlink is removed right away, the rest is left to the reaper
+    assert bag.cleanup_deferred
+    assert not root_folder.exists()
+    assert essence_path.stat().st_nlink == 1
+    assert fixity_cache.get(essence_path, ["md5"]) == {"md5": "1"}
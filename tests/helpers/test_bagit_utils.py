@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+from pathlib import Path
+
+import bagit
+import pytest
+
+from app.helpers.bagit_utils import make_bag
+
+
+def _create_sip(root: Path) -> Path:
+    sip = root.joinpath("sip")
+    sip.joinpath("metadata", "descriptive").mkdir(parents=True)
+    sip.joinpath("representations", "representation_1", "data").mkdir(parents=True)
+    sip.joinpath("mets.xml").write_bytes(b"<mets/>")
+    sip.joinpath("metadata", "descriptive", "dc.xml").write_bytes(b"<dc/>")
+    sip.joinpath("representations", "representation_1", "data", "file.mxf").write_bytes(
+        b"essence" * 1000
+    )
+    return sip
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_make_bag(tmp_path, workers):
+    sip = _create_sip(tmp_path)
+    bag = make_bag(sip, algorithms=["md5", "sha256"], workers=workers)
+
+    assert sip.joinpath("data", "mets.xml").exists()
+    assert sorted(bag.algorithms) == ["md5", "sha256"]
+    assert bag.info["Payload-Oxum"] == "7012.3"
+    assert "data/representations/representation_1/data/file.mxf" in bag.entries
+    # The bag is identical to one created by bagit
+    bag.validate()
+    bagit.Bag(str(sip)).validate()
+
+
+def test_make_bag_known_digests(tmp_path):
+    sip = _create_sip(tmp_path)
+    bag = make_bag(sip, known_digests={"mets.xml": {"md5": "known"}})
+
+    # The known digest is reused instead of reading the file.
+    assert bag.entries["data/mets.xml"]["md5"] == "known"
+    assert (
+        bag.entries["data/metadata/descriptive/dc.xml"]["md5"]
+        == hashlib.md5(b"<dc/>").hexdigest()
+    )
+    with pytest.raises(bagit.BagValidationError):
+        bag.validate()
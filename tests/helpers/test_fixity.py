@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gc
+import hashlib
+import sys
+import zipfile
+import zlib
+
+import pytest
+
+from app.helpers.fixity import (
+    MAX_BLOCK_SIZE,
+    MIN_BLOCK_SIZE,
+    HashEngine,
+    calculate_digests,
+    copy_with_digests,
+    is_manifest_algorithm,
+    new_hasher,
+)
+from app.helpers import fixity, page_cache
+from app.helpers.page_cache import CacheMode, WriteBehind
+from app.helpers.pipeline import PipelineStats, ReadPipeline
+
+DATA = b"essence" * 500_000
+
+
+def test_calculate_digests(tmp_path):
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(DATA)
+    digests = calculate_digests(file, ["md5", "sha256", "crc32"])
+    assert digests == {
+        "md5": hashlib.md5(DATA).hexdigest(),
+        "sha256": hashlib.sha256(DATA).hexdigest(),
+        "crc32": f"{zlib.crc32(DATA):08x}",
+    }
+
+
+def test_copy_with_digests(tmp_path):
+    src = tmp_path.joinpath("src.mxf")
+    src.write_bytes(DATA)
+    src.chmod(0o640)
+    dst = tmp_path.joinpath("dst.mxf")
+    digests = copy_with_digests(src, dst, ["md5", "sha256"])
+    assert dst.read_bytes() == DATA
+    assert dst.stat().st_mode == src.stat().st_mode
+    assert digests["md5"] == hashlib.md5(DATA).hexdigest()
+    assert digests["sha256"] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_new_hasher_unknown():
+    with pytest.raises(ValueError):
+        new_hasher("unknown")
+
+
+@pytest.mark.parametrize(
+    "algorithm,result",
+    [("md5", True), ("sha256", True), ("crc32", False), ("xxh64", False)],
+)
+def test_is_manifest_algorithm(algorithm, result):
+    assert is_manifest_algorithm(algorithm) == result
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_hash_engine(tmp_path, use_mmap):
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(DATA)
+    engine = HashEngine(block_size=MIN_BLOCK_SIZE, use_mmap=use_mmap)
+    assert engine.calculate_digests(file, ["md5"]) == {
+        "md5": hashlib.md5(DATA).hexdigest()
+    }
+    dst = tmp_path.joinpath("dst.mxf")
+    engine.copy_with_digests(file, dst, ["sha256"])
+    assert dst.read_bytes() == DATA
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_hash_engine_empty_file(tmp_path, use_mmap):
+    file = tmp_path.joinpath("empty.mxf")
+    file.touch()
+    engine = HashEngine(use_mmap=use_mmap)
+    assert engine.calculate_digests(file, ["md5"]) == {
+        "md5": hashlib.md5(b"").hexdigest()
+    }
+
+
+def test_hash_engine_mmap_consumer_error(tmp_path, monkeypatch):
+    unraisable = []
+    monkeypatch.setattr(sys, "unraisablehook", unraisable.append)
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(DATA)
+    engine = HashEngine(block_size=MIN_BLOCK_SIZE, use_mmap=True)
+
+    with open(file, "rb") as f:
+        blocks = engine.blocks(f)
+        # The consumer still holds a slice of the block when it fails
+        held = next(blocks)[10:]
+        with pytest.raises(ValueError, match="consumer"):
+            blocks.throw(ValueError("consumer"))
+        blocks.close()
+        gc.collect()
+    assert unraisable == []
+    assert bytes(held[:10]) == DATA[10:20]
+
+
+@pytest.mark.parametrize(
+    "block_size,result",
+    [
+        (4096, MIN_BLOCK_SIZE),
+        (2 * MIN_BLOCK_SIZE, 2 * MIN_BLOCK_SIZE),
+        (2 ** 30, MAX_BLOCK_SIZE),
+    ],
+)
+def test_hash_engine_block_size(block_size, result):
+    assert HashEngine(block_size=block_size).block_size == result
+
+
+def test_hash_engine_read_ahead(tmp_path):
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(DATA)
+    stats = PipelineStats()
+    engine = HashEngine(block_size=MIN_BLOCK_SIZE, read_ahead=3)
+    digests = engine.copy_with_digests(file, tmp_path.joinpath("dst.mxf"), stats=stats)
+    assert digests == {"md5": hashlib.md5(DATA).hexdigest()}
+    assert stats.bytes == len(DATA)
+
+
+def test_hash_engine_read_ahead_threshold(tmp_path, monkeypatch):
+    pipelines = []
+
+    class CountingPipeline(ReadPipeline):
+        def __init__(self, *args):
+            super().__init__(*args)
+            pipelines.append(self)
+
+    monkeypatch.setattr(fixity, "ReadPipeline", CountingPipeline)
+    small = tmp_path.joinpath("small.xml")
+    small.write_bytes(DATA[: 2 * MIN_BLOCK_SIZE])
+    large = tmp_path.joinpath("large.mxf")
+    large.write_bytes(DATA)
+    engine = HashEngine(block_size=MIN_BLOCK_SIZE, read_ahead=3)
+
+    # Not read ahead up to two blocks
+    engine.calculate_digests(small)
+    assert pipelines == []
+    # The pipeline of the thread is reused for the next files
+    for file in (large, small, large):
+        assert engine.calculate_digests(file) == {
+            "md5": hashlib.md5(file.read_bytes()).hexdigest()
+        }
+    assert len(pipelines) == 1
+
+
+def test_hash_engine_write_to_zip(tmp_path):
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(DATA)
+    zip_path = tmp_path.joinpath("bag.zip")
+    engine = HashEngine(read_ahead=2)
+    with zipfile.ZipFile(zip_path, mode="w") as archive:
+        engine.write_to_zip(archive, tmp_path, "folder")
+        engine.write_to_zip(archive, file, "folder/file.mxf")
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.testzip() is None
+        assert archive.read("folder/file.mxf") == DATA
+
+
+def test_hash_engine_write_to_zip_write_behind(tmp_path, monkeypatch):
+    syncs = []
+    monkeypatch.setattr(page_cache.os, "fdatasync", syncs.append)
+    essence = tmp_path.joinpath("essence.mxf")
+    essence.write_bytes(DATA * 2)
+    metadata = tmp_path.joinpath("metadata.xml")
+    metadata.write_bytes(b"<xml/>")
+    engine = HashEngine(block_size=MIN_BLOCK_SIZE, cache_mode=CacheMode.DONTNEED)
+
+    zip_path = tmp_path.joinpath("bag.zip")
+    with zipfile.ZipFile(zip_path, mode="w") as archive:
+        write_behind = WriteBehind(archive.fp, window=len(DATA))
+        for index in range(10):
+            engine.write_to_zip(
+                archive,
+                metadata,
+                f"metadata/{index}.xml",
+                write_behind=write_behind,
+                cache_mode=CacheMode.NORMAL,
+            )
+        # The metadata isn't synced per file
+        assert syncs == []
+        engine.write_to_zip(archive, essence, "essence.mxf", write_behind=write_behind)
+        # Once per window, the rest when the archive is written
+        assert len(syncs) == 1
+        write_behind.flush()
+    assert len(syncs) == 2
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.testzip() is None
+        assert archive.read("essence.mxf") == DATA * 2
+
+
+@pytest.mark.parametrize("cache_mode", list(CacheMode))
+@pytest.mark.parametrize("read_ahead", [0, 2])
+def test_hash_engine_cache_mode(tmp_path, cache_mode, read_ahead):
+    # An unaligned size, so O_DIRECT has to write the tail without it
+    data = DATA + b"tail"
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(data)
+    engine = HashEngine(read_ahead=read_ahead, cache_mode=cache_mode)
+    dst = tmp_path.joinpath("dst.mxf")
+    digests = engine.copy_with_digests(file, dst)
+    assert digests == {"md5": hashlib.md5(data).hexdigest()}
+    assert dst.read_bytes() == data
+
+    zip_path = tmp_path.joinpath("bag.zip")
+    with zipfile.ZipFile(zip_path, mode="w") as archive:
+        engine.write_to_zip(archive, file, "file.mxf")
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.read("file.mxf") == data
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+from app.helpers.fixity_cache import FixityCache, file_key
+
+
+def test_fixity_cache(tmp_path):
+    cache = FixityCache(tmp_path.joinpath("cache.db"))
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(b"essence")
+    assert cache.get(file, ["md5"]) is None
+
+    cache.put(file, {"md5": "1"})
+    cache.put(file, {"sha256": "2"})
+    assert cache.get(file, ["md5"]) == {"md5": "1"}
+    assert cache.get(file, ["md5", "sha256"]) == {"md5": "1", "sha256": "2"}
+    assert cache.get(file, ["md5", "sha512"]) is None
+
+    # Shared between instances
+    assert FixityCache(cache.path).get(file, ["md5"]) == {"md5": "1"}
+
+
+def test_fixity_cache_changed(tmp_path):
+    cache = FixityCache(tmp_path.joinpath("cache.db"))
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(b"essence")
+    cache.put(file, {"md5": "1"})
+
+    # Rewritten with the same size and mtime
+    stat = file.stat()
+    file.write_bytes(b"ESSENCE")
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.get(file, ["md5"]) is None
+
+
+def test_fixity_cache_relinked(tmp_path):
+    cache = FixityCache(tmp_path.joinpath("cache.db"))
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(b"essence")
+    cache.put(file, {"md5": "1"})
+
+    key = file_key(file)
+    os.link(file, tmp_path.joinpath("link.mxf"))
+    cache.relinked(file, key)
+    key = file_key(file)
+    tmp_path.joinpath("link.mxf").unlink()
+    cache.relinked(file, key)
+    assert cache.get(file, ["md5"]) == {"md5": "1"}
+
+
+def test_fixity_cache_relinked_changed(tmp_path):
+    cache = FixityCache(tmp_path.joinpath("cache.db"))
+    file = tmp_path.joinpath("file.mxf")
+    file.write_bytes(b"essence")
+    cache.put(file, {"md5": "1"})
+
+    key = file_key(file)
+    os.link(file, tmp_path.joinpath("link.mxf"))
+    # Rewritten before the stat after the link, the entry is dropped
+    file.write_bytes(b"essence, rewritten")
+    cache.relinked(file, key)
+    assert cache._get(key) is None
+
+
+def test_fixity_cache_eviction(tmp_path):
+    cache = FixityCache(tmp_path.joinpath("cache.db"), max_entries=2)
+    files = []
+    for i in range(3):
+        file = tmp_path.joinpath(f"file_{i}.mxf")
+        file.write_bytes(b"essence")
+        cache.put(file, {"md5": str(i)})
+        files.append(file)
+
+    assert cache.get(files[0], ["md5"]) is None
+    assert cache.get(files[1], ["md5"]) == {"md5": "1"}
+    assert cache.get(files[2], ["md5"]) == {"md5": "2"}
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from app.helpers.inflight import Delivery, InFlightRegistry, calculate_message_key
+
+
+def test_calculate_message_key():
+    assert calculate_message_key(b"message") == calculate_message_key(b"message")
+    assert calculate_message_key(b"message") != calculate_message_key(b"other")
+
+
+class FakeChannel:
+    def __init__(self):
+        self.is_open = True
+
+
+class FakeAcks:
+    def __init__(self):
+        self.channel = FakeChannel()
+
+
+def test_in_flight_registry():
+    registry = InFlightRegistry()
+    old_acks = FakeAcks()
+    first = Delivery(old_acks, 5, "queue")
+    assert registry.claim("key", first)
+    assert registry.current("key") == [first]
+
+    # Redelivered on a new channel while the job is running
+    old_acks.channel.is_open = False
+    redelivery = Delivery(FakeAcks(), 1, "queue")
+    assert not registry.claim("key", redelivery)
+    assert len(registry) == 1
+
+    # The job is settled with the latest delivery
+    assert registry.release("key") == [redelivery]
+    assert registry.release("key") == []
+    assert registry.claim("key", first)
+
+
+def test_in_flight_registry_duplicates():
+    registry = InFlightRegistry()
+    acks = FakeAcks()
+    other_acks = FakeAcks()
+    first = Delivery(acks, 1, "queue")
+    assert registry.claim("key", first)
+
+    # Published twice, on the same channel and on another queue
+    duplicate = Delivery(acks, 2, "queue")
+    other_queue = Delivery(other_acks, 1, "other queue")
+    assert not registry.claim("key", duplicate)
+    assert not registry.claim("key", other_queue)
+    assert registry.current("key") == [first, duplicate, other_queue]
+
+    # After a reconnect, the channel of the queue is replaced
+    redelivery = Delivery(FakeAcks(), 1, "queue")
+    assert not registry.claim("key", redelivery)
+
+    # The job settles all the deliveries which can still be settled
+    assert registry.release("key") == [other_queue, redelivery]
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+from app.helpers.events import WatchfolderMessage
+from app.helpers.journal import JobJournal, JobStage, calculate_job_id
+
+
+def _message(folder) -> WatchfolderMessage:
+    return WatchfolderMessage(
+        json.dumps(
+            {
+                "cp_name": "CP",
+                "flow_id": "OR-1",
+                "sip_package": [
+                    {
+                        "file_type": "essence",
+                        "file_name": "file.mxf",
+                        "file_path": str(folder),
+                    },
+                    {
+                        "file_type": "sidecar",
+                        "file_name": "file.xml",
+                        "file_path": str(folder),
+                    },
+                ],
+            }
+        ).encode()
+    )
+
+
+def test_calculate_job_id(tmp_path):
+    tmp_path.joinpath("file.mxf").write_bytes(b"essence")
+    tmp_path.joinpath("file.xml").write_bytes(b"<sidecar/>")
+    message = _message(tmp_path)
+
+    job_id = calculate_job_id(message)
+    assert job_id == calculate_job_id(_message(tmp_path))
+
+    # A changed essence is a new job
+    stat = tmp_path.joinpath("file.mxf").stat()
+    os.utime(tmp_path.joinpath("file.mxf"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert calculate_job_id(message) != job_id
+
+
+def test_journal_record(tmp_path):
+    journal = JobJournal(tmp_path.joinpath("journal.db"))
+    assert journal.get("job") is None
+
+    journal.record("job", JobStage.STAGED, {"digests": {"file": {"md5": "1"}}})
+    journal.record("job", JobStage.PUBLISHED, {"bag_path": "/file.bag.zip"})
+
+    record = journal.get("job")
+    assert record.stage is JobStage.PUBLISHED
+    assert record.state == {
+        "digests": {"file": {"md5": "1"}},
+        "bag_path": "/file.bag.zip",
+    }
+
+    # Shared between instances
+    assert JobJournal(journal.path).get("job").stage is JobStage.PUBLISHED
+
+
+def test_journal_prune(tmp_path):
+    journal = JobJournal(tmp_path.joinpath("journal.db"))
+    journal.record("job", JobStage.ANNOUNCED)
+
+    assert journal.prune(3600) == 0
+    assert journal.prune(-1) == 1
+    assert journal.get("job") is None
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from app.helpers.metrics import (
+    JobMetrics,
+    MetricsServer,
+    Registry,
+    queue_wait,
+    throughput,
+    timed,
+)
+
+
+def test_timed():
+    durations = {}
+    with timed(durations, "stage"):
+        pass
+    with pytest.raises(ValueError):
+        with timed(durations, "stage"):
+            raise ValueError()
+    assert list(durations) == ["stage"]
+    assert durations["stage"] >= 0
+
+
+def test_queue_wait():
+    now = time.time()
+    assert 10 <= queue_wait(now - 10) < 11
+    # Since it was published
+    assert 60 <= queue_wait(now - 10, now - 60) < 61
+    # Clocks out of sync
+    assert queue_wait(now, now + 60) == 0
+
+
+def test_throughput():
+    assert throughput(1000, 0.5) == 2000
+    assert throughput(0, 0.5) is None
+    assert throughput(1000, 0) is None
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = registry.histogram("seconds", "Help.", ["stage"], buckets=(1, 5))
+    histogram.observe(0.5, stage="zip")
+    histogram.observe(1, stage="zip")
+    histogram.observe(7, stage="zip")
+    assert histogram.count(stage="zip") == 3
+
+    assert registry.render().splitlines() == [
+        "# HELP seconds Help.",
+        "# TYPE seconds histogram",
+        'seconds_bucket{stage="zip",le="1"} 2',
+        'seconds_bucket{stage="zip",le="5"} 2',
+        'seconds_bucket{stage="zip",le="+Inf"} 3',
+        'seconds_sum{stage="zip"} 8.5',
+        'seconds_count{stage="zip"} 3',
+    ]
+
+
+def test_counter():
+    registry = Registry()
+    counter = registry.counter("sips_total", "Help.", ["cp_id"])
+    counter.inc(cp_id='OR-"1"')
+    counter.inc(2, cp_id='OR-"1"')
+    assert counter.value(cp_id='OR-"1"') == 3
+    assert counter.value(cp_id="OR-2") == 0
+    assert registry.render().splitlines()[2] == 'sips_total{cp_id="OR-\\"1\\""} 3'
+
+
+def test_job_metrics():
+    metrics = JobMetrics()
+    metrics.observe_stages({"zip": 2.0, "bagit": 1.0})
+    metrics.sip_created("video/mxf", "OR-1", 1000)
+    metrics.sip_created(None, "OR-1", 10)
+
+    assert metrics.stage_seconds.count(stage="zip") == 1
+    assert metrics.essence_bytes.value(mimetype="video/mxf", cp_id="OR-1") == 1000
+    assert metrics.sips.value(mimetype="unknown", cp_id="OR-1") == 1
+
+
+def test_server():
+    metrics = JobMetrics()
+    metrics.sip_created("image/jpeg", "OR-1", 10)
+    server = MetricsServer(metrics.registry, port=0)
+    server.start()
+    try:
+        url = f"http://127.0.0.1:{server.port}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            body = response.read().decode()
+        assert 'sipin_sip_creator_sips_total{mimetype="image/jpeg",cp_id="OR-1"} 1' in (
+            body
+        )
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.stop()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import time
+
+from app.helpers.outbox import Outbox, OutboxFlusher
+
+
+def test_outbox(tmp_path):
+    outbox = Outbox(tmp_path.joinpath("outbox.db"))
+    first = outbox.put(b"first", {"id": "1"}, 1000)
+    second = outbox.put(b"second", {"id": "2"})
+    assert len(outbox) == 2
+
+    messages = outbox.due(10)
+    assert [m.id for m in messages] == [first, second]
+    assert messages[0].to_dict() == {
+        "content": b"first",
+        "properties": {"id": "1"},
+        "event_timestamp": 1000,
+    }
+    assert len(outbox.due(1)) == 1
+
+    outbox.retry_later([first], 60)
+    assert [m.id for m in outbox.due(10)] == [second]
+
+    outbox.remove([second])
+    assert len(outbox) == 1
+    # Shared between instances
+    assert len(Outbox(outbox.path)) == 1
+
+
+def test_flusher(tmp_path):
+    outbox = Outbox(tmp_path.joinpath("outbox.db"))
+    outbox.put(b"ok", {})
+    outbox.put(b"fail", {})
+    sent = []
+    reported = []
+
+    def send(messages):
+        sent.extend(m["content"] for m in messages)
+        return [None if m["content"] == b"ok" else IOError() for m in messages]
+
+    flusher = OutboxFlusher(
+        outbox, send, report=lambda *args: reported.append(args), interval=60
+    )
+    assert flusher.flush() == 1
+    assert sent == [b"ok", b"fail"]
+    assert [m.content for m in reported[0][0]] == [b"ok"]
+    assert [m.content for m, _ in reported[0][1]] == [b"fail"]
+
+    # The failed message is retried later
+    assert len(outbox) == 1
+    assert flusher.flush() == 0
+    assert sent == [b"ok", b"fail"]
+
+
+def test_flusher_send_error(tmp_path):
+    outbox = Outbox(tmp_path.joinpath("outbox.db"))
+    outbox.put(b"event", {})
+
+    def send(messages):
+        raise ConnectionError()
+
+    assert OutboxFlusher(outbox, send).flush() == 0
+    assert outbox.due(10) == []
+    assert len(outbox) == 1
+
+
+def test_flusher_start(tmp_path):
+    outbox = Outbox(tmp_path.joinpath("outbox.db"))
+    sent = []
+    flusher = OutboxFlusher(outbox, lambda ms: [sent.append(m) for m in ms])
+    flusher.start()
+
+    outbox.put(b"event", {})
+    flusher.notify()
+    for _ in range(50):
+        if sent:
+            break
+        time.sleep(0.1)
+    flusher.stop()
+
+    assert [m["content"] for m in sent] == [b"event"]
+    assert len(outbox) == 0
+
+
+def test_flusher_keeps_running(tmp_path):
+    outbox = Outbox(tmp_path.joinpath("outbox.db"))
+    outbox.put(b"event", {})
+    due = outbox.due
+    failures = [sqlite3.OperationalError("database is locked")]
+
+    def flaky_due(limit):
+        if failures:
+            raise failures.pop()
+        return due(limit)
+
+    outbox.due = flaky_due
+    sent = []
+    errors = []
+    flusher = OutboxFlusher(
+        outbox,
+        lambda ms: [sent.append(m) for m in ms],
+        interval=0.1,
+        on_error=errors.append,
+    )
+    flusher.start()
+    for _ in range(50):
+        if sent:
+            break
+        time.sleep(0.1)
+    flusher.stop()
+
+    assert [type(error) for error in errors] == [sqlite3.OperationalError]
+    assert [m["content"] for m in sent] == [b"event"]
+    assert len(outbox) == 0
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import ctypes
+
+from app.helpers.page_cache import (
+    ALIGNMENT,
+    PageCacheMonitor,
+    align,
+    allocate_aligned,
+)
+
+
+def test_align():
+    assert align(1) == ALIGNMENT
+    assert align(ALIGNMENT) == ALIGNMENT
+    assert align(ALIGNMENT + 1) == 2 * ALIGNMENT
+
+
+def test_allocate_aligned():
+    buffer = allocate_aligned(1000)
+    assert len(buffer) == ALIGNMENT
+    address = ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+    assert address % ALIGNMENT == 0
+
+
+def test_page_cache_monitor():
+    with PageCacheMonitor(interval=0.01) as monitor:
+        pass
+    result = monitor.to_dict()
+    assert set(result) == {
+        "page_cache_start_bytes",
+        "page_cache_peak_growth_bytes",
+        "page_cache_end_growth_bytes",
+    }
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+
+from app.helpers.pipeline import PipelineStats, ReadPipeline
+
+DATA = bytes(range(256)) * 4096
+
+
+def test_read_pipeline():
+    stats = PipelineStats()
+    pipeline = ReadPipeline(ring_size=3, block_size=10_000)
+    result = b"".join(
+        bytes(block) for block in pipeline.blocks(io.BytesIO(DATA), stats)
+    )
+    assert result == DATA
+    assert stats.bytes == len(DATA)
+    assert stats.duration > 0
+
+
+def test_read_pipeline_stop_early():
+    pipeline = ReadPipeline(ring_size=2, block_size=1000)
+    blocks = pipeline.blocks(io.BytesIO(DATA))
+    assert bytes(next(blocks)) == DATA[:1000]
+    # Closing the generator stops the reader thread
+    blocks.close()
+
+
+def test_read_pipeline_read_error():
+    class BrokenFile(io.BytesIO):
+        def readinto(self, buffer):
+            raise OSError("Stale file handle")
+
+    pipeline = ReadPipeline(ring_size=2, block_size=1000)
+    with pytest.raises(OSError):
+        list(pipeline.blocks(BrokenFile(DATA)))
+
+
+def test_read_pipeline_reuses_buffers():
+    allocated = []
+
+    def allocate(size):
+        allocated.append(size)
+        return memoryview(bytearray(size))
+
+    pipeline = ReadPipeline(ring_size=3, block_size=10_000, allocate=allocate)
+    for _ in range(2):
+        result = b"".join(bytes(block) for block in pipeline.blocks(io.BytesIO(DATA)))
+        assert result == DATA
+    assert allocated == [10_000] * 3
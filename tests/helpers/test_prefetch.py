@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from app.helpers.prefetch import PrefetchController, split_prefetch_count
+
+
+def test_no_jobs_yet():
+    controller = PrefetchController(10, workers=4)
+    assert controller.update(in_flight=10) is None
+    assert controller.prefetch_count == 10
+
+
+def test_long_jobs():
+    controller = PrefetchController(10, workers=4, refill_time=1)
+    controller.job_finished(600)
+    # A single extra job covers the refill of long jobs
+    assert controller.update(in_flight=10) == 5
+
+
+def test_short_jobs():
+    controller = PrefetchController(5, workers=4, refill_time=1, maximum=50)
+    controller.job_finished(0.1)
+    # Only grows once the window is used up
+    assert controller.update(in_flight=3) is None
+    assert controller.update(in_flight=5) == 44
+    controller.job_finished(0.01)
+    assert controller.update(in_flight=44) == 50
+
+
+def test_headroom():
+    controller = PrefetchController(8, workers=4)
+    controller.job_finished(600, space=100)
+    # 5 jobs wait for disk space, there's room for 1 more
+    assert controller.update(in_flight=8, waiting=5, headroom=150) == 4
+    # Never below the minimum
+    assert controller.update(in_flight=0, waiting=0, headroom=0) == 1
+
+
+def test_averages():
+    controller = PrefetchController(1, workers=1, smoothing=0.5)
+    controller.job_finished(10, space=100)
+    controller.job_finished(20)
+    assert controller.mean_duration == pytest.approx(15)
+    assert controller.mean_space == 100
+
+
+def test_split_prefetch_count():
+    assert split_prefetch_count(12, [2, 1, 1]) == [6, 3, 3]
+    assert split_prefetch_count(2, [10, 1]) == [2, 1]
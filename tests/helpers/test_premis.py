@@ -11,3 +11,38 @@ import pprint
 
 def test_premis():
     pass
+
+
+def _fixity_values(element):
+    ns = {"premis": "http://www.loc.gov/premis/v3"}
+    return [
+        (
+            fixity.findtext("premis:messageDigestAlgorithm", namespaces=ns),
+            fixity.findtext("premis:messageDigest", namespaces=ns),
+        )
+        for fixity in element.findall("premis:fixity", namespaces=ns)
+    ]
+
+
+def test_fixity_md5():
+    element = Fixity("digest").to_element()
+    assert _fixity_values(element) == [("MD5", "digest")]
+
+
+def test_fixity_empty():
+    element = Fixity().to_element()
+    assert _fixity_values(element) == [(None, None)]
+
+
+def test_fixity_digests():
+    element = Fixity("md5_digest", {"sha256": "sha_digest", "xxh64": "xx"}).to_element()
+    assert _fixity_values(element) == [
+        ("MD5", "md5_digest"),
+        ("SHA-256", "sha_digest"),
+        ("xxh64", "xx"),
+    ]
+    algorithm = element.find(
+        "premis:fixity[2]/premis:messageDigestAlgorithm",
+        namespaces={"premis": "http://www.loc.gov/premis/v3"},
+    )
+    assert algorithm.get("valueURI").endswith("cryptographicHashFunctions/sha256")
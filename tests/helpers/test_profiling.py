@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pstats
+import time
+import tracemalloc
+
+from app.helpers.profiling import JobProfiler, ProfilingPolicy
+
+
+def test_policy():
+    policy = ProfilingPolicy(sample_rate=0.1, cp_ids=["OR-1"], rand=lambda: 0.5)
+    assert policy.selected({"x-profile": "true"}, "OR-2")
+    assert policy.selected({"x-profile": b"1"}, "OR-2")
+    assert policy.selected(None, "OR-1")
+    assert not policy.selected({"x-profile": "false"}, "OR-2")
+    assert not policy.selected(None, None)
+
+    # Sampled
+    assert ProfilingPolicy(sample_rate=0.1, rand=lambda: 0.05).selected(None, None)
+    assert not ProfilingPolicy(header=False).selected({"x-profile": "1"}, None)
+
+
+def work():
+    blocks = [bytearray(1024) for _ in range(100)]
+    time.sleep(0.05)
+    return len(blocks)
+
+
+def test_job_profiler(tmp_path):
+    profiler = JobProfiler(
+        tmp_path.joinpath("profiles"), "essence name/1", sampling_interval=0.005
+    )
+    assert profiler.run(work) == 100
+
+    assert [path.suffixes[-1] for path in profiler.paths] == [
+        ".pstats",
+        ".txt",
+        ".folded",
+    ]
+    assert all("essence_name_1" in path.name for path in profiler.paths)
+    stats = pstats.Stats(str(profiler.paths[0]))
+    assert any(function == "work" for _, _, function in stats.stats)
+    assert profiler.paths[1].read_text().startswith("Peak traced memory: ")
+    assert "work (" in profiler.paths[2].read_text()
+    assert not tracemalloc.is_tracing()
+
+
+def test_job_profiler_disabled(tmp_path):
+    profiler = JobProfiler(tmp_path, "essence", cprofile=False, trace_malloc=False)
+    with profiler:
+        pass
+    assert profiler.paths == []
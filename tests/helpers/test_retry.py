@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from app.helpers.retry import ATTEMPT_HEADER, RetryTopology
+
+
+def test_retry_queues():
+    topology = RetryTopology("queue", max_attempts=5, base_delay=30, max_delay=100)
+    assert topology.retry_queues() == {
+        "queue.retry.30000ms": {
+            "x-message-ttl": 30000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": "queue",
+        },
+        "queue.retry.60000ms": {
+            "x-message-ttl": 60000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": "queue",
+        },
+        # The capped delays share a queue
+        "queue.retry.100000ms": {
+            "x-message-ttl": 100000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": "queue",
+        },
+    }
+
+
+def test_route():
+    topology = RetryTopology("queue", max_attempts=3, base_delay=1)
+    assert topology.route(None) == ("queue.retry.1000ms", {ATTEMPT_HEADER: 1})
+    assert topology.route({ATTEMPT_HEADER: 1, "other": "value"}) == (
+        "queue.retry.2000ms",
+        {ATTEMPT_HEADER: 2, "other": "value"},
+    )
+    assert topology.route({ATTEMPT_HEADER: 2}) == (
+        "queue.parked",
+        {ATTEMPT_HEADER: 3},
+    )
+
+
+def test_attempts():
+    assert RetryTopology.attempts({}) == 0
+    assert RetryTopology.attempts({ATTEMPT_HEADER: "2"}) == 2
+    assert RetryTopology.attempts({ATTEMPT_HEADER: "invalid"}) == 0
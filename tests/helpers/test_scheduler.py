@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+
+from app.helpers.scheduler import WeightedScheduler
+
+
+def test_weights():
+    scheduler = WeightedScheduler(workers=1)
+    scheduler.add_queue("video", weight=2)
+    scheduler.add_queue("image", weight=1)
+    order = []
+    for _ in range(4):
+        scheduler.submit("video", lambda: order.append("video"))
+        scheduler.submit("image", lambda: order.append("image"))
+    scheduler.start()
+    scheduler.stop()
+
+    # Interleaved by weight, until the video queue is empty
+    assert order == ["video", "image", "video", "video", "image", "video"] + [
+        "image",
+        "image",
+    ]
+
+
+def test_max_concurrency():
+    scheduler = WeightedScheduler(workers=3)
+    scheduler.add_queue("video", max_concurrency=1)
+    scheduler.add_queue("image")
+    lock = threading.Lock()
+    running = {"video": 0, "max": 0}
+    release = threading.Event()
+
+    def video():
+        with lock:
+            running["video"] += 1
+            running["max"] = max(running["max"], running["video"])
+        release.wait(1)
+        with lock:
+            running["video"] -= 1
+
+    images = []
+    for _ in range(3):
+        scheduler.submit("video", video)
+    scheduler.submit("image", lambda: images.append(1))
+    scheduler.start()
+    release.set()
+    scheduler.stop()
+
+    assert running["max"] == 1
+    assert images == [1]
+    assert scheduler.pending() == 0
+    assert scheduler.running() == 0
+
+
+def test_on_error():
+    errors = []
+    scheduler = WeightedScheduler(1, on_error=lambda q, e: errors.append((q, e)))
+    scheduler.add_queue("queue")
+    error = ValueError()
+
+    def crash():
+        raise error
+
+    scheduler.submit("queue", crash)
+    done = []
+    scheduler.submit("queue", lambda: done.append(1))
+    scheduler.start()
+    scheduler.stop()
+
+    assert errors == [("queue", error)]
+    assert done == [1]
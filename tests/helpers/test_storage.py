@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import errno
+from pathlib import Path
+
+import pytest
+
+from app.helpers import storage
+from app.helpers.storage import (
+    StagingStrategy,
+    optional_path,
+    partial_path,
+    publish,
+    resolve_staging_strategy,
+    same_filesystem,
+)
+
+
+@pytest.mark.parametrize(
+    "value,result",
+    [(None, None), ("", None), ("  ", None), ("/scratch", Path("/scratch"))],
+)
+def test_optional_path(value, result):
+    assert optional_path(value) == result
+
+
+def test_partial_path():
+    path = Path("/output", "file.bag.zip")
+    assert partial_path(path) == Path("/output", "file.bag.zip.partial")
+    assert partial_path(path, Path("/scratch")) == Path(
+        "/scratch", "file.bag.zip.partial"
+    )
+
+
+def test_publish(tmp_path):
+    partial = tmp_path.joinpath("file.bag.zip.partial")
+    partial.write_bytes(b"zip")
+    path = publish(partial, tmp_path.joinpath("file.bag.zip"))
+    assert path.read_bytes() == b"zip"
+    assert not partial.exists()
+
+
+def test_publish_other_filesystem(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "same_filesystem", lambda path, other: False)
+    scratch = tmp_path.joinpath("scratch")
+    scratch.mkdir()
+    output = tmp_path.joinpath("output")
+    output.mkdir()
+    partial = scratch.joinpath("file.bag.zip.partial")
+    partial.write_bytes(b"zip")
+
+    path = publish(partial, output.joinpath("file.bag.zip"), sync_dir=False)
+    assert path.read_bytes() == b"zip"
+    assert not partial.exists()
+    assert list(output.iterdir()) == [path]
+
+
+def test_publish_other_filesystem_copy_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "same_filesystem", lambda path, other: False)
+
+    def copyfile(src, dst):
+        Path(dst).write_bytes(b"z")
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(storage.shutil, "copyfile", copyfile)
+    scratch = tmp_path.joinpath("scratch")
+    scratch.mkdir()
+    output = tmp_path.joinpath("output")
+    output.mkdir()
+    partial = scratch.joinpath("file.bag.zip.partial")
+    partial.write_bytes(b"zip")
+
+    with pytest.raises(OSError):
+        publish(partial, output.joinpath("file.bag.zip"), sync_dir=False)
+    assert list(output.iterdir()) == []
+    assert partial.read_bytes() == b"zip"
+
+
+@pytest.mark.parametrize(
+    "strategy,same,result",
+    [
+        (StagingStrategy.AUTO, True, StagingStrategy.HARDLINK),
+        (StagingStrategy.AUTO, False, StagingStrategy.COPY),
+        (StagingStrategy.HARDLINK, True, StagingStrategy.HARDLINK),
+        (StagingStrategy.HARDLINK, False, StagingStrategy.COPY),
+        (StagingStrategy.COPY, True, StagingStrategy.COPY),
+    ],
+)
+def test_resolve_staging_strategy(monkeypatch, strategy, same, result):
+    monkeypatch.setattr(storage, "same_filesystem", lambda path, other: same)
+    assert (
+        resolve_staging_strategy(strategy, Path("/essence"), Path("/staging")) == result
+    )
+
+
+def test_same_filesystem(tmp_path):
+    assert same_filesystem(tmp_path, tmp_path.joinpath("not", "created", "yet"))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import time
+
+from app.helpers.admission import DiskAdmission
+from app.helpers.sweeper import (
+    Reaper,
+    Sweeper,
+    is_live,
+    marker_path,
+    release_marker,
+    tombstone,
+    write_marker,
+)
+
+
+def _age(path, seconds=7200):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_marker(tmp_path):
+    root_folder = tmp_path.joinpath("file")
+    marker = write_marker(root_folder, "job")
+    assert marker == tmp_path.joinpath(".file.sipin-sip-creator")
+    assert json.loads(marker.read_text())["job_id"] == "job"
+    assert is_live(marker)
+
+    release_marker(marker, remove=False)
+    assert marker.exists()
+    assert not is_live(marker)
+
+    release_marker(marker, remove=True)
+    assert not marker.exists()
+
+
+def test_is_live_other_process(tmp_path):
+    marker = marker_path(tmp_path.joinpath("file"))
+    info = {"host": socket.gethostname(), "pid": os.getppid(), "process": "other"}
+    marker.write_text(json.dumps(info))
+    assert is_live(marker)
+
+    marker.write_text(json.dumps({**info, "pid": 2 ** 22 + 1}))
+    assert not is_live(marker)
+
+    marker.write_text(json.dumps({**info, "host": "other"}))
+    assert is_live(marker)
+
+
+def test_sweeper_find(tmp_path):
+    # Abandoned staging tree
+    abandoned = tmp_path.joinpath("abandoned")
+    abandoned.mkdir()
+    release_marker(write_marker(abandoned), remove=False)
+    _age(marker_path(abandoned))
+    # Staging tree of a live job
+    live = tmp_path.joinpath("live")
+    live.mkdir()
+    write_marker(live)
+    _age(marker_path(live))
+    # Abandoned and recent partial zip
+    tmp_path.joinpath("old.bag.zip.partial").write_bytes(b"zip")
+    _age(tmp_path.joinpath("old.bag.zip.partial"))
+    tmp_path.joinpath("new.bag.zip.partial").write_bytes(b"zip")
+    # Not an artifact
+    tmp_path.joinpath("essence.mxf").write_bytes(b"essence")
+    _age(tmp_path.joinpath("essence.mxf"))
+    # The stalled upload of another tool
+    tmp_path.joinpath("upload.mxf.partial").write_bytes(b"essence")
+    _age(tmp_path.joinpath("upload.mxf.partial"))
+
+    sweeper = Sweeper([tmp_path], Reaper(), max_age=3600)
+    assert sorted(sweeper.find()) == sorted(
+        [abandoned, marker_path(abandoned), tmp_path.joinpath("old.bag.zip.partial")]
+    )
+
+
+def test_reaper_remove(tmp_path):
+    essence = tmp_path.joinpath("essence.mxf")
+    essence.write_bytes(b"e" * 1000)
+    root_folder = tmp_path.joinpath("essence")
+    root_folder.joinpath("data").mkdir(parents=True)
+    root_folder.joinpath("data", "metadata.xml").write_bytes(b"m" * 250)
+    os.link(essence, root_folder.joinpath("data", "essence.mxf"))
+
+    reaper = Reaper(rate=0, step=100)
+    assert reaper.reclaimable_bytes(root_folder) == 250
+    assert reaper.remove(root_folder) == 250
+    assert not root_folder.exists()
+    # The hardlinked essence is kept
+    assert essence.read_bytes() == b"e" * 1000
+
+
+def _wait_for(condition):
+    for _ in range(50):
+        if condition():
+            return
+        time.sleep(0.1)
+
+
+def test_reaper(tmp_path):
+    admission = DiskAdmission(tmp_path.joinpath("admission.db"))
+    device = tmp_path.stat().st_dev
+    root_folder = tmp_path.joinpath("file")
+    root_folder.mkdir()
+    root_folder.joinpath("file.mxf").write_bytes(b"e" * 1000)
+    admission.replace("job", {tmp_path: 5000})
+    reported = []
+    done = []
+
+    reaper = Reaper(report=lambda *args: reported.append(args), admission=admission)
+    assert reaper.enqueue(root_folder, lambda: done.append(True), "job")
+    assert not reaper.enqueue(root_folder)
+    # The job's reservation is replaced by the pending bytes
+    assert reaper.pending_bytes == 1000
+    assert admission.reserved_bytes(device) == 1000
+
+    reaper.start()
+    _wait_for(lambda: reported)
+    reaper.stop()
+
+    assert reported == [(root_folder, 1000)]
+    assert done == [True]
+    assert reaper.pending_bytes == 0
+    assert reaper.reclaimed_bytes == 1000
+    assert admission.reserved_bytes(device) == 0
+    assert not root_folder.exists()
+
+
+def test_sweeper_start(tmp_path):
+    partial = tmp_path.joinpath("file.bag.zip.partial")
+    partial.write_bytes(b"z" * 1000)
+    _age(partial)
+    reaper = Reaper()
+
+    sweeper = Sweeper([tmp_path], reaper, max_age=3600)
+    sweeper.start(interval=3600)
+    reaper.start()
+    _wait_for(lambda: reaper.reclaimed_bytes)
+    sweeper.stop()
+    reaper.stop()
+
+    assert reaper.reclaimed_bytes == 1000
+    assert not partial.exists()
+
+
+def test_tombstone(tmp_path):
+    root_folder = tmp_path.joinpath("file")
+    root_folder.mkdir()
+    _age(root_folder)
+
+    deleting = tombstone(root_folder)
+    assert not root_folder.exists()
+    assert deleting.parent == tmp_path
+    assert deleting.name.startswith(".file.")
+    assert deleting.name.endswith(".deleting")
+    # Aged from the rename on
+    sweeper = Sweeper([tmp_path], Reaper(), max_age=3600)
+    assert sweeper.find() == []
+    _age(deleting)
+    assert sweeper.find() == [deleting]
+
+
+def test_reaper_reused_root(tmp_path):
+    root_folder = tmp_path.joinpath("file")
+    root_folder.joinpath("data").mkdir(parents=True)
+    for index in range(5):
+        root_folder.joinpath("data", f"{index}.xml").write_bytes(b"m" * 1000)
+    reported = []
+
+    # Slow enough to still be removing when the root folder is reused
+    reaper = Reaper(rate=10000, report=lambda *args: reported.append(args))
+    deleting = tombstone(root_folder)
+    reaper.enqueue(deleting)
+    reaper.start()
+    root_folder.joinpath("data").mkdir(parents=True)
+    root_folder.joinpath("data", "0.xml").write_bytes(b"n" * 1000)
+    _wait_for(lambda: reported)
+    reaper.stop()
+
+    assert reported == [(deleting, 5000)]
+    assert not deleting.exists()
+    assert root_folder.joinpath("data", "0.xml").read_bytes() == b"n" * 1000
+
+
+def test_sweeper_foreign_partial(tmp_path):
+    foreign = tmp_path.joinpath("x.mxf.partial")
+    foreign.write_bytes(b"e" * 1000)
+    _age(foreign)
+    reaper = Reaper()
+
+    assert Sweeper([tmp_path], reaper, max_age=3600).sweep() == 0
+    assert foreign.exists()
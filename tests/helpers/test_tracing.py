@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from app.helpers.tracing import (
+    SpanFileExporter,
+    Trace,
+    parse_traceparent,
+    span,
+)
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+def test_parse_traceparent():
+    assert parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01") == (TRACE_ID, PARENT_ID)
+    assert parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01".encode()) == (
+        TRACE_ID,
+        PARENT_ID,
+    )
+    assert parse_traceparent(None) is None
+    assert parse_traceparent("invalid") is None
+    assert parse_traceparent(f"00-{'0' * 32}-{PARENT_ID}-01") is None
+
+
+def test_from_message():
+    trace = Trace.from_message(
+        "a" * 64, {"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"}
+    )
+    assert (trace.trace_id, trace.parent_id) == (TRACE_ID, PARENT_ID)
+
+    # Derived from the key of the message
+    trace = Trace.from_message("a" * 64, None)
+    assert (trace.trace_id, trace.parent_id) == ("a" * 32, None)
+
+
+def test_nested_spans():
+    trace = Trace(TRACE_ID, PARENT_ID)
+    with trace.span("job") as job:
+        trace.annotate(cp_id="OR-1")
+        with span(trace, "zip", bytes=10) as zip_:
+            assert zip_.traceparent == f"00-{TRACE_ID}-{zip_.span_id}-01"
+        with pytest.raises(ValueError):
+            with trace.span("cleanup"):
+                raise ValueError("failed")
+        publish = trace.child("pulsar_publish")
+    publish.finish()
+    trace.add(publish)
+
+    spans = {span_.name: span_ for span_ in trace.pop_finished()}
+    assert list(spans) == ["zip", "cleanup", "job", "pulsar_publish"]
+    assert job.parent_id == PARENT_ID
+    assert spans["zip"].parent_id == job.span_id
+    assert spans["pulsar_publish"].parent_id == job.span_id
+    assert job.attributes == {"cp_id": "OR-1"}
+    assert spans["zip"].attributes == {"bytes": 10}
+    assert spans["cleanup"].attributes == {"error": "ValueError('failed')"}
+    assert job.duration >= spans["zip"].duration
+    assert trace.pop_finished() == []
+
+
+def test_span_without_trace():
+    with span(None, "zip") as span_:
+        span_.set(bytes=10)
+    assert span_.attributes == {"bytes": 10}
+
+
+def test_span_file_exporter(tmp_path):
+    path = tmp_path.joinpath("traces", "spans.jsonl")
+    exporter = SpanFileExporter(path, "sipin-sip-creator")
+    trace = Trace(TRACE_ID)
+    with trace.span("zip", bytes=10, strategy="copy"):
+        pass
+    exporter.export(trace.pop_finished())
+    exporter.export([])
+
+    lines = path.read_text().splitlines()
+    assert len(lines) == 1
+    resource_spans = json.loads(lines[0])["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"][0]["value"] == {
+        "stringValue": "sipin-sip-creator"
+    }
+    (otlp_span,) = resource_spans["scopeSpans"][0]["spans"]
+    assert otlp_span["traceId"] == TRACE_ID
+    assert otlp_span["name"] == "zip"
+    assert int(otlp_span["endTimeUnixNano"]) >= int(otlp_span["startTimeUnixNano"])
+    assert otlp_span["attributes"] == [
+        {"key": "bytes", "value": {"intValue": "10"}},
+        {"key": "strategy", "value": {"stringValue": "copy"}},
+    ]
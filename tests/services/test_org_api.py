@@ -1,6 +1,7 @@
+import asyncio
 import json
 
-from app.services.org_api import OrgApiClient, OrgApiError
+from app.services.org_api import AsyncOrgApiClient, OrgApiClient, OrgApiError
 
 import pytest
 import responses
@@ -66,3 +67,20 @@ class TestOrgApiClient:
         responses.add(responses.POST, "https://org_api_url", body=json.dumps(result))
         with pytest.raises(OrgApiError):
             client.get_label("")
+
+
+class TestAsyncOrgApiClient:
+    @responses.activate
+    def test_get_label(self):
+        client = AsyncOrgApiClient(OrgApiClient())
+        result = {"data": {"organizations": [{"label": "label"}]}}
+        responses.add(responses.POST, "https://org_api_url", body=json.dumps(result))
+
+        async def lookup():
+            return await asyncio.gather(*(client.get_label("cp_id") for _ in range(3)))
+
+        assert asyncio.run(lookup()) == ["label"] * 3
+        # The concurrent lookups share one request
+        assert len(responses.calls) == 1
+        assert asyncio.run(client.get_label("cp_id")) == "label"
+        assert len(responses.calls) == 1
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+
+import pulsar
+import pytest
+from cloudevents.events import Event, EventAttributes, EventOutcome
+
+from app.helpers.tracing import TRACEPARENT_HEADER
+from app.services import pulsar as pulsar_module
+from app.services.pulsar import PRODUCER_TOPIC, PulsarClient, PulsarDeliveryError
+
+TRACEPARENT = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+
+class ProducerClosed(Exception):
+    pass
+
+
+class FakeProducer:
+    """Collects the sends, their callbacks are fired by the test."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.sent = []
+        self.callbacks = []
+        self.closed = False
+
+    def send_async(self, callback, content, properties, event_timestamp=None):
+        if self.closed:
+            raise ProducerClosed()
+        self.sent.append((content, properties))
+        self.callbacks.append(callback)
+
+    def fire(self, *results):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, result in zip(callbacks, results):
+            callback(result, None)
+
+
+class FakeClient:
+    def __init__(self, url):
+        self.url = url
+
+    def create_producer(self, topic, **kwargs):
+        self.producer = FakeProducer(**kwargs)
+        return self.producer
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(pulsar_module.pulsar, "Client", FakeClient)
+    return PulsarClient()
+
+
+def _event():
+    attributes = EventAttributes(
+        type=PRODUCER_TOPIC,
+        source="sipin-sip-creator",
+        subject="essence",
+        outcome=EventOutcome.SUCCESS,
+    )
+    return Event(attributes, {"path": "/output/essence.bag.zip"})
+
+
+def _message(content):
+    return {"content": content, "properties": {}, "event_timestamp": 0}
+
+
+def test_producer(client):
+    kwargs = client.producer.kwargs
+    assert kwargs["block_if_queue_full"] is False
+    assert kwargs["send_timeout_millis"] == 30000
+
+
+def _produce_later(client, messages, *results):
+    """Produce the messages, firing their callbacks from another thread."""
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.extend(client.produce_messages(messages))
+    )
+    thread.start()
+    while len(client.producer.callbacks) < len(results) and thread.is_alive():
+        thread.join(0.01)
+    # Waits for the callbacks, not for a timeout of its own
+    assert thread.is_alive()
+    client.producer.fire(*results)
+    thread.join()
+    return result
+
+
+def test_produce_messages(client):
+    messages = [_message(b"ok"), _message(b"fail")]
+
+    results = _produce_later(client, messages, pulsar.Result.Ok, pulsar.Result.Timeout)
+
+    assert results[0] is None
+    assert isinstance(results[1], PulsarDeliveryError)
+    assert results[1].result == pulsar.Result.Timeout
+
+
+def test_produce_messages_not_sent(client):
+    client.producer.closed = True
+
+    (result,) = client.produce_messages([_message(b"event")])
+
+    # Failed right away, without a callback to wait for
+    assert isinstance(result, ProducerClosed)
+
+
+def test_produce_event_async(client):
+    errors = []
+    client.produce_event_async(_event(), errors.append, TRACEPARENT)
+    client.produce_event_async(_event(), errors.append)
+
+    (_, properties), (_, other_properties) = client.producer.sent
+    assert properties[TRACEPARENT_HEADER] == TRACEPARENT
+    assert TRACEPARENT_HEADER not in other_properties
+    # Not settled until the broker answers
+    assert errors == []
+
+    client.producer.fire(pulsar.Result.Ok, pulsar.Result.ProducerQueueIsFull)
+    assert errors[0] is None
+    assert isinstance(errors[1], PulsarDeliveryError)
+    assert errors[1].result == pulsar.Result.ProducerQueueIsFull
+
+
+@pytest.mark.parametrize(
+    "result,error", [(pulsar.Result.Ok, None), (pulsar.Result.Timeout, True)]
+)
+def test_produce_event_aio(client, result, error):
+    async def produce():
+        task = asyncio.ensure_future(client.produce_event_aio(_event()))
+        while not client.producer.callbacks:
+            await asyncio.sleep(0)
+        assert not task.done()
+        # Fired on a thread of the Pulsar client
+        thread = threading.Thread(target=client.producer.fire, args=(result,))
+        thread.start()
+        try:
+            await task
+        finally:
+            thread.join()
+
+    if error:
+        with pytest.raises(PulsarDeliveryError):
+            asyncio.run(produce())
+    else:
+        asyncio.run(produce())
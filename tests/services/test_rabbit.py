@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pika
+import pytest
+
+from app.helpers.retry import ATTEMPT_HEADER, RetryTopology
+from app.services import rabbit
+from app.services.rabbit import RabbitClient, backoff_delay
+
+
+class FakeChannel:
+    def __init__(self):
+        self.is_open = True
+        self.consumed = []
+        self.published = []
+
+    def queue_declare(self, name, durable=False, arguments=None):
+        pass
+
+    def basic_qos(self, prefetch_count, global_qos=False):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.consumed.append(queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body, properties))
+
+    def close(self):
+        self.is_open = False
+
+    def stop_consuming(self):
+        pass
+
+
+class FakeConnection:
+    """Opens fake channels, failing to connect for the given attempts."""
+
+    failures = 0
+    opened = []
+
+    def __init__(self, parameters):
+        if FakeConnection.failures:
+            FakeConnection.failures -= 1
+            raise pika.exceptions.AMQPConnectionError("refused")
+        self.is_open = True
+        self.channels = []
+        self.on_events = None
+        FakeConnection.opened.append(self)
+
+    def channel(self):
+        self.channels.append(FakeChannel())
+        return self.channels[-1]
+
+    def process_data_events(self, time_limit=0):
+        self.on_events(self)
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture
+def client(monkeypatch):
+    FakeConnection.failures = 0
+    FakeConnection.opened = []
+    monkeypatch.setattr(rabbit.pika, "BlockingConnection", FakeConnection)
+    delays = []
+    monkeypatch.setattr(rabbit.time, "sleep", delays.append)
+    client = RabbitClient()
+    client.delays = delays
+    return client
+
+
+@pytest.mark.parametrize("attempt", range(10))
+def test_backoff_delay(attempt):
+    delays = [backoff_delay(attempt, 1, 60) for _ in range(100)]
+    assert all(0 <= delay <= min(60, 2 ** attempt) for delay in delays)
+
+
+def test_reconnect(client):
+    old_connection = client.connection
+    FakeConnection.failures = 2
+
+    client.reconnect()
+
+    assert not old_connection.is_open
+    assert client.connection is FakeConnection.opened[-1]
+    assert client.connection.is_open
+    # A delay before every attempt, growing with the failed attempts
+    assert len(client.delays) == 3
+    assert client.delays[0] <= client.reconnect_base_delay
+    assert client.delays[2] <= min(
+        client.reconnect_max_delay, client.reconnect_base_delay * 4
+    )
+
+
+def test_reconnect_stopped(client):
+    old_connection = client.connection
+    client.stopped = True
+
+    client.reconnect()
+
+    assert client.connection is old_connection
+    assert client.delays == []
+
+
+def test_listen_reconnects(client):
+    def lose_connection(connection):
+        raise pika.exceptions.AMQPConnectionError("lost")
+
+    def stop(connection):
+        client.stopped = True
+
+    client.connection.on_events = lose_connection
+    FakeConnection.failures = 1
+    # The new connection is created by the reconnect
+    original_reconnect = client.reconnect
+
+    def reconnect():
+        original_reconnect()
+        client.connection.on_events = stop
+
+    client.reconnect = reconnect
+
+    client.listen(lambda *args: None)
+
+    first, second = FakeConnection.opened
+    assert client.connection is second
+    assert not first.is_open
+    # The queues are consumed again on the channels of the new connection
+    assert [c.consumed for c in second.channels] == [
+        [queue.name] for queue in client.queues
+    ]
+    assert set(client.channels.values()) == set(second.channels)
+    assert len(client.delays) == 2
+
+
+def test_listen_reopens_closed_channel(client):
+    events = []
+
+    def close_channel(connection):
+        events.append(connection)
+        if len(events) == 1:
+            connection.channels[0].is_open = False
+        else:
+            client.stopped = True
+
+    client.connection.on_events = close_channel
+
+    client.listen(lambda *args: None)
+
+    # The connection is kept, the channels are opened again
+    assert FakeConnection.opened == [client.connection]
+    assert len(client.connection.channels) == 2 * len(client.queues)
+    assert client.delays == [client.reconnect_base_delay]
+
+
+def test_retry():
+    channel = FakeChannel()
+    retry_topology = RetryTopology("queue")
+    properties = pika.BasicProperties(
+        content_type="application/json",
+        headers={"origin": "watchfolder"},
+        priority=5,
+        message_id="message",
+        timestamp=1700000000,
+        user_id="publisher",
+    )
+
+    queue = RabbitClient.retry(channel, retry_topology, properties, b"body")
+
+    assert queue == retry_topology.retry_queue(1)
+    ((routing_key, body, retried),) = channel.published
+    assert (routing_key, body) == (queue, b"body")
+    # Only the headers and the delivery mode change
+    assert retried.headers == {"origin": "watchfolder", ATTEMPT_HEADER: 1}
+    assert retried.delivery_mode == 2
+    assert retried.content_type == "application/json"
+    assert retried.priority == 5
+    assert retried.message_id == "message"
+    assert retried.timestamp == 1700000000
+    assert retried.user_id is None
+    # The properties of the delivery are left alone
+    assert properties.headers == {"origin": "watchfolder"}
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+from datetime import datetime, timezone
+
+import aio_pika
+
+from app.helpers.retry import ATTEMPT_HEADER, RetryTopology
+from app.services.rabbit import ConsumerQueue
+from app.services import rabbit_async
+from app.services.rabbit_async import AsyncRabbitClient, JitteredRobustConnection
+
+
+class FakeExchange:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        self.published.append((message, routing_key))
+
+
+class FakeAmqpQueue:
+    def __init__(self):
+        self.cancelled = []
+
+    async def cancel(self, consumer_tag):
+        self.cancelled.append(consumer_tag)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.default_exchange = FakeExchange()
+        self.prefetch_count = None
+
+    async def set_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+
+class FakeMessage:
+    body = b"body"
+    content_type = "application/json"
+    content_encoding = None
+    priority = 5
+    correlation_id = "correlation"
+    reply_to = None
+    expiration = None
+    message_id = "message"
+    timestamp = datetime(2023, 11, 14, tzinfo=timezone.utc)
+    type = None
+    app_id = None
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+def test_jittered_reconnect_interval(monkeypatch):
+    async def create():
+        return JitteredRobustConnection(
+            aio_pika.connection.make_url(reconnect_interval=1, max_reconnect_interval=8)
+        )
+
+    connection = asyncio.run(create())
+    now = [100.0]
+    monkeypatch.setattr(rabbit_async.time, "monotonic", lambda: now[0])
+
+    # Up to the reconnect interval right after losing the connection
+    intervals = [connection.reconnect_interval for _ in range(100)]
+    assert all(0 <= interval <= 1 for interval in intervals)
+    assert len(set(intervals)) > 1
+    # Growing with the outage, up to the maximum
+    now[0] += 4
+    intervals = [connection.reconnect_interval for _ in range(100)]
+    assert all(0 <= interval <= 4 for interval in intervals)
+    assert max(intervals) > 1
+    now[0] += 100
+    assert all(0 <= connection.reconnect_interval <= 8 for _ in range(100))
+
+
+def test_retry():
+    client = AsyncRabbitClient()
+    queue = ConsumerQueue("queue", 1, retry_topology=RetryTopology("queue"))
+    channel = client.channels["queue"] = FakeChannel()
+
+    routing_key = asyncio.run(client.retry(queue, FakeMessage()))
+
+    assert routing_key == queue.retry_topology.retry_queue(1)
+    ((message, published_to),) = channel.default_exchange.published
+    assert published_to == routing_key
+    assert message.body == b"body"
+    assert message.headers[ATTEMPT_HEADER] == 1
+    assert message.delivery_mode == aio_pika.DeliveryMode.PERSISTENT
+    # The other properties are kept
+    assert message.content_type == "application/json"
+    assert message.priority == 5
+    assert message.message_id == "message"
+    assert message.timestamp == FakeMessage.timestamp
+
+
+def test_retry_parked():
+    client = AsyncRabbitClient()
+    queue = ConsumerQueue("queue", 1, retry_topology=RetryTopology("queue"))
+    client.channels["queue"] = FakeChannel()
+
+    message = FakeMessage({ATTEMPT_HEADER: queue.retry_topology.max_attempts - 1})
+    routing_key = asyncio.run(client.retry(queue, message))
+
+    assert routing_key == queue.retry_topology.parking_queue
+
+
+def test_set_prefetch_counts():
+    client = AsyncRabbitClient()
+    channels = {queue.name: FakeChannel() for queue in client.queues}
+    client.channels = channels
+    client.queues[0].prefetch_count = 7
+
+    asyncio.run(client.set_prefetch_counts())
+
+    assert channels[client.queues[0].name].prefetch_count == 7
+
+
+def test_stop_consuming():
+    client = AsyncRabbitClient()
+    amqp_queue = FakeAmqpQueue()
+    client.consumers = [(amqp_queue, "consumer")]
+
+    asyncio.run(client.stop_consuming())
+
+    assert amqp_queue.cancelled == ["consumer"]
+    assert client.consumers == []
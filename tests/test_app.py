@@ -1,2 +1,234 @@
 #!/usr/bin/env python3
-# -*- coding: utf-8 -*-
\ No newline at end of file
+# -*- coding: utf-8 -*-
+
+import functools
+import json
+
+import pika
+import pulsar
+import pytest
+from cloudevents.events import Event, EventAttributes, EventOutcome
+
+from app import app as app_module
+from app.app import EventListener
+from app.helpers.admission import DiskAdmission
+from app.helpers.inflight import Delivery, calculate_message_key
+from app.helpers.journal import JobJournal, JobStage
+from app.helpers.retry import RetryTopology
+from app.helpers.tracing import Trace
+from app.services import pulsar as pulsar_module
+from app.services import rabbit
+from app.services.rabbit import ConsumerQueue
+
+BODY = b'{"sip_package": []}'
+
+
+class FakeChannel:
+    def __init__(self):
+        self.is_open = True
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append(routing_key)
+
+
+class FakeConnection:
+    """Runs the thread safe callbacks right away."""
+
+    def __init__(self, parameters=None):
+        self.is_open = True
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+
+class FakeAcks:
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.channel = FakeChannel()
+        self.settled = []
+
+    def ack(self, delivery_tag):
+        self.settled.append(("ack", delivery_tag))
+
+    def nack(self, delivery_tag, requeue=False):
+        self.settled.append(("nack", delivery_tag, requeue))
+
+
+class FakeProducer:
+    def __init__(self):
+        self.callbacks = []
+
+    def send_async(self, callback, content, properties, event_timestamp=None):
+        self.callbacks.append(callback)
+
+    def fire(self, result):
+        self.callbacks.pop(0)(result, None)
+
+
+class FakePulsarClient:
+    def __init__(self, url):
+        pass
+
+    def create_producer(self, topic, **kwargs):
+        return FakeProducer()
+
+
+class FakeMetricsServer:
+    def __init__(self, registry, host, port):
+        pass
+
+
+@pytest.fixture
+def listener(monkeypatch, tmp_path):
+    monkeypatch.setattr(rabbit.pika, "BlockingConnection", FakeConnection)
+    monkeypatch.setattr(pulsar_module.pulsar, "Client", FakePulsarClient)
+    monkeypatch.setattr(app_module, "MetricsServer", FakeMetricsServer)
+    listener = EventListener()
+    listener.journal = JobJournal(tmp_path.joinpath("journal.db"))
+    return listener
+
+
+def _event():
+    attributes = EventAttributes(
+        type="be.meemoo.sipin.sip.create",
+        source="sipin-sip-creator",
+        subject="essence",
+        outcome=EventOutcome.SUCCESS,
+    )
+    return Event(attributes, {"path": "/output/essence.bag.zip"})
+
+
+def _produce(listener, queue, *deliveries):
+    """Deliver a message and send its event, as `do_work` does."""
+    key = calculate_message_key(BODY)
+    for acks, delivery_tag in deliveries:
+        listener.in_flight.claim(key, Delivery(acks, delivery_tag, queue))
+    trace = Trace(key[:32])
+    publish = trace.child("pulsar_publish")
+    properties = pika.BasicProperties(headers={})
+    listener.pulsar_client.produce_event_async(
+        _event(),
+        functools.partial(
+            listener.event_delivered, key, properties, BODY, "job", trace, publish
+        ),
+        publish.traceparent,
+    )
+    return key
+
+
+def test_event_delivered(listener):
+    acks = FakeAcks()
+    key = _produce(listener, ConsumerQueue("queue", 1), (acks, 1), (acks, 2))
+    # Not settled until the broker answers
+    assert acks.settled == []
+    assert listener.journal.get("job") is None
+
+    listener.pulsar_client.producer.fire(pulsar.Result.Ok)
+
+    # All the deliveries are acked and the job is announced
+    assert acks.settled == [("ack", 1), ("ack", 2)]
+    assert listener.journal.get("job").stage is JobStage.ANNOUNCED
+    assert listener.in_flight.current(key) == []
+
+
+def test_event_delivered_error_retry(listener):
+    acks = FakeAcks()
+    queue = ConsumerQueue("queue", 1, retry_topology=RetryTopology("queue"))
+    _produce(listener, queue, (acks, 1))
+
+    listener.pulsar_client.producer.fire(pulsar.Result.Timeout)
+
+    # Published to the retry queue, then acked
+    assert acks.channel.published == [queue.retry_topology.retry_queue(1)]
+    assert acks.settled == [("ack", 1)]
+    assert listener.journal.get("job") is None
+
+
+def test_event_delivered_error_requeue(listener):
+    acks = FakeAcks()
+    _produce(listener, ConsumerQueue("queue", 1), (acks, 1))
+
+    listener.pulsar_client.producer.fire(pulsar.Result.ProducerQueueIsFull)
+
+    # Without retry queues, the message is requeued
+    assert acks.settled == [("nack", 1, True)]
+    assert listener.journal.get("job") is None
+
+
+class FakeBag:
+    def __init__(self, folder, bag=None):
+        self.folder = folder
+        self.bag = bag
+        self.created = False
+        self.job_id = "job"
+        self.cleanup_deferred = False
+        self.stage_durations = {}
+        self.io_stats = {}
+        self.page_cache_monitor = None
+
+    def space_requirements(self):
+        return {self.folder: 1}
+
+    def create_sip_bag(self):
+        self.created = True
+        return self.folder.joinpath("essence.bag.zip"), self.bag
+
+
+def _body(tmp_path):
+    tmp_path.joinpath("essence.mxf").write_bytes(b"essence")
+    tmp_path.joinpath("essence.xml").write_bytes(b"<sidecar/>")
+    return json.dumps(
+        {
+            "cp_name": "CP",
+            "flow_id": "OR-1",
+            "sip_package": [
+                {
+                    "file_type": file_type,
+                    "file_name": f"essence.{extension}",
+                    "file_path": str(tmp_path),
+                }
+                for file_type, extension in (("essence", "mxf"), ("sidecar", "xml"))
+            ],
+        }
+    ).encode()
+
+
+@pytest.mark.parametrize("bag,counted", [(object(), 1), (None, 0)])
+def test_do_work_sip_created(listener, monkeypatch, tmp_path, bag, counted):
+    body = _body(tmp_path)
+    monkeypatch.setattr(app_module, "Sidecar", lambda path: None)
+    monkeypatch.setattr(
+        listener, "create_bag", lambda message, sidecar: FakeBag(tmp_path, bag)
+    )
+    monkeypatch.setattr(listener, "event_metrics", lambda *args: {})
+    monkeypatch.setattr(listener, "create_event", lambda *args: _event())
+    key = calculate_message_key(body)
+    listener.in_flight.claim(key, Delivery(FakeAcks(), 1, ConsumerQueue("queue", 1)))
+
+    listener.do_work(key, pika.BasicProperties(headers={}), body, Trace(key[:32]))
+
+    # A SIP published by an earlier attempt isn't counted again
+    sips = listener.metrics.sips.value(mimetype="application/mxf", cp_id="OR-1")
+    assert sips == counted
+
+
+def test_do_work_no_space(listener, monkeypatch, tmp_path):
+    body = _body(tmp_path)
+    bag = FakeBag(tmp_path)
+    monkeypatch.setattr(app_module, "Sidecar", lambda path: None)
+    monkeypatch.setattr(listener, "create_bag", lambda message, sidecar: bag)
+    # Nothing fits on the filesystem
+    listener.admission = DiskAdmission(tmp_path.joinpath("admission.db"), 2 ** 62)
+    acks = FakeAcks()
+    queue = ConsumerQueue("queue", 1, retry_topology=RetryTopology("queue"))
+    key = calculate_message_key(body)
+    listener.in_flight.claim(key, Delivery(acks, 1, queue))
+
+    listener.do_work(key, pika.BasicProperties(headers={}), body, Trace(key[:32]))
+
+    # Retried later instead of waiting for the space on the worker
+    assert not bag.created
+    assert acks.channel.published == [queue.retry_topology.retry_queue(1)]
+    assert acks.settled == [("ack", 1)]
+    assert listener.waiting_for_space == 0
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+from app import app as app_module
+from app.async_app import AsyncEventListener
+from app.helpers.inflight import calculate_message_key
+from app.helpers.retry import RetryTopology
+from app.services.rabbit import ConsumerQueue
+
+
+class FakePulsarClient:
+    async_send = False
+
+    def close(self):
+        pass
+
+
+class FakeMetricsServer:
+    def __init__(self, registry, host, port):
+        pass
+
+
+class FakeRabbitClient:
+    def __init__(self, queues):
+        self.queues = queues
+        self.retried = []
+
+    async def retry(self, queue, message):
+        self.retried.append(message)
+        routing_key, _ = queue.retry_topology.route(message.headers)
+        return routing_key
+
+
+class FakeChannel:
+    def __init__(self):
+        self.is_closed = False
+
+
+class FakeMessage:
+    def __init__(self, body, channel, headers=None):
+        self.body = body
+        self.channel = channel
+        self.headers = headers or {}
+        self.settled = []
+
+    async def ack(self):
+        self.settled.append("ack")
+
+    async def nack(self, requeue=False):
+        self.settled.append(("nack", requeue))
+
+
+@pytest.fixture
+def listener(monkeypatch):
+    monkeypatch.setattr(app_module, "PulsarClient", FakePulsarClient)
+    monkeypatch.setattr(app_module, "MetricsServer", FakeMetricsServer)
+    listener = AsyncEventListener()
+    listener.rabbit_client = FakeRabbitClient(
+        [
+            ConsumerQueue("queue", 1),
+            ConsumerQueue("retried", 1, retry_topology=RetryTopology("retried")),
+        ]
+    )
+    return listener
+
+
+def _run_jobs(listener, settle, deliveries):
+    """Deliver the messages and settle their jobs once all are delivered."""
+
+    async def run():
+        delivered = asyncio.Event()
+        started = []
+
+        async def run_job(key, queue, message, time):
+            started.append(message)
+            await delivered.wait()
+            await settle(key)
+
+        listener.run_job = run_job
+        for queue, message in deliveries:
+            await listener.handle_message(queue, message)
+        tasks = list(listener.tasks.values())
+        delivered.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    return asyncio.run(run())
+
+
+def test_dedupe_ack(listener):
+    queue, other_queue = listener.rabbit_client.queues
+    channel = FakeChannel()
+    first = FakeMessage(b"body", channel)
+    duplicate = FakeMessage(b"body", channel)
+    other = FakeMessage(b"body", FakeChannel())
+
+    started = _run_jobs(
+        listener,
+        listener.ack,
+        [(queue, first), (queue, duplicate), (other_queue, other)],
+    )
+
+    # One job, settling all the deliveries
+    assert started == [first]
+    assert first.settled == duplicate.settled == other.settled == ["ack"]
+    assert listener.deliveries == {}
+    assert listener.tasks == {}
+
+
+def test_dedupe_reconnect(listener):
+    queue, _ = listener.rabbit_client.queues
+    old_channel = FakeChannel()
+    first = FakeMessage(b"body", old_channel)
+    redelivery = FakeMessage(b"body", FakeChannel())
+
+    async def deliver():
+        await listener.handle_message(queue, first)
+        old_channel.is_closed = True
+        await listener.handle_message(queue, redelivery)
+        key = calculate_message_key(b"body")
+        deliveries = listener.deliveries[key]
+        await listener.ack(key)
+        await asyncio.gather(*listener.tasks.values(), return_exceptions=True)
+        return deliveries
+
+    listener.run_job = lambda *args: asyncio.sleep(0)
+
+    # The delivery on the closed channel can't be settled anymore
+    assert asyncio.run(deliver()) == [(queue, redelivery)]
+    assert first.settled == []
+    assert redelivery.settled == ["ack"]
+
+
+def test_retry(listener):
+    queue, retried_queue = listener.rabbit_client.queues
+    channel = FakeChannel()
+    first = FakeMessage(b"body", channel)
+    duplicate = FakeMessage(b"body", channel)
+    other = FakeMessage(b"body", FakeChannel())
+
+    _run_jobs(
+        listener,
+        listener.retry,
+        [(retried_queue, first), (retried_queue, duplicate), (queue, other)],
+    )
+
+    # Published to the retry queue once, all the deliveries are settled
+    assert listener.rabbit_client.retried == [first]
+    assert first.settled == duplicate.settled == ["ack"]
+    # Without retry queues, the message is requeued
+    assert other.settled == [("nack", True)]
+
+
+def test_nack(listener):
+    queue, _ = listener.rabbit_client.queues
+    channel = FakeChannel()
+    first = FakeMessage(b"body", channel)
+    duplicate = FakeMessage(b"body", channel)
+
+    _run_jobs(listener, listener.nack, [(queue, first), (queue, duplicate)])
+
+    assert first.settled == duplicate.settled == [("nack", False)]